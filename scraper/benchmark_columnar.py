@@ -0,0 +1,91 @@
+import argparse
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from columnar import MenuHistory, deep_size
+from menu_diff import diff
+
+
+def synthetic_history(snapshots, beverages, changes, seed=0):
+    """
+    Build a history of menus of one location, each menu has changes beverages replaced from the previous one. Every
+    tenth replacement is a copy of a beverage already on the menu, so some menus list a beverage twice.
+
+    :param snapshots: Number of menus.
+    :type snapshots: int
+    :param beverages: Number of beverages per menu.
+    :type beverages: int
+    :param changes: Number of beverages replaced between menus.
+    :type changes: int
+    :param seed: Random seed.
+    :type seed: int
+    :return: List of menus, oldest first.
+    :rtype: list
+    """
+    rand = random.Random(seed)
+    start = datetime(2015, 1, 1)
+    styles = ['IPA', 'Stout', 'Saison', 'Lager', 'Sour']
+    current = [_beverage(rand, i, styles) for i in range(beverages)]
+    menus = []
+    for n in range(snapshots):
+        for change in range(n * changes, (n + 1) * changes):
+            if change % 10 == 9:
+                beverage = dict(rand.choice(current))
+            else:
+                beverage = _beverage(rand, rand.randrange(beverages * 10), styles)
+            current[rand.randrange(beverages)] = beverage
+        menus.append({
+            'location': 'Synthetic',
+            'parsed': str(start + timedelta(days=n)),
+            'sections': [{'name': 'Drafts', 'type': 'beer', 'beverages': [dict(b) for b in current]}]
+        })
+    return menus
+
+
+def _beverage(rand, i, styles):
+    abv = round(rand.uniform(4, 12), 1)
+    price = rand.randrange(6, 15)
+    style = rand.choice(styles)
+    return {
+        'name': 'Beer {0} - Brewery {1} / CA / {2} / 16oz / {3}% / ${4}'.format(i, i % 50, style, abv, price),
+        'details': {'type': 'beer', 'name': 'Beer {0}'.format(i), 'brewery': 'Brewery {0}'.format(i % 50),
+                    'location': 'CA', 'style': style, 'size': '16oz', 'alcohol_percentage': '{0}%'.format(abv),
+                    'price': '${0}'.format(price), 'abv': abv, 'price_cents': price * 100, 'size_ml': 473.2}
+    }
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Compare the memory of nested menu dicts with a MenuHistory.')
+    parser.add_argument('--snapshots', type=int, default=365, help='number of menus')
+    parser.add_argument('--beverages', type=int, default=200, help='number of beverages per menu')
+    parser.add_argument('--changes', type=int, default=5, help='number of beverages replaced between menus')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timing runs, best is reported')
+    args = parser.parse_args()
+
+    menus = synthetic_history(args.snapshots, args.beverages, args.changes)
+    history = MenuHistory()
+    for menu in menus:
+        history.add(menu['location'], menu['parsed'], menu)
+
+    # Both representations must agree on every diff before comparing
+    for i in range(1, len(menus)):
+        expected = diff(menus[i - 1], menus[i])
+        added, removed = history.diff(i - 1, i)
+        assert [item['beverage'] for item in expected['added']] == [history.value('name', r) for r in added]
+        assert [item['beverage'] for item in expected['removed']] == [history.value('name', r) for r in removed]
+
+    dict_time = min(timeit.repeat(lambda: [diff(menus[i - 1], menus[i]) for i in range(1, len(menus))],
+                                  number=1, repeat=args.repeat))
+    columnar_time = min(timeit.repeat(lambda: [history.diff(i - 1, i) for i in range(1, len(menus))],
+                                      number=1, repeat=args.repeat))
+    dict_size = deep_size(menus)
+    columnar_size = history.memory()
+
+    print 'History: {0} menus of {1} beverages, {2} changes per menu'.format(args.snapshots, args.beverages,
+                                                                            args.changes)
+    print 'Nested dicts:  {0:.1f}MB, diffs {1:.4f}s'.format(dict_size / 1e6, dict_time)
+    print 'MenuHistory:   {0:.1f}MB, diffs {1:.4f}s'.format(columnar_size / 1e6, columnar_time)
+    print 'Memory:        {0:.1f}%'.format(100.0 * columnar_size / dict_size)
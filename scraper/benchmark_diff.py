@@ -0,0 +1,100 @@
+import argparse
+import random
+import timeit
+from datetime import datetime, timedelta
+
+from menu_diff import diff
+
+
+def legacy_diff(original, modified):
+    """
+    The nested scan diff menu_diff.diff used to be, kept to compare against.
+    """
+    _diff = {'added': [], 'removed': []}
+
+    for section in modified['sections']:
+        o_section = None
+        for s in original['sections']:
+            if s['name'] == section['name']:
+                o_section = s
+        for beverage in section['beverages']:
+            o_beverage = None
+            for b in o_section['beverages']:
+                if b['name'] == beverage['name']:
+                    o_beverage = b
+            if not o_beverage:
+                _diff['added'].append({'section': section['name'], 'beverage': beverage['name']})
+
+    for section in original['sections']:
+        m_section = None
+        for s in modified['sections']:
+            if s['name'] == section['name']:
+                m_section = s
+        for beverage in section['beverages']:
+            m_beverage = None
+            for b in m_section['beverages']:
+                if b['name'] == beverage['name']:
+                    m_beverage = b
+            if not m_beverage:
+                _diff['removed'].append({'section': section['name'], 'beverage': beverage['name']})
+
+    return _diff
+
+
+def synthetic_menus(beverages, sections, changes, seed=0):
+    """
+    Build a pair of menus with the given number of beverages spread over sections. The second menu has changes
+    beverages replaced.
+
+    :param beverages: Total number of beverages per menu.
+    :type beverages: int
+    :param sections: Number of sections per menu.
+    :type sections: int
+    :param changes: Number of beverages replaced in the modified menu.
+    :type changes: int
+    :param seed: Random seed.
+    :type seed: int
+    :return: Original and modified menus.
+    :rtype: tuple
+    """
+    rand = random.Random(seed)
+    now = datetime.now()
+    original = {'location': 'Synthetic', 'parsed': str(now - timedelta(days=1)), 'sections': []}
+    modified = {'location': 'Synthetic', 'parsed': str(now), 'sections': []}
+    per_section = beverages // sections
+    for i in range(sections):
+        names = ['Beer {0}-{1} - Brewery {1} / CA / IPA / 7.{1}%'.format(i, j) for j in range(per_section)]
+        original['sections'].append({'name': 'Section {0}'.format(i), 'type': 'beer',
+                                     'beverages': [{'name': name} for name in names]})
+        modified['sections'].append({'name': 'Section {0}'.format(i), 'type': 'beer',
+                                     'beverages': [{'name': name} for name in names]})
+    for n in range(changes):
+        section = rand.choice(modified['sections'])
+        beverage = rand.choice(section['beverages'])
+        beverage['name'] = 'New Beer {0} - Brewery / CA / Stout / 9%'.format(n)
+    return original, modified
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark menu_diff.diff against the previous nested scan diff.')
+    parser.add_argument('--beverages', type=int, default=10000, help='number of beverages per menu')
+    parser.add_argument('--sections', type=int, default=10, help='number of sections per menu')
+    parser.add_argument('--changes', type=int, default=100, help='number of beverages changed between menus')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timing runs, best is reported')
+    args = parser.parse_args()
+
+    original, modified = synthetic_menus(args.beverages, args.sections, args.changes)
+
+    # Both implementations must agree before comparing timings
+    expected = legacy_diff(original, modified)
+    actual = diff(original, modified)
+    assert expected['added'] == actual['added'] and expected['removed'] == actual['removed']
+
+    legacy_time = min(timeit.repeat(lambda: legacy_diff(original, modified), number=1, repeat=args.repeat))
+    indexed_time = min(timeit.repeat(lambda: diff(original, modified), number=1, repeat=args.repeat))
+
+    print 'Menus: {0} beverages in {1} sections, {2} changes'.format(args.beverages, args.sections, args.changes)
+    print 'Nested scan diff: {0:.4f}s'.format(legacy_time)
+    print 'Indexed diff:     {0:.4f}s'.format(indexed_time)
+    print 'Speedup:          {0:.1f}x'.format(legacy_time / indexed_time)
@@ -0,0 +1,120 @@
+import argparse
+import imp
+import json
+import logging
+import os
+import subprocess
+import timeit
+
+from parse_menu import BeerParser, ParsingException, normalized_fields
+
+# Beer titles as they appear on the menus
+corpus = [
+    'Old Speckled Hen - Green King / UK / Cream Ale / Nitro / 5.2%',
+    'RazzMaTazz - Julian / CA / Rasp Cider / 22oz / 6.9% / $12',
+    'Saison Dupont Cuvee Dry Hop - Dupont / Belg / Saison / 6.5% / $10',
+    'Avec Les Bons Voeux 2012 - Dupont / Belg / Xmas Saison / 9.5%',
+    'Weihenstephaner Original - Germ / Helles Lager / 5.1%',
+    'St Louis Framboise - Belgium / Lambic-Fruit / 375ml / 4.5% / $15',
+    'Pliny the Elder - Russian River / CA / DIPA / 8%',
+    'Hop Stoopid w/ Citra - Lagunitas / CA / IPAw / Citra / 8%',
+    'Kostritzer - Germ / Schwarzbier / 4.8%',
+    'Guinness - Ireland / Dry Stout / Nitro / 4.2%',
+    'Bourbon County Brand Stout 2013 - Goose Island / IL / Imperial Stout / 12oz / 14.9% / $15',
+    'Duvel - Belg / Golden Strong / 330ml / 8.5% / $9',
+    'Allagash White - ME / Witbier / 5.2%',
+    'Sculpin - Ballast Point / CA / IPA / 7%',
+    'Chimay Blue - Belg / Trappist Strong Dark / 750ml / 9% / $24',
+    'Old Rasputin - North Coast / CA / Russian Imperial Stout / Nitro / 9%',
+    'Stone Enjoy By 09.05.14 - Stone / CA / DIPA / 22oz / 9.4% / $11',
+    'La Fin du Monde - Unibroue / Canada / Tripel / 9%',
+    'Rodenbach Grand Cru - Belg / Flanders Red / 6%',
+    'Firestone Walker Parabola 2014 - CA / Imperial Stout / 12oz / 14% / $18',
+]
+
+# The commit before the BeerParser hot path rework, the parser the rework is measured against
+rework_revision = '5b81dadbb301a6dade0719e286b5ab35cdb5c111'
+
+
+def load_revision(revision):
+    """
+    Load parse_menu as it was at a git revision, to compare the working tree's parser against.
+
+    :param revision: Git revision, e.g. HEAD or a commit hash.
+    :type revision: str
+    :return: The parse_menu module of the revision.
+    :rtype: module
+    :raises subprocess.CalledProcessError: If the revision has no parse_menu.py.
+    """
+    directory = os.path.dirname(os.path.realpath(__file__))
+    source = subprocess.check_output(['git', 'show', '{0}:./parse_menu.py'.format(revision)], cwd=directory)
+    module = imp.new_module('parse_menu_{0}'.format(revision))
+    module.__file__ = os.path.join(directory, 'parse_menu.py')
+    exec compile(source, '{0}:parse_menu.py'.format(revision), 'exec') in module.__dict__
+    return module
+
+
+def _compare(titles, parser, previous):
+    for title in titles:
+        expected = _parse_or_fail(previous.BeerParser(), title, previous.ParsingException)
+        actual = _parse_or_fail(parser, title, ParsingException)
+        assert expected == actual, 'Parsed "{0}" as {1}, expected {2}'.format(title, actual, expected)
+
+
+def _parse_or_fail(parser, title, exception):
+    try:
+        details = parser.parse(title)
+    except exception:
+        return 'unparsed'
+    # Older parsers did not add the numeric fields
+    for field in normalized_fields:
+        details.pop(field, None)
+    return details
+
+
+def _parse_all(titles, parser, exception=ParsingException):
+    for title in titles:
+        try:
+            parser.parse(title)
+        except exception:
+            pass
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark BeerParser against its implementation at a git revision.')
+    parser.add_argument('menus', type=str, nargs='*', help='menu JSON files to take beer titles from')
+    parser.add_argument('--revision', type=str, default=rework_revision,
+                        help='git revision to compare the parser against, the commit before the rework by default')
+    parser.add_argument('--number', type=int, default=2000, help='number of passes over the titles per run')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timing runs, best is reported')
+    args = parser.parse_args()
+
+    # Quiet the warnings about unidentified pieces
+    logging.getLogger().setLevel(logging.ERROR)
+
+    titles = list(corpus)
+    for menu_file in args.menus:
+        with open(menu_file) as fh:
+            for section in json.load(fh)['sections']:
+                if section['type'] == 'beer':
+                    titles.extend(beverage['name'] for beverage in section['beverages'])
+
+    try:
+        previous = load_revision(args.revision)
+    except subprocess.CalledProcessError:
+        parser.error('Unable to read parse_menu.py at revision {0}'.format(args.revision))
+    beer_parser = BeerParser()
+    previous_beer_parser = previous.BeerParser()
+    # Both implementations must agree before comparing timings
+    _compare(titles, beer_parser, previous)
+
+    legacy_time = min(timeit.repeat(lambda: _parse_all(titles, previous_beer_parser, previous.ParsingException),
+                                    number=args.number, repeat=args.repeat))
+    new_time = min(timeit.repeat(lambda: _parse_all(titles, beer_parser), number=args.number, repeat=args.repeat))
+    count = len(titles) * args.number
+
+    print 'Titles: {0} distinct, {1} parsed per run'.format(len(titles), count)
+    print 'BeerParser at {0}: {1:.0f} titles/s'.format(args.revision[:7], count / legacy_time)
+    print 'BeerParser:            {0:.0f} titles/s'.format(count / new_time)
+    print 'Speedup:               {0:.2f}x'.format(legacy_time / new_time)
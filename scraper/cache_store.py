@@ -0,0 +1,551 @@
+import argparse
+import difflib
+import hashlib
+import os
+import json
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+root_log = logging.getLogger()
+
+# Format of the scraped column, sorts the same as the datetime it represents
+date_format = '%Y-%m-%d %H:%M:%S.%f'
+# Format of the scrape time in the URL of a snapshot's menu view
+url_time_format = '%Y%m%dT%H%M%S.%f'
+
+Snapshot = namedtuple('Snapshot', ['id', 'location', 'scraped', 'blob'])
+
+
+class CacheStoreException(Exception):
+    pass
+
+
+class MenuCacheStore(object):
+    """
+    Parsed menus stored in a single SQLite file, indexed by location and scrape time.
+
+    Finding the nearest, newest or oldest menu for a location is a single indexed lookup. Connections are per thread
+    (and per process) so a store can be shared by the scraper threads and the web app.
+
+    Menus are stored content addressed. A snapshot points at the blob holding its menu, so menus which did not change
+    between scrapes share a single blob. Optionally a new blob is stored as a delta against the blob of the previous
+    snapshot, with a full checkpoint every checkpoint_interval blobs to keep loading fast.
+    """
+
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            base TEXT,
+            depth INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY,
+            location TEXT NOT NULL,
+            scraped TEXT NOT NULL,
+            parsed TEXT,
+            blob TEXT NOT NULL REFERENCES blobs (hash)
+        )''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS snapshots_location_scraped ON snapshots (location, scraped)',
+        '''CREATE TABLE IF NOT EXISTS pages (
+            hash TEXT PRIMARY KEY,
+            data BLOB NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS snapshot_pages (
+            location TEXT NOT NULL,
+            scraped TEXT NOT NULL,
+            name TEXT NOT NULL,
+            page TEXT NOT NULL REFERENCES pages (hash),
+            PRIMARY KEY (location, scraped)
+        )''',
+    ]
+
+    def __init__(self, path, deltas=False, checkpoint_interval=7):
+        """
+        :param path: Path to the SQLite file, created if it does not exist.
+        :type path: str
+        :param deltas: Store new blobs as deltas against the previous snapshot of the location.
+        :type deltas: bool
+        :param checkpoint_interval: Maximum number of deltas between full blobs.
+        :type checkpoint_interval: int
+        """
+        self.path = path
+        self.deltas = deltas
+        self.checkpoint_interval = checkpoint_interval
+        self._local = threading.local()
+
+    def connection(self):
+        """
+        Get the SQLite connection for the current thread.
+
+        :rtype: sqlite3.Connection
+        """
+        # Connections can not be shared with a forked process either
+        if getattr(self._local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            self._local.schemas = set()
+            with connection:
+                self._upgrade(connection)
+                for statement in self.schema:
+                    connection.execute(statement)
+        return self._local.connection
+
+    def ensure_schema(self, schema):
+        """
+        Create the tables of a module built on top of the store, once per connection.
+
+        :param schema: CREATE ... IF NOT EXISTS statements.
+        :type schema: list
+        :return: Connection for the current thread.
+        :rtype: sqlite3.Connection
+        """
+        connection = self.connection()
+        key = tuple(schema)
+        if key not in self._local.schemas:
+            with connection:
+                for statement in schema:
+                    connection.execute(statement)
+            self._local.schemas.add(key)
+        return connection
+
+    def put(self, location, time, menu, replace=None, fence=None, html=None):
+        """
+        Store a parsed menu, replacing any menu for the location scraped at the same time.
+
+        :param location: Stout location name.
+        :type location: str
+        :param time: When menu was downloaded.
+        :type time: datetime
+        :param menu: Parsed menu.
+        :type menu: dict
+        :param replace: Snapshot being replaced, nothing is written if the menu is the same as the snapshot's.
+        :type replace: Snapshot
+        :param fence: Called with the connection first thing in the transaction, raising rolls the write back. Lets a
+        writer check it still holds its lease atomically with the write.
+        :type fence: callable
+        :param html: Menu page HTML the menu was parsed from, archived in the same transaction, see put_page.
+        :type html: str
+        :return: The stored snapshot.
+        :rtype: Snapshot
+        """
+        name, location = location, location_key(location)
+        scraped = time.strftime(date_format)
+        # The parse time differs every scrape, keep it with the snapshot so the rest of the menu can be shared
+        content = dict(menu)
+        parsed = content.pop('parsed', None)
+        text = _encode(content)
+        blob = hashlib.sha1(text).hexdigest()
+        if blob == getattr(replace, 'blob', None):
+            return replace
+        with self.connection() as connection:
+            if fence:
+                fence(connection)
+            if not connection.execute('SELECT 1 FROM blobs WHERE hash = ?', (blob,)).fetchone():
+                self._put_blob(connection, blob, text, location, scraped)
+            cursor = connection.execute(
+                'INSERT OR REPLACE INTO snapshots (location, scraped, parsed, blob) VALUES (?, ?, ?, ?)',
+                (location, scraped, parsed, blob))
+            snapshot = Snapshot(cursor.lastrowid, location, scraped, blob)
+            if html:
+                self._put_page(connection, snapshot, name, html)
+        return snapshot
+
+    def put_page(self, snapshot, name, html):
+        """
+        Archive the raw HTML a snapshot was parsed from, so it can be parsed again when the parser improves. Pages are
+        compressed and stored by content hash.
+
+        :param snapshot: Snapshot parsed from the page.
+        :type snapshot: Snapshot
+        :param name: Location name as passed to parse_menu.
+        :type name: str
+        :param html: Menu page HTML.
+        :type html: str
+        """
+        with self.connection() as connection:
+            self._put_page(connection, snapshot, name, html)
+
+    def latest_page(self, location):
+        """
+        :param location: Stout location name.
+        :type location: str
+        :return: Hash of the page the newest snapshot of the location was parsed from, None if it has no archived page.
+        :rtype: str
+        """
+        row = self.connection().execute('SELECT page FROM snapshots LEFT JOIN snapshot_pages USING (location, scraped) '
+                                        'WHERE location = ? ORDER BY scraped DESC LIMIT 1',
+                                        (location_key(location),)).fetchone()
+        return row[0] if row else None
+
+    def archived(self, location=None):
+        """
+        List the snapshots which have an archived page.
+
+        :param location: Only list snapshots of this location.
+        :type location: str
+        :return: List of (snapshot, location name, parsed, page hash) tuples, oldest first.
+        :rtype: list
+        """
+        query = 'SELECT id, snapshots.location, snapshots.scraped, blob, name, parsed, page FROM snapshots ' \
+                'JOIN snapshot_pages USING (location, scraped)'
+        params = ()
+        if location:
+            query += ' WHERE snapshots.location = ?'
+            params = (location_key(location),)
+        rows = self.connection().execute(query + ' ORDER BY snapshots.scraped', params).fetchall()
+        return [(Snapshot(*row[:4]), row[4], row[5], row[6]) for row in rows]
+
+    def load_page(self, page, decompress=True):
+        """
+        :param page: Page hash from archived.
+        :type page: str
+        :param decompress: Return the zlib compressed page if False.
+        :type decompress: bool
+        :return: Menu page HTML.
+        :rtype: str
+        """
+        row = self.connection().execute('SELECT data FROM pages WHERE hash = ?', (page,)).fetchone()
+        if not row:
+            raise CacheStoreException('Page {0} does not exist.'.format(page))
+        return zlib.decompress(row[0]) if decompress else str(row[0])
+
+    def _put_page(self, connection, snapshot, name, html):
+        page = hashlib.sha1(html).hexdigest()
+        # Another process may archive the same page between the check and the insert
+        if not connection.execute('SELECT 1 FROM pages WHERE hash = ?', (page,)).fetchone():
+            connection.execute('INSERT OR IGNORE INTO pages (hash, data) VALUES (?, ?)',
+                               (page, sqlite3.Binary(zlib.compress(html))))
+        connection.execute('INSERT OR REPLACE INTO snapshot_pages (location, scraped, name, page) '
+                           'VALUES (?, ?, ?, ?)', (snapshot.location, snapshot.scraped, name, page))
+
+    def _put_blob(self, connection, blob, text, location, scraped):
+        base = None
+        if self.deltas:
+            row = connection.execute('SELECT blobs.hash, blobs.depth FROM snapshots JOIN blobs ON blobs.hash = blob '
+                                     'WHERE location = ? AND scraped < ? ORDER BY scraped DESC LIMIT 1',
+                                     (location, scraped)).fetchone()
+            if row and row[1] < self.checkpoint_interval:
+                base, depth = row[0], row[1] + 1
+        if base:
+            data = json.dumps(_delta(self._blob_text(base, connection), text))
+        else:
+            data, depth = text, 0
+        connection.execute('INSERT OR IGNORE INTO blobs (hash, base, depth, data) VALUES (?, ?, ?, ?)',
+                           (blob, base, depth, sqlite3.Binary(zlib.compress(data))))
+
+    def _blob_text(self, blob, connection=None):
+        connection = connection or self.connection()
+        row = connection.execute('SELECT base, data FROM blobs WHERE hash = ?', (blob,)).fetchone()
+        if not row:
+            raise CacheStoreException('Blob {0} does not exist.'.format(blob))
+        data = zlib.decompress(row[1])
+        if row[0]:
+            return _apply_delta(self._blob_text(row[0], connection), json.loads(data))
+        return data
+
+    def stats(self):
+        """
+        :return: Number of snapshots and blobs, and the compressed size of the blobs in bytes.
+        :rtype: dict
+        """
+        connection = self.connection()
+        return {
+            'snapshots': connection.execute('SELECT COUNT(*) FROM snapshots').fetchone()[0],
+            'blobs': connection.execute('SELECT COUNT(*) FROM blobs').fetchone()[0],
+            'delta_blobs': connection.execute('SELECT COUNT(*) FROM blobs WHERE base IS NOT NULL').fetchone()[0],
+            'blob_bytes': connection.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM blobs').fetchone()[0]
+        }
+
+    def _upgrade(self, connection):
+        # Snapshots used to hold the menu JSON themselves, move them into blobs
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(snapshots)')]
+        if 'menu' in columns:
+            _log('Upgrading {0} to content addressed blobs'.format(self.path), logging.INFO)
+            connection.execute('ALTER TABLE snapshots RENAME TO snapshots_old')
+            connection.execute('DROP INDEX snapshots_location_scraped')
+            for statement in self.schema:
+                connection.execute(statement)
+            rows = connection.execute('SELECT location, scraped, menu FROM snapshots_old ORDER BY scraped').fetchall()
+            for location, scraped, menu in rows:
+                content = json.loads(menu)
+                parsed = content.pop('parsed', None)
+                text = _encode(content)
+                blob = hashlib.sha1(text).hexdigest()
+                if not connection.execute('SELECT 1 FROM blobs WHERE hash = ?', (blob,)).fetchone():
+                    self._put_blob(connection, blob, text, location, scraped)
+                connection.execute('INSERT INTO snapshots (location, scraped, parsed, blob) VALUES (?, ?, ?, ?)',
+                                   (location, scraped, parsed, blob))
+            connection.execute('DROP TABLE snapshots_old')
+
+    def load(self, snapshot):
+        """
+        Load the menu of a snapshot.
+
+        :param snapshot: Snapshot from one of the find methods.
+        :type snapshot: Snapshot
+        :return: Parsed menu.
+        :rtype: dict
+        """
+        row = self.connection().execute('SELECT parsed, blob FROM snapshots WHERE id = ?', (snapshot.id,)).fetchone()
+        if not row:
+            raise CacheStoreException('Snapshot {0} does not exist.'.format(snapshot.id))
+        menu = json.loads(self._blob_text(row[1]))
+        if row[0] is not None:
+            menu['parsed'] = row[0]
+        return menu
+
+    def find_near(self, location, time, lean='new'):
+        """
+        Find the snapshot nearest to a time.
+
+        :param location: Stout location name.
+        :type location: str
+        :param time: Time to search from.
+        :type time: datetime
+        :param lean: "new" for the first snapshot at or after time, "old" for the last snapshot at or before time. Falls
+        back to the newest/oldest snapshot if there is none in that direction.
+        :type lean: str
+        :return: Nearest snapshot, None if there are no snapshots for the location.
+        :rtype: Snapshot
+        """
+        if lean == 'new':
+            query = 'scraped >= ? ORDER BY scraped ASC'
+        else:
+            query = 'scraped <= ? ORDER BY scraped DESC'
+        snapshot = self._find_one(query, (location_key(location), time.strftime(date_format)))
+        if not snapshot:
+            return self.find_extreme(location, lean)
+        return snapshot
+
+    def find_extreme(self, location, extreme='new'):
+        """
+        Find the newest or oldest snapshot of a location.
+
+        :param location: Stout location name.
+        :type location: str
+        :param extreme: "new" for the newest snapshot, "old" for the oldest.
+        :type extreme: str
+        :return: Newest or oldest snapshot, None if there are no snapshots for the location.
+        :rtype: Snapshot
+        """
+        order = 'DESC' if extreme == 'new' else 'ASC'
+        return self._find_one('1 ORDER BY scraped ' + order, (location_key(location),))
+
+    def find_day(self, location, day):
+        """
+        Find the last snapshot scraped on a day.
+
+        :param location: Stout location name.
+        :type location: str
+        :param day: Day to find a snapshot for, the time is ignored.
+        :type day: datetime
+        :return: Last snapshot of the day, None if the location was not scraped that day.
+        :rtype: Snapshot
+        """
+        start = datetime(day.year, day.month, day.day)
+        end = start + timedelta(days=1)
+        return self._find_one('scraped >= ? AND scraped < ? ORDER BY scraped DESC',
+                              (location_key(location), start.strftime(date_format), end.strftime(date_format)))
+
+    def find_scraped(self, location, time):
+        """
+        Find the snapshot scraped at an exact time.
+
+        :param location: Stout location name.
+        :type location: str
+        :param time: Scrape time of the snapshot.
+        :type time: datetime
+        :return: Snapshot, None if the location was not cached at that time.
+        :rtype: Snapshot
+        """
+        return self._find_one('scraped = ?', (location_key(location), time.strftime(date_format)))
+
+    def find_previous(self, snapshot):
+        """
+        :return: Snapshot of the same location scraped before snapshot, None if it is the first.
+        :rtype: Snapshot
+        """
+        return self._find_one('scraped < ? ORDER BY scraped DESC', (snapshot.location, snapshot.scraped))
+
+    def find_next(self, snapshot):
+        """
+        :return: Snapshot of the same location scraped after snapshot, None if it is the last.
+        :rtype: Snapshot
+        """
+        return self._find_one('scraped > ? ORDER BY scraped ASC', (snapshot.location, snapshot.scraped))
+
+    def snapshots(self, location):
+        """
+        :return: All snapshots of a location, oldest first.
+        :rtype: list
+        """
+        rows = self.connection().execute('SELECT id, location, scraped, blob FROM snapshots WHERE location = ? '
+                                         'ORDER BY scraped', (location_key(location),))
+        return [Snapshot(*row) for row in rows]
+
+    def locations(self):
+        """
+        :return: Location keys which have at least one snapshot.
+        :rtype: list
+        """
+        return [row[0] for row in self.connection().execute('SELECT DISTINCT location FROM snapshots')]
+
+    def _find_one(self, query, params):
+        row = self.connection().execute('SELECT id, location, scraped, blob FROM snapshots WHERE location = ? AND ' +
+                                        query + ' LIMIT 1', params).fetchone()
+        return Snapshot(*row) if row else None
+
+
+def location_key(location):
+    """
+    Normalize a location name, "Studio City" and "studio_city" are the same location.
+    """
+    return location.replace(' ', '_').lower()
+
+
+def menu_name(location, scraped):
+    """
+    Name of the menu of a day, as used in the menu view URL, e.g. menu_2014-08-25_studio_city.
+
+    :param location: Location key.
+    :type location: str
+    :param scraped: Scraped column of a snapshot.
+    :type scraped: str
+    :rtype: str
+    """
+    return 'menu_{0}_{1}'.format(scraped[:10], location)
+
+
+def _encode(content):
+    # Canonical JSON, one value per line so deltas between menus stay small
+    return json.dumps(content, sort_keys=True, indent=1)
+
+
+def _delta(base, text):
+    """
+    Encode text as a list of line ranges copied from base and lists of new lines.
+    """
+    base_lines = base.splitlines(True)
+    lines = text.splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j1 != j2:
+            ops.append(lines[j1:j2])
+    return ops
+
+
+def _apply_delta(base, ops):
+    base_lines = base.splitlines(True)
+    lines = []
+    for op in ops:
+        if op and isinstance(op[0], int):
+            lines.extend(base_lines[op[0]:op[1]])
+        else:
+            lines.extend(op)
+    return ''.join(lines)
+
+
+def snapshot_time(scraped):
+    """
+    Scrape time of a snapshot as used in the URL of its menu view, e.g. 20140825T130507.123456.
+
+    :param scraped: Scraped column of a snapshot.
+    :type scraped: str
+    :rtype: str
+    """
+    return parse_scraped(scraped).strftime(url_time_format)
+
+
+def snapshot_etag(snapshot):
+    """
+    Strong ETag of the menu view of a snapshot. The view shows the menu and when it was scraped, so it is the content
+    hash and the scrape time, a later snapshot with the same menu gets a new ETag.
+
+    :type snapshot: Snapshot
+    :rtype: str
+    """
+    return '{0}-{1}'.format(snapshot.blob, snapshot_time(snapshot.scraped))
+
+
+def parse_scraped(scraped):
+    """
+    Convert the scraped column of a snapshot to a datetime.
+    """
+    return datetime.strptime(scraped, date_format)
+
+
+def migrate_cache_dir(store, cache_dir):
+    """
+    Import the menu_cache/YYYY/MM/menu_YYYY-MM-DD_location.json files written by earlier versions of the scraper.
+
+    :param store: Store to import into.
+    :type store: MenuCacheStore
+    :param cache_dir: Root of the old cache directory.
+    :type cache_dir: str
+    :return: Number of menus imported.
+    :rtype: int
+    """
+    regex = re.compile('^menu_([0-9]{4}-[0-9]{2}-[0-9]{2})_(.+)\.json$')
+    count = 0
+    for directory, _, filenames in sorted(os.walk(cache_dir)):
+        for filename in sorted(filenames):
+            matches = regex.match(filename)
+            if not matches:
+                continue
+            with open(os.path.join(directory, filename)) as fh:
+                menu = json.load(fh)
+            time = _menu_time(menu, matches.group(1))
+            store.put(matches.group(2), time, menu)
+            count += 1
+            _log('Imported {0}'.format(filename), logging.DEBUG)
+    return count
+
+
+def _menu_time(menu, day):
+    # Prefer the time the menu was parsed, fall back on the day in the file name
+    for date_format_ in (date_format, '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(menu.get('parsed', ''), date_format_)
+        except ValueError:
+            pass
+    return datetime.strptime(day, '%Y-%m-%d')
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Import menu JSON files from an old menu_cache directory.')
+    parser.add_argument('cache_dir', type=str, help='directory containing the YYYY/MM/*.json menu files')
+    parser.add_argument('database', type=str, help='SQLite file to import into')
+    parser.add_argument('--deltas', action='store_true', help='store menus as deltas against the previous menu')
+    parser.add_argument('--checkpoint', type=int, default=7, help='maximum number of deltas between full menus')
+    args = parser.parse_args()
+
+    store = MenuCacheStore(args.database, args.deltas, args.checkpoint)
+    imported = migrate_cache_dir(store, args.cache_dir)
+    _log('Imported {0} menus into {1}: {2}'.format(imported, args.database, store.stats()))
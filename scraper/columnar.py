@@ -0,0 +1,275 @@
+import argparse
+import json
+import logging
+import sys
+from array import array
+from collections import Counter, namedtuple
+
+from cache_store import MenuCacheStore
+from menu_diff import beverage_key
+from parse_menu import parse_abv, parse_price_cents, parse_size_ml
+
+root_log = logging.getLogger()
+
+# Menu of one snapshot, the rows of the beverage table in menu order
+ColumnarSnapshot = namedtuple('ColumnarSnapshot', ['location', 'scraped', 'beverages'])
+
+# Missing values of the numeric columns
+missing_number = float('nan')
+missing_cents = -1
+
+
+class StringPool(object):
+    """
+    Interned strings, each distinct string is kept once and referred to by an integer ID.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self._ids = {}
+
+    def intern(self, text):
+        """
+        :return: ID of the string, -1 for None.
+        :rtype: int
+        """
+        if text is None:
+            return -1
+        string_id = self._ids.get(text)
+        if string_id is None:
+            string_id = self._ids[text] = len(self.strings)
+            self.strings.append(text)
+        return string_id
+
+    def get(self, string_id):
+        return self.strings[string_id] if string_id >= 0 else None
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class MenuHistory(object):
+    """
+    Compact in-memory representation of many menus, for analytics over the whole history.
+
+    Every distinct beverage (title in a section) is a row of a table kept as typed arrays, one array per column.
+    Strings are interned in a shared pool, and ABV, price and size are stored as numbers. A snapshot is an array of
+    row IDs, snapshots sharing a blob in the store share one array. Diffs are set operations on the row IDs.
+    """
+
+    string_columns = ['section', 'name', 'key', 'brewery', 'style', 'location']
+
+    def __init__(self):
+        self.strings = StringPool()
+        self.columns = dict((column, array('i')) for column in self.string_columns)
+        self.columns['abv'] = array('d')
+        self.columns['price_cents'] = array('i')
+        self.columns['size_ml'] = array('d')
+        self.snapshots = []
+        self._rows = {}
+        self._blobs = {}
+
+    def __len__(self):
+        return len(self.columns['name'])
+
+    def add(self, location, scraped, menu, blob=None):
+        """
+        Add a menu to the history.
+
+        :param location: Location key.
+        :type location: str
+        :param scraped: Scrape time as stored in the cache store.
+        :type scraped: str
+        :param menu: Parsed menu.
+        :type menu: dict
+        :param blob: Hash of the menu blob, menus with the same blob share their row array.
+        :type blob: str
+        :return: Index of the snapshot.
+        :rtype: int
+        """
+        beverages = self._blobs.get(blob) if blob else None
+        if beverages is None:
+            beverages = array('i')
+            for section in menu['sections']:
+                section_id = self.strings.intern(section['name'])
+                for beverage in section['beverages']:
+                    beverages.append(self._row(section_id, beverage))
+            if blob:
+                self._blobs[blob] = beverages
+        self.snapshots.append(ColumnarSnapshot(self.strings.intern(location), scraped, beverages))
+        return len(self.snapshots) - 1
+
+    def _row(self, section_id, beverage):
+        name_id = self.strings.intern(beverage['name'])
+        row = self._rows.get((section_id, name_id))
+        if row is None:
+            row = self._rows[(section_id, name_id)] = len(self)
+            details = beverage.get('details') or {}
+            columns = self.columns
+            columns['section'].append(section_id)
+            columns['name'].append(name_id)
+            columns['key'].append(self.strings.intern(beverage_key(beverage)))
+            columns['brewery'].append(self.strings.intern(details.get('brewery') or details.get('winery')))
+            columns['style'].append(self.strings.intern(details.get('style')))
+            columns['location'].append(self.strings.intern(details.get('location')))
+            abv = _normalized(details, 'abv', 'alcohol_percentage', parse_abv)
+            columns['abv'].append(abv if abv is not None else missing_number)
+            price_cents = _normalized(details, 'price_cents', 'price', parse_price_cents)
+            columns['price_cents'].append(price_cents if price_cents is not None else missing_cents)
+            size_ml = _normalized(details, 'size_ml', 'size', parse_size_ml)
+            columns['size_ml'].append(size_ml if size_ml is not None else missing_number)
+        return row
+
+    def value(self, column, row):
+        """
+        :return: Value of a column of a row, strings are looked up in the pool and missing values are None.
+        """
+        value = self.columns[column][row]
+        if column in self.string_columns:
+            return self.strings.get(value)
+        if value != value or value == missing_cents and column == 'price_cents':
+            return None
+        return value
+
+    def diff(self, old, new):
+        """
+        Rows added and removed between two snapshots, the same beverages menu_diff.diff reports. A beverage listed more
+        than once in a section is one row, each copy beyond the number on the other menu is added or removed.
+
+        :param old: Index of the older snapshot.
+        :type old: int
+        :param new: Index of the newer snapshot.
+        :type new: int
+        :return: Added and removed row IDs in menu order.
+        :rtype: tuple
+        """
+        old_rows = self.snapshots[old].beverages
+        new_rows = self.snapshots[new].beverages
+        if old_rows is new_rows:
+            return array('i'), array('i')
+        return _missing(new_rows, old_rows), _missing(old_rows, new_rows)
+
+    def mean(self, column, snapshot):
+        """
+        :return: Mean of a numeric column over the beverages of a snapshot which have a value, None if none do.
+        :rtype: float
+        """
+        values = self.columns[column]
+        present = [values[row] for row in self.snapshots[snapshot].beverages
+                   if values[row] == values[row] and values[row] != missing_cents]
+        return sum(present) / float(len(present)) if present else None
+
+    def count_by(self, column, snapshot):
+        """
+        :return: Number of beverages of a snapshot per value of a string column.
+        :rtype: dict
+        """
+        values = self.columns[column]
+        counts = {}
+        for row in self.snapshots[snapshot].beverages:
+            counts[values[row]] = counts.get(values[row], 0) + 1
+        return dict((self.strings.get(value), count) for value, count in counts.iteritems())
+
+    def memory(self):
+        """
+        :return: Approximate number of bytes used by the history: the columns, the snapshots and their row arrays, the
+        interned strings and the indexes of rows, strings and blobs.
+        :rtype: int
+        """
+        return deep_size((self.strings.strings, self.strings._ids, self.columns, self.snapshots, self._rows,
+                          self._blobs)) - sys.getsizeof(())
+
+    def has_blob(self, blob):
+        """
+        :return: Whether a menu with this blob was already added, it can then be added again without loading it.
+        :rtype: bool
+        """
+        return blob in self._blobs
+
+
+def deep_size(obj, seen=None):
+    """
+    Approximate number of bytes used by nested dicts, lists, tuples, arrays and strings, counting shared objects once.
+    """
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def load_history(store, locations=None):
+    """
+    Load the cached menus of locations into a MenuHistory, each distinct blob is only loaded once.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param locations: Locations to load, all locations by default.
+    :type locations: list
+    :rtype: MenuHistory
+    """
+    history = MenuHistory()
+    for location in locations or store.locations():
+        for snapshot in store.snapshots(location):
+            if history.has_blob(snapshot.blob):
+                history.add(snapshot.location, snapshot.scraped, None, snapshot.blob)
+            else:
+                history.add(snapshot.location, snapshot.scraped, store.load(snapshot), snapshot.blob)
+    return history
+
+
+def _normalized(details, field, raw_field, parse):
+    # Menus cached before the numeric fields were added at ingest only have the raw text
+    if field in details:
+        return details[field]
+    return parse(details[raw_field]) if details.get(raw_field) else None
+
+
+def _missing(rows, other_rows):
+    """
+    :return: Rows which are not on the other menu, the first copies of a row are paired with the other menu's copies.
+    :rtype: array
+    """
+    unpaired = Counter(other_rows)
+    missing = array('i')
+    for row in rows:
+        if unpaired[row]:
+            unpaired[row] -= 1
+        else:
+            missing.append(row)
+    return missing
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Load the cached menu history into memory and summarize it.')
+    parser.add_argument('database', type=str, help='menu cache SQLite file')
+    parser.add_argument('--location', type=str, action='append', help='only load this location, may be repeated')
+    args = parser.parse_args()
+
+    menus = load_history(MenuCacheStore(args.database), args.location)
+    _log('Loaded {0} snapshots with {1} distinct beverages and {2} strings in {3} bytes'
+         .format(len(menus.snapshots), len(menus), len(menus.strings), menus.memory()))
+    if menus.snapshots:
+        latest = len(menus.snapshots) - 1
+        print json.dumps({
+            'sections': menus.count_by('section', latest),
+            'average_abv': menus.mean('abv', latest),
+            'average_price_cents': menus.mean('price_cents', latest)
+        }, indent=2)
@@ -0,0 +1,269 @@
+import argparse
+import json
+import logging
+import sys
+from collections import OrderedDict
+from time import time as now
+
+import metrics
+from cache_store import MenuCacheStore, date_format, location_key, parse_scraped
+from menu_diff import diff
+
+root_log = logging.getLogger()
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS menu_deltas (
+        location TEXT NOT NULL,
+        scraped TEXT NOT NULL,
+        previous TEXT,
+        changes TEXT NOT NULL,
+        PRIMARY KEY (location, scraped)
+    )''',
+]
+
+# Lists of a diff which are stored in the chain and composed over a range
+change_lists = ['added', 'removed', 'added_sections', 'removed_sections', 'modified']
+
+compose_seconds = metrics.timer('diff_compose_seconds', 'Time to compose the stored changes over a date range')
+
+
+def record(store, snapshot):
+    """
+    Diff a newly cached snapshot against the previous snapshot of its location and store the changes.
+
+    The following snapshot is recomputed as well, so snapshots cached out of order keep the chain correct.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param snapshot: Snapshot which was just cached.
+    :type snapshot: cache_store.Snapshot
+    :return: Diff against the previous snapshot, None if it is the first snapshot of the location.
+    :rtype: dict
+    """
+    menu = store.load(snapshot)
+    previous = store.find_previous(snapshot)
+    _diff = _record(store, snapshot, menu, previous, store.load(previous) if previous else None)
+    following = store.find_next(snapshot)
+    if following:
+        _record(store, following, store.load(following), snapshot, menu)
+    return _diff
+
+
+def rebuild(store, location):
+    """
+    Recompute the whole chain of a location, loading each snapshot once.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param location: Stout location name.
+    :type location: str
+    :return: Number of snapshots in the chain.
+    :rtype: int
+    """
+    connection = store.ensure_schema(schema)
+    with connection:
+        connection.execute('DELETE FROM menu_deltas WHERE location = ?', (location_key(location),))
+    previous = previous_menu = None
+    count = 0
+    for snapshot in store.snapshots(location):
+        menu = store.load(snapshot)
+        _record(store, snapshot, menu, previous, previous_menu)
+        previous, previous_menu = snapshot, menu
+        count += 1
+    return count
+
+
+def _record(store, snapshot, menu, previous, previous_menu):
+    if previous:
+        _diff = diff(previous_menu, menu, fields=True)
+        changes = dict((key, _diff[key]) for key in change_lists)
+    else:
+        _diff = None
+        changes = dict((key, []) for key in change_lists)
+    connection = store.ensure_schema(schema)
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO menu_deltas (location, scraped, previous, changes) '
+                           'VALUES (?, ?, ?, ?)',
+                           (snapshot.location, snapshot.scraped, previous.scraped if previous else None,
+                            json.dumps(changes)))
+    return _diff
+
+
+def compose(store, start, end):
+    """
+    Compose the stored changes between two snapshots of a location.
+
+    Unlike diffing the two menus this also finds beverages which were added and removed again inside the range.
+    Beverages are matched by menu_diff.beverage_key, the changes of a beverage modified several times are merged into
+    the first before and last after value of each field.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param start: Snapshot to start from.
+    :type start: cache_store.Snapshot
+    :param end: Last snapshot of the range.
+    :type end: cache_store.Snapshot
+    :return: Diff with the same keys as menu_diff.diff with fields, plus transient, the beverages which came and went.
+    Each transient entry has the time it was added and removed.
+    :rtype: dict
+    """
+    started = now()
+    connection = store.ensure_schema(schema)
+    rows = connection.execute('SELECT scraped, changes FROM menu_deltas WHERE location = ? AND scraped > ? '
+                              'AND scraped <= ? ORDER BY scraped', (start.location, start.scraped, end.scraped))
+    # First and last change of each beverage, a beverage added and then removed is transient
+    beverages = OrderedDict()
+    sections = OrderedDict()
+    modified = OrderedDict()
+    for scraped, changes in rows:
+        changes = json.loads(changes)
+        for change in ('added', 'removed'):
+            for item in changes[change]:
+                _fold(beverages, (item['section'], item.get('key') or item['beverage']), change, scraped,
+                      item['beverage'])
+            for section in changes[change + '_sections']:
+                _fold(sections, section, change, scraped)
+        # Chains recorded before modified beverages were detected have no modified list
+        for item in changes.get('modified', []):
+            _merge_modified(modified, item)
+
+    _diff = {
+        'old_date': parse_scraped(start.scraped),
+        'new_date': parse_scraped(end.scraped),
+        'added': [],
+        'removed': [],
+        'added_sections': [],
+        'removed_sections': [],
+        'modified': [],
+        'transient': []
+    }
+    for (section, key), (first, last, added, removed, beverage) in beverages.iteritems():
+        if first == last:
+            _diff[first].append({'section': section, 'beverage': beverage, 'key': key})
+        elif first == 'added':
+            _diff['transient'].append({'section': section, 'beverage': beverage, 'key': key,
+                                       'added': parse_scraped(added), 'removed': parse_scraped(removed)})
+    for section, (first, last, _, _, _) in sections.iteritems():
+        if first == last:
+            _diff[first + '_sections'].append(section)
+    for key, item in modified.iteritems():
+        # Only beverages on the menu at both ends of the range, otherwise they are added, removed or transient
+        entry = beverages.get(key)
+        if entry and (entry[0], entry[1]) != ('removed', 'added'):
+            continue
+        changes = dict((field, change) for field, change in item['changes'].iteritems()
+                       if change['before'] != change['after'])
+        if changes:
+            _diff['modified'].append(dict(item, changes=changes))
+    compose_seconds.observe(now() - started)
+    return _diff
+
+
+def iter_changes(store, location, start=None, end=None):
+    """
+    Iterate over the stored changes of a location without loading them all at once.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param location: Stout location name.
+    :type location: str
+    :param start: Only changes of snapshots scraped at or after this time.
+    :type start: datetime
+    :param end: Only changes of snapshots scraped before this time.
+    :type end: datetime
+    :return: Generator of dicts with the scraped and previous times of the snapshot and its change lists, oldest first.
+    :rtype: generator
+    """
+    query = 'SELECT scraped, previous, changes FROM menu_deltas WHERE location = ?'
+    params = [location_key(location)]
+    if start:
+        query += ' AND scraped >= ?'
+        params.append(start.strftime(date_format))
+    if end:
+        query += ' AND scraped < ?'
+        params.append(end.strftime(date_format))
+    for scraped, previous, changes in store.ensure_schema(schema).execute(query + ' ORDER BY scraped', params):
+        entry = {'scraped': parse_scraped(scraped), 'previous': parse_scraped(previous) if previous else None}
+        entry.update(json.loads(changes))
+        yield entry
+
+
+def field_timeline(store, location, field='price'):
+    """
+    Every change of a field of the beverages of a location, e.g. price increases, from the stored chain.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param location: Stout location name.
+    :type location: str
+    :param field: Details field.
+    :type field: str
+    :return: Time, section, beverage and the before and after values of each change, oldest first.
+    :rtype: list
+    """
+    connection = store.ensure_schema(schema)
+    rows = connection.execute('SELECT scraped, changes FROM menu_deltas WHERE location = ? ORDER BY scraped',
+                              (location_key(location),))
+    timeline = []
+    for scraped, changes in rows:
+        for item in json.loads(changes).get('modified', []):
+            if field in item['changes']:
+                timeline.append({
+                    'scraped': parse_scraped(scraped),
+                    'section': item['section'],
+                    'beverage': item['beverage'],
+                    'before': item['changes'][field]['before'],
+                    'after': item['changes'][field]['after']
+                })
+    return timeline
+
+
+def _fold(state, key, change, scraped, name=None):
+    # [first change, last change, first time added, last time removed, latest name]
+    entry = state.get(key)
+    if entry is None:
+        entry = state[key] = [change, change, None, None, name]
+    entry[1] = change
+    entry[4] = name
+    if change == 'added' and entry[2] is None:
+        entry[2] = scraped
+    elif change == 'removed':
+        entry[3] = scraped
+
+
+def _merge_modified(state, item):
+    # Keep the first before and the latest after of each field
+    key = (item['section'], item['key'])
+    entry = state.get(key)
+    if entry is None:
+        entry = state[key] = {'section': item['section'], 'beverage': item['beverage'], 'key': item['key'],
+                              'previous': item['previous'], 'changes': {}}
+    entry['beverage'] = item['beverage']
+    for field, change in item['changes'].iteritems():
+        if field in entry['changes']:
+            entry['changes'][field] = {'before': entry['changes'][field]['before'], 'after': change['after']}
+        else:
+            entry['changes'][field] = change
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Rebuild the chain of menu changes from the cached menus.')
+    parser.add_argument('database', type=str, help='menu cache SQLite file')
+    parser.add_argument('--location', type=str, action='append', help='only rebuild this location, may be repeated')
+    args = parser.parse_args()
+
+    cache = MenuCacheStore(args.database)
+    for loc in args.location or cache.locations():
+        _log('Rebuilt {0} changes for {1}'.format(rebuild(cache, loc), loc))
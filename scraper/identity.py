@@ -0,0 +1,180 @@
+import argparse
+import json
+import logging
+import math
+import sys
+import threading
+
+from cache_store import MenuCacheStore
+from menu_diff import tokenize
+
+root_log = logging.getLogger()
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS identities (
+        id INTEGER PRIMARY KEY,
+        type TEXT NOT NULL,
+        name TEXT NOT NULL,
+        name_tokens TEXT NOT NULL,
+        tokens TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS identity_aliases (
+        alias TEXT PRIMARY KEY,
+        identity INTEGER NOT NULL REFERENCES identities (id)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS identity_blocks (
+        token TEXT NOT NULL,
+        identity INTEGER NOT NULL REFERENCES identities (id),
+        PRIMARY KEY (token, identity)
+    )''',
+]
+
+# Minimum Jaccard similarity of the name tokens, and of all tokens, for a title to match an existing beverage
+name_threshold = 0.8
+token_threshold = 0.6
+
+# Details fields whose tokens identify a beverage besides its name, brewery and location are sometimes swapped
+identifying_fields = ['brewery', 'winery', 'location', 'style']
+
+# Resolving reads then writes, scraper threads resolve one menu at a time
+_lock = threading.Lock()
+
+
+def resolve(store, menu):
+    """
+    Give every beverage of a menu the ID of the canonical beverage it is a variant of, and drop beverages listed twice
+    within a section with the same title and details. Beverages sharing an ID are kept, they are the same beverage in
+    another size or serving.
+
+    A title seen before is found by its alias, the sorted tokens of its name and identifying details. A new title is
+    only compared against the beverages which share one of its least common name tokens (the blocking index), and
+    matches the most similar one above name_threshold and token_threshold. Otherwise it becomes a new canonical
+    beverage. Matching is near linear in the number of titles rather than comparing every pair.
+
+    :param store: Menu cache store the identities are kept in.
+    :type store: cache_store.MenuCacheStore
+    :param menu: Parsed menu, updated in place.
+    :type menu: dict
+    :return: Number of duplicate beverages dropped.
+    :rtype: int
+    """
+    dropped = 0
+    with _lock:
+        connection = store.ensure_schema(schema)
+        with connection:
+            for section in menu['sections']:
+                _type = section.get('type', 'beer')
+                seen = set()
+                beverages = []
+                for beverage in section['beverages']:
+                    beverage['id'] = _resolve(connection, _type, beverage)
+                    listing = (beverage['name'], json.dumps(beverage.get('details'), sort_keys=True))
+                    if listing in seen:
+                        _log('Dropped duplicate "{0}" in section "{1}"'.format(beverage['name'], section['name']),
+                             logging.DEBUG)
+                        dropped += 1
+                        continue
+                    seen.add(listing)
+                    beverages.append(beverage)
+                section['beverages'] = beverages
+    return dropped
+
+
+def canonical(store, identity_id):
+    """
+    :return: Canonical name and the aliases of a beverage, None if there is no such beverage.
+    :rtype: dict
+    """
+    connection = store.ensure_schema(schema)
+    row = connection.execute('SELECT type, name FROM identities WHERE id = ?', (identity_id,)).fetchone()
+    if not row:
+        return None
+    aliases = [alias for (alias,) in connection.execute('SELECT alias FROM identity_aliases WHERE identity = ? '
+                                                        'ORDER BY alias', (identity_id,))]
+    return {'id': identity_id, 'type': row[0], 'name': row[1], 'aliases': aliases}
+
+
+def beverage_tokens(beverage):
+    """
+    :return: Name tokens, and the sorted tokens of the name and identifying details.
+    :rtype: tuple
+    """
+    details = beverage.get('details') or {}
+    name_tokens = tokenize(details.get('name') or beverage['name'])
+    tokens = set(name_tokens)
+    for field in identifying_fields:
+        if details.get(field):
+            tokens.update(tokenize(details[field]))
+    return name_tokens, sorted(tokens)
+
+
+def jaccard(a, b):
+    a = set(a)
+    b = set(b)
+    return len(a & b) / float(len(a | b)) if a or b else 1.0
+
+
+def _resolve(connection, _type, beverage):
+    name_tokens, tokens = beverage_tokens(beverage)
+    alias = '{0}|{1}|{2}'.format(_type, ' '.join(name_tokens), ' '.join(tokens))
+    row = connection.execute('SELECT identity FROM identity_aliases WHERE alias = ?', (alias,)).fetchone()
+    if row:
+        return row[0]
+
+    identity_id = _match(connection, _type, name_tokens, tokens)
+    if identity_id is None:
+        identity_id = connection.execute('INSERT INTO identities (type, name, name_tokens, tokens) VALUES (?, ?, ?, ?)',
+                                         (_type, beverage['name'], json.dumps(name_tokens),
+                                          json.dumps(tokens))).lastrowid
+        connection.executemany('INSERT OR IGNORE INTO identity_blocks (token, identity) VALUES (?, ?)',
+                               [(token, identity_id) for token in set(name_tokens)])
+    connection.execute('INSERT OR IGNORE INTO identity_aliases (alias, identity) VALUES (?, ?)', (alias, identity_id))
+    return identity_id
+
+
+def _match(connection, _type, name_tokens, tokens):
+    unique_tokens = list(set(name_tokens))
+    if not unique_tokens:
+        return None
+    # Prefix filter: a name with Jaccard similarity of at least name_threshold shares at least one of the least common
+    # len - ceil(threshold * len) + 1 name tokens, only beverages indexed under those are compared
+    counts = dict(connection.execute('SELECT token, COUNT(*) FROM identity_blocks WHERE token IN (' +
+                                     ', '.join('?' * len(unique_tokens)) + ') GROUP BY token', unique_tokens))
+    unique_tokens.sort(key=lambda token: counts.get(token, 0))
+    prefix = unique_tokens[:len(unique_tokens) - int(math.ceil(name_threshold * len(unique_tokens))) + 1]
+    prefix = [token for token in prefix if token in counts]
+    if not prefix:
+        return None
+    best = None
+    best_score = 0
+    rows = connection.execute('SELECT DISTINCT id, name_tokens, tokens FROM identity_blocks '
+                              'JOIN identities ON id = identity WHERE token IN (' + ', '.join('?' * len(prefix)) +
+                              ') AND type = ? ORDER BY id', prefix + [_type])
+    for identity_id, candidate_name_tokens, candidate_tokens in rows:
+        if jaccard(name_tokens, json.loads(candidate_name_tokens)) < name_threshold:
+            continue
+        score = jaccard(tokens, json.loads(candidate_tokens))
+        if score >= token_threshold and score > best_score:
+            best, best_score = identity_id, score
+    return best
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Show a canonical beverage and the titles resolved to it.')
+    parser.add_argument('database', type=str, help='menu cache SQLite file')
+    parser.add_argument('id', type=int, help='canonical beverage ID')
+    args = parser.parse_args()
+
+    print json.dumps(canonical(MenuCacheStore(args.database), args.id), indent=2)
@@ -0,0 +1,153 @@
+import argparse
+import json
+import logging
+import sys
+
+from cache_store import MenuCacheStore, date_format, location_key, menu_name, parse_scraped, snapshot_time
+from parse_menu import section_type
+
+root_log = logging.getLogger()
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS manifest (
+        location TEXT NOT NULL,
+        scraped TEXT NOT NULL,
+        beverages INTEGER NOT NULL,
+        sections TEXT NOT NULL,
+        PRIMARY KEY (location, scraped)
+    )''',
+    'CREATE INDEX IF NOT EXISTS manifest_scraped ON manifest (scraped, location)',
+]
+
+
+class ManifestException(Exception):
+    pass
+
+
+def record(store, snapshot, menu):
+    """
+    Add a newly cached snapshot to the manifest, replacing the entry of a snapshot scraped at the same time.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param snapshot: Snapshot of the menu.
+    :type snapshot: cache_store.Snapshot
+    :param menu: Parsed menu.
+    :type menu: dict
+    """
+    sections = [{'name': section['name'], 'type': section_type(section['name']),
+                 'beverages': len(section['beverages'])} for section in menu['sections']]
+    with store.ensure_schema(schema) as connection:
+        connection.execute('INSERT OR REPLACE INTO manifest (location, scraped, beverages, sections) '
+                           'VALUES (?, ?, ?, ?)',
+                           (snapshot.location, snapshot.scraped, sum(s['beverages'] for s in sections),
+                            json.dumps(sections)))
+
+
+def rebuild(store, location=None):
+    """
+    Recompute the manifest from the cached menus.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param location: Only rebuild this location.
+    :type location: str
+    :return: Number of snapshots recorded.
+    :rtype: int
+    """
+    connection = store.ensure_schema(schema)
+    with connection:
+        if location:
+            connection.execute('DELETE FROM manifest WHERE location = ?', (location_key(location),))
+        else:
+            connection.execute('DELETE FROM manifest')
+    count = 0
+    for _location in [location] if location else store.locations():
+        for snapshot in store.snapshots(_location):
+            record(store, snapshot, store.load(snapshot))
+            count += 1
+    return count
+
+
+def page(store, location=None, start=None, end=None, after=None, limit=50):
+    """
+    List snapshots newest first, a page at a time.
+
+    Pages are found by key rather than offset, so every page is a single indexed range scan no matter how deep.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param location: Only list this location.
+    :type location: str
+    :param start: Only list snapshots scraped at or after this time.
+    :type start: datetime
+    :param end: Only list snapshots scraped before this time.
+    :type end: datetime
+    :param after: Cursor returned with the previous page.
+    :type after: str
+    :param limit: Number of snapshots per page.
+    :type limit: int
+    :return: Entries with location, scraped, time (for the snapshot's menu view), name (for the menu view of the day),
+    beverages and sections, and the cursor of the next page, None on the last page.
+    :rtype: tuple
+    """
+    where = []
+    params = []
+    if location:
+        where.append('location = ?')
+        params.append(location_key(location))
+    if start:
+        where.append('scraped >= ?')
+        params.append(start.strftime(date_format))
+    if end:
+        where.append('scraped < ?')
+        params.append(end.strftime(date_format))
+    if after:
+        scraped, _, _location = after.partition('|')
+        if not _location:
+            raise ManifestException('Invalid cursor "{0}".'.format(after))
+        where.append('(scraped < ? OR scraped = ? AND location < ?)')
+        params.extend((scraped, scraped, _location))
+    query = 'SELECT location, scraped, beverages, sections FROM manifest'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += ' ORDER BY scraped DESC, location DESC LIMIT ?'
+    # Fetch one more than the page to know whether there is a next page
+    params.append(limit + 1)
+
+    rows = store.ensure_schema(schema).execute(query, params).fetchall()
+    entries = []
+    for _location, scraped, beverages, sections in rows[:limit]:
+        entries.append({
+            'location': _location,
+            'scraped': parse_scraped(scraped),
+            'time': snapshot_time(scraped),
+            'name': menu_name(_location, scraped),
+            'beverages': beverages,
+            'sections': json.loads(sections)
+        })
+    cursor = None
+    if len(rows) > limit:
+        cursor = '{0}|{1}'.format(rows[limit - 1][1], rows[limit - 1][0])
+    return entries, cursor
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Rebuild the manifest of cached menus.')
+    parser.add_argument('database', type=str, help='menu cache SQLite file')
+    parser.add_argument('--location', type=str, help='only rebuild this location')
+    args = parser.parse_args()
+
+    _log('Recorded {0} snapshots'.format(rebuild(MenuCacheStore(args.database), args.location)))
@@ -11,49 +11,239 @@ from unidecode import unidecode
 
 import sys
 
+import metrics
+
 root_log = logging.getLogger()
-root_log.setLevel(logging.WARN)
+
+diff_seconds = metrics.timer('diff_seconds', 'Time to diff two menus')
+
+token_regex = re.compile('[a-z0-9]+')
 
 
 class DiffException(Exception):
     pass
 
 
-def diff(original, modified):
+def diff(original, modified, fields=False):
+    """
+    Compute the beverages added and removed between two parsed menus.
+
+    Sections and beverages are matched by name. Each menu is indexed once so the diff runs in time linear to the
+    size of the menus. Beverages listed more than once in a section under the same key are paired one to one, see
+    _pair. Sections that only exist in one of the menus are listed in added_sections/removed_sections and all of
+    their beverages are reported as added/removed.
+
+    With fields, beverages are matched by beverage_key instead, so a beverage whose price or size changed is the same
+    beverage. Matched beverages whose details differ are listed in modified with the before/after of each field.
+
+    :param original: Older menu generated by parse_menu.
+    :type original: dict
+    :param modified: Newer menu generated by parse_menu.
+    :type modified: dict
+    :param fields: Match beverages by key and report modified beverages.
+    :type fields: bool
+    :return: Diff of the two menus.
+    :rtype: dict
+    """
     _diff = {
-        'old_date': datetime.strptime(original['parsed'], '%Y-%m-%d %H:%M:%S.%f'),
-        'new_date': datetime.strptime(modified['parsed'], '%Y-%m-%d %H:%M:%S.%f'),
+        'old_date': _parse_date(original['parsed']),
+        'new_date': _parse_date(modified['parsed']),
         'added': [],
-        'removed': []
+        'removed': [],
+        'added_sections': [],
+        'removed_sections': []
     }
 
-    for section in modified['sections']:
-        o_section = None
-        for s in original['sections']:
-            if s['name'] == section['name']:
-                o_section = s
+    with diff_seconds.time():
+        key = beverage_key if fields else _beverage_name
+        original_index = _index_menu(original, key)
+        modified_index = _index_menu(modified, key)
+        originals = _pair_menus(original_index, modified_index)
+        matched = set(id(beverage) for beverage in originals.itervalues())
+
+        _diff['added'], _diff['added_sections'] = _missing(modified, original_index, originals, key, fields)
+        _diff['removed'], _diff['removed_sections'] = _missing(original, modified_index, matched, key, fields)
+        if fields:
+            _diff['modified'] = _modified(modified, originals)
+
+    return _diff
+
+
+def beverage_key(beverage):
+    """
+    Key identifying a beverage across menus. The canonical beverage ID when it was resolved by identity, so variants of
+    a title are the same beverage. Otherwise the normalized parsed name and brewery when available, so a change in
+    price or size is still the same beverage, otherwise the normalized title.
+
+    :param beverage: Beverage from a menu generated by parse_menu.
+    :type beverage: dict
+    :rtype: str
+    """
+    if beverage.get('id') is not None:
+        return 'id {0}'.format(beverage['id'])
+    details = beverage.get('details')
+    if details and details.get('name'):
+        return ' '.join(tokenize(details['name']) + ['-'] +
+                        tokenize(details.get('brewery') or details.get('winery') or ''))
+    return ' '.join(tokenize(beverage['name']))
+
+
+def tokenize(text):
+    """
+    :return: Lowercase words and numbers in text.
+    :rtype: list
+    """
+    return token_regex.findall(unicode(text).lower())
+
+
+def _beverage_name(beverage):
+    return beverage['name']
+
+
+def _index_menu(menu, key):
+    """
+    Index a menu by section name to the beverages in that section by key.
+
+    :param menu: Menu generated by parse_menu.
+    :type menu: dict
+    :param key: Function returning the key of a beverage.
+    :type key: callable
+    :return: Lists of beverages by key, in menu order, keyed by section name.
+    :rtype: dict
+    """
+    index = {}
+    for section in menu['sections']:
+        beverages = index.setdefault(section['name'], {})
         for beverage in section['beverages']:
-            o_beverage = None
-            for b in o_section['beverages']:
-                if b['name'] == beverage['name']:
-                    o_beverage = b
-            if not o_beverage:
-                _diff['added'].append({'section': section['name'], 'beverage': beverage['name']})
-
-    for section in original['sections']:
-        m_section = None
-        for s in modified['sections']:
-            if s['name'] == section['name']:
-                m_section = s
+            beverages.setdefault(key(beverage), []).append(beverage)
+    return index
+
+
+def _pair_menus(original_index, modified_index):
+    """
+    Pair the beverages of two menus which share a section and key.
+
+    :return: Original beverage paired with each modified beverage, by id() of the modified beverage.
+    :rtype: dict
+    """
+    originals = {}
+    for section_name, modified_beverages in modified_index.iteritems():
+        original_beverages = original_index.get(section_name, {})
+        for _key, beverages in modified_beverages.iteritems():
+            for original, beverage in _pair(original_beverages.get(_key, []), beverages):
+                originals[id(beverage)] = original
+    return originals
+
+
+def _pair(originals, beverages):
+    """
+    Pair beverages sharing a key, e.g. the same beer in two sizes. Identical beverages are paired first, then those of
+    the same serving, then whatever is left in menu order, so a single beverage whose size changed is still paired.
+
+    :return: List of (original, modified) beverages.
+    :rtype: list
+    """
+    if len(originals) <= 1 or len(beverages) <= 1:
+        return zip(originals, beverages)
+    pairs = []
+    originals = list(originals)
+    for match in (_details, _serving):
+        unpaired = []
+        for beverage in beverages:
+            for i, original in enumerate(originals):
+                if match(original) == match(beverage):
+                    pairs.append((originals.pop(i), beverage))
+                    break
+            else:
+                unpaired.append(beverage)
+        beverages = unpaired
+    return pairs + zip(originals, beverages)
+
+
+def _details(beverage):
+    return beverage['name'], beverage.get('details')
+
+
+def _serving(beverage):
+    details = beverage.get('details') or {}
+    return details.get('size_ml', details.get('size')), details.get('nitro')
+
+
+def _missing(menu, other_index, paired, key, with_key=False):
+    """
+    Find the beverages and sections of menu which are not in the other menu.
+
+    :param menu: Menu generated by parse_menu.
+    :type menu: dict
+    :param other_index: Index of the menu to compare against, from _index_menu.
+    :type other_index: dict
+    :param paired: id() of the beverages of menu which were paired with a beverage of the other menu.
+    :type paired: set|dict
+    :param key: Function returning the key of a beverage, the same used to build other_index.
+    :type key: callable
+    :param with_key: Include the key of each missing beverage.
+    :type with_key: bool
+    :return: List of missing beverages and list of missing section names.
+    :rtype: tuple
+    """
+    beverages = []
+    sections = []
+    for section in menu['sections']:
+        if section['name'] not in other_index and section['name'] not in sections:
+            sections.append(section['name'])
         for beverage in section['beverages']:
-            m_beverage = None
-            for b in m_section['beverages']:
-                if b['name'] == beverage['name']:
-                    m_beverage = b
-            if not m_beverage:
-                _diff['removed'].append({'section': section['name'], 'beverage': beverage['name']})
+            if id(beverage) not in paired:
+                missing = {'section': section['name'], 'beverage': beverage['name']}
+                if with_key:
+                    missing['key'] = key(beverage)
+                beverages.append(missing)
+    return beverages, sections
 
-    return _diff
+
+def _modified(menu, originals):
+    """
+    Find the beverages of menu whose details differ from the beverage they were paired with in the original menu.
+
+    :param originals: Original beverage of each paired beverage of menu, from _pair_menus.
+    :type originals: dict
+    :return: List of modified beverages with the changes of each field.
+    :rtype: list
+    """
+    modified = []
+    for section in menu['sections']:
+        for beverage in section['beverages']:
+            original = originals.get(id(beverage))
+            if original is None:
+                continue
+            before = original.get('details') or {}
+            after = beverage.get('details') or {}
+            changes = {}
+            for field in set(before) | set(after):
+                if before.get(field) != after.get(field):
+                    changes[field] = {'before': before.get(field), 'after': after.get(field)}
+            if changes:
+                modified.append({'section': section['name'], 'beverage': beverage['name'],
+                                 'key': beverage_key(beverage), 'previous': original['name'], 'changes': changes})
+    return modified
+
+
+def json_default(obj):
+    """
+    json.dumps default for the datetimes of a diff, e.g. json.dumps(diff(a, b), default=json_default).
+
+    :return: ISO 8601 string of a datetime.
+    :rtype: str
+    """
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+
+def _parse_date(date):
+    # str(datetime) drops the microseconds when they are 0
+    if '.' in date:
+        return datetime.strptime(date, '%Y-%m-%d %H:%M:%S.%f')
+    return datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
 
 
 def _log(message, level=logging.INFO):
@@ -66,12 +256,14 @@ if __name__ == '__main__':
     sh.setLevel(logging.INFO)
     sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     root_log.addHandler(sh)
+    root_log.setLevel(logging.WARN)
 
     # Command line arguments
     parser = argparse.ArgumentParser(description='Create a diff from two menu parsed by parse_menu.py.')
     parser.add_argument('original', type=str, help='file path to original menu')
     parser.add_argument('modified', type=str, help='file path to modified menu')
     parser.add_argument('--pretty', action='store_true', help='pretty print JSON output')
+    parser.add_argument('--fields', action='store_true', help='match beverages by name and brewery, report modified')
     args = parser.parse_args()
 
     # Get file contents
@@ -87,10 +279,10 @@ if __name__ == '__main__':
         raise DiffException('Unable to open file "{0}".'.format(args.modified))
 
     # Create diff of menus
-    menu_diff = diff(original_json, modified_json)
+    menu_diff = diff(original_json, modified_json, args.fields)
 
     # Output diff as JSON
     if args.pretty:
-        print json.dumps(menu_diff, indent=2)
+        print json.dumps(menu_diff, indent=2, default=json_default)
     else:
-        print json.dumps(menu_diff)
+        print json.dumps(menu_diff, default=json_default)
@@ -0,0 +1,451 @@
+import argparse
+import cProfile
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time as now
+
+root_log = logging.getLogger()
+
+# Upper bounds in seconds of the timer buckets, from a cached page view to a slow menu download
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Stats file of the run being profiled, set by profiled. Pool processes forked during the run profile their tasks to
+# it suffixed with their pid.
+profile_path = None
+_task_profile = None
+
+
+class MetricsException(Exception):
+    pass
+
+
+class Counter(object):
+    """
+    Count of events by label values, e.g. beverages parsed by section type.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, description):
+        """
+        :param name: Metric name, in Prometheus style e.g. scrape_fetch_bytes_total.
+        :type name: str
+        :param description: What is counted.
+        :type description: str
+        """
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def options(self):
+        return {}
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def total(self):
+        """
+        :return: Sum of every series.
+        :rtype: int
+        """
+        with self._lock:
+            return sum(self._values.itervalues())
+
+    def series(self):
+        """
+        :return: Label values and value of every series, JSON serializable.
+        :rtype: list
+        """
+        with self._lock:
+            return [[dict(key), value] for key, value in self._values.iteritems()]
+
+    def merge(self, series):
+        for labels, value in series:
+            self.inc(value, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            for key, value in sorted(self._values.iteritems()):
+                yield self.name, key, value
+
+
+class Timer(object):
+    """
+    Distribution of durations in seconds by label values, exposed as a Prometheus histogram.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=default_buckets):
+        """
+        :param name: Metric name, in Prometheus style e.g. scrape_fetch_seconds.
+        :type name: str
+        :param description: What is timed.
+        :type description: str
+        :param buckets: Ascending upper bounds of the buckets in seconds.
+        :type buckets: tuple
+        """
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        # Label key to the count of each bucket (not cumulative), the sum and the count of the observations
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Time the body of a with statement, observed even if it raises.
+        """
+        started = now()
+        try:
+            yield
+        finally:
+            self.observe(now() - started, **labels)
+
+    def options(self):
+        return {'buckets': list(self.buckets)}
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(_label_key(labels))
+            return entry[2] if entry else 0
+
+    def series(self):
+        with self._lock:
+            return [[dict(key), [list(counts), total, count]]
+                    for key, (counts, total, count) in self._values.iteritems()]
+
+    def merge(self, series):
+        for labels, (counts, total, count) in series:
+            if len(counts) != len(self.buckets):
+                raise MetricsException('Buckets of {0} do not match'.format(self.name))
+            key = _label_key(labels)
+            with self._lock:
+                entry = self._values.get(key)
+                if entry is None:
+                    entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count)
+                            in self._values.iteritems())
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', key + (('le', _format_value(bound)),), cumulative
+            yield self.name + '_bucket', key + (('le', '+Inf'),), count
+            yield self.name + '_sum', key, total
+            yield self.name + '_count', key, count
+
+
+metric_types = {Counter.type: Counter, Timer.type: Timer}
+
+
+class Registry(object):
+    """
+    The metrics of a process, by name.
+
+    Metrics are plain counts in memory, so recording one is cheap enough for the parser's inner loop. Pool processes
+    and web workers each have their own registry, their snapshots are merged into one for reporting.
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric, or get the existing one of the same name so a module may be imported twice.
+
+        :raises MetricsException: If a metric of another type has the name.
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None:
+                self._metrics[metric.name] = metric
+                return metric
+        if existing.type != metric.type:
+            raise MetricsException('Metric {0} is already a {1}'.format(metric.name, existing.type))
+        return existing
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def snapshot(self):
+        """
+        :return: Type, description, options and series of every metric, JSON serializable.
+        :rtype: dict
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return dict((metric.name, {'type': metric.type, 'description': metric.description,
+                                   'options': metric.options(), 'series': metric.series()}) for metric in metrics)
+
+    def merge(self, snapshot):
+        """
+        Add the series of a snapshot of another registry to this one's.
+
+        :param snapshot: Snapshot from Registry.snapshot.
+        :type snapshot: dict
+        """
+        for name, entry in snapshot.iteritems():
+            metric = self.get(name) or self.register(metric_types[entry['type']](name, entry['description'],
+                                                                                 **entry['options']))
+            metric.merge(entry['series'])
+
+    def drain(self):
+        """
+        Take a snapshot and reset, e.g. to hand a pool process's metrics for a task back to the parent.
+
+        :rtype: dict
+        """
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def render(self):
+        """
+        :return: Every metric in the Prometheus text exposition format.
+        :rtype: str
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.description.replace('\\', '\\\\')
+                                                 .replace('\n', '\\n')))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+            for name, key, value in metric.samples():
+                if key:
+                    labels = ','.join('{0}="{1}"'.format(label, _escape(label_value)) for label, label_value in key)
+                    lines.append('{0}{{{1}}} {2}'.format(name, labels, _format_value(value)))
+                else:
+                    lines.append('{0} {1}'.format(name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, description):
+    """
+    :return: The counter of the name in the process registry, created if it does not exist.
+    :rtype: Counter
+    """
+    return registry.register(Counter(name, description))
+
+
+def timer(name, description, buckets=default_buckets):
+    """
+    :return: The timer of the name in the process registry, created if it does not exist.
+    :rtype: Timer
+    """
+    return registry.register(Timer(name, description, buckets))
+
+
+def reset():
+    """
+    Reset the process registry, e.g. as a pool initializer so a forked process does not report its parent's metrics.
+    """
+    registry.reset()
+
+
+def collect_call(func, *args):
+    """
+    Call a function and drain the metrics it recorded, for pool tasks. The parent merges them with merge. While the
+    parent is profiled the call is profiled too, see profiled.
+
+    :return: What the function returned and the metrics snapshot.
+    :rtype: tuple
+    """
+    try:
+        return _profile_call(func, args), registry.drain()
+    except Exception:
+        registry.reset()
+        raise
+
+
+def _profile_call(func, args):
+    global _task_profile
+    if not profile_path:
+        return func(*args)
+    if _task_profile is None:
+        _task_profile = cProfile.Profile()
+    _task_profile.enable()
+    try:
+        return func(*args)
+    finally:
+        _task_profile.disable()
+        # Pool processes exit without running atexit handlers, so the stats are written after every task
+        _task_profile.dump_stats('{0}.{1}'.format(profile_path, os.getpid()))
+
+
+def merge(snapshot):
+    registry.merge(snapshot)
+
+
+def render_merged(snapshots):
+    """
+    :param snapshots: Snapshots of several registries, e.g. one per web worker.
+    :type snapshots: list
+    :return: The sum of the snapshots in the Prometheus text exposition format.
+    :rtype: str
+    """
+    merged = Registry()
+    for snapshot in snapshots:
+        merged.merge(snapshot)
+    return merged.render()
+
+
+def dump(path, text=False):
+    """
+    Write the process registry to a file, replacing it atomically so a reader never sees a partial file.
+
+    :param path: File to write.
+    :type path: str
+    :param text: Write the Prometheus text format, e.g. for node_exporter's textfile collector, rather than a JSON
+    snapshot.
+    :type text: bool
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fh:
+        fh.write(registry.render() if text else json.dumps(registry.snapshot()))
+    os.rename(tmp_path, path)
+
+
+def load_dir(directory, exclude=None):
+    """
+    :param directory: Directory of JSON snapshots written by dump.
+    :type directory: str
+    :param exclude: File name to skip, e.g. this process's own snapshot.
+    :type exclude: str
+    :return: The snapshots, files which cannot be read are skipped.
+    :rtype: list
+    """
+    snapshots = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        if os.path.basename(path) == exclude:
+            continue
+        try:
+            with open(path) as fh:
+                snapshots.append(json.load(fh))
+        except (IOError, ValueError) as e:
+            _log('Unable to read metrics snapshot {0}: {1}'.format(path, str(e)), logging.WARN)
+    return snapshots
+
+
+@contextmanager
+def profiled(path):
+    """
+    Profile the body of a with statement with cProfile and save the stats to a file for pstats or snakeviz. Does
+    nothing when path is None, so profiling can be switched on per run.
+
+    Pool processes forked in the body profile the tasks they run with collect_call, each to <path>.<pid>. Load them
+    together with pstats.Stats(*files) for the whole run.
+
+    :param path: File to write the stats to.
+    :type path: str
+    """
+    global profile_path
+    if not path:
+        yield
+        return
+    # Profiles of an earlier run's pool processes would be mistaken for this run's
+    for stale in glob.glob('{0}.[0-9]*'.format(path)):
+        os.remove(stale)
+    profile_path = path
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile_path = None
+        profile.dump_stats(path)
+        _log('Wrote profile to {0}'.format(path))
+        tasks = glob.glob('{0}.[0-9]*'.format(path))
+        if tasks:
+            _log('Wrote profiles of {0} pool processes to {1}.<pid>'.format(len(tasks), path))
+
+
+def _label_key(labels):
+    return tuple(sorted((label, value.encode('utf-8') if isinstance(value, unicode) else str(value))
+                        for label, value in labels.iteritems()))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Print the sum of dumped metrics snapshots in Prometheus format.')
+    parser.add_argument('directory', type=str, help='directory of JSON metrics snapshots')
+    args = parser.parse_args()
+
+    sys.stdout.write(render_merged(load_dir(args.directory)))
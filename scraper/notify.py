@@ -0,0 +1,560 @@
+import argparse
+import json
+import logging
+import Queue
+import smtplib
+import sys
+import threading
+import urllib2
+from collections import namedtuple, OrderedDict
+from email.mime.text import MIMEText
+from time import sleep, time as now
+
+from cache_store import MenuCacheStore, location_key
+from parse_menu import section_type
+
+root_log = logging.getLogger()
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS subscriptions (
+        id INTEGER PRIMARY KEY,
+        address TEXT NOT NULL,
+        transport TEXT NOT NULL,
+        locations TEXT NOT NULL,
+        section_types TEXT NOT NULL,
+        frequency TEXT NOT NULL DEFAULT 'immediate',
+        digest_sent REAL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS digest_items (
+        id INTEGER PRIMARY KEY,
+        subscription INTEGER NOT NULL REFERENCES subscriptions (id),
+        location TEXT NOT NULL,
+        added TEXT NOT NULL,
+        removed TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS digest_items_subscription ON digest_items (subscription)',
+]
+
+# Created once the subscriptions have a frequency, due digests are claimed per frequency
+digest_schema = [
+    'CREATE INDEX IF NOT EXISTS subscriptions_digest ON subscriptions (frequency, digest_sent)',
+]
+
+# Seconds between the notifications of each frequency, changes for digest subscriptions are kept until it is due
+frequencies = OrderedDict([('immediate', 0), ('daily', 86400), ('weekly', 7 * 86400)])
+
+# Defaults of the command line options of the scrapers, a local mail relay takes about this many messages per second
+default_rate = 1000
+default_workers = 8
+
+Subscription = namedtuple('Subscription', ['id', 'address', 'transport', 'locations', 'section_types', 'frequency'])
+# Changes to one location's menu for one subscriber
+Notification = namedtuple('Notification', ['subscription', 'location', 'added', 'removed'])
+
+
+class NotificationException(Exception):
+    pass
+
+
+def add_subscription(store, address, transport='smtp', locations=None, section_types=None, frequency='immediate'):
+    """
+    Subscribe to menu changes.
+
+    :param store: Menu cache store the subscriptions are kept in.
+    :type store: cache_store.MenuCacheStore
+    :param address: Email address or webhook URL.
+    :type address: str
+    :param transport: Name of the transport to deliver with, "smtp" or "webhook".
+    :type transport: str
+    :param locations: Only notify about these locations, all locations if empty.
+    :type locations: list
+    :param section_types: Only notify about these section types ("beer", "wine"), all if empty.
+    :type section_types: list
+    :param frequency: One of frequencies, changes are sent as they happen or in a daily or weekly digest.
+    :type frequency: str
+    :return: The new subscription.
+    :rtype: Subscription
+    :raises NotificationException: If the frequency is unknown.
+    """
+    if frequency not in frequencies:
+        raise NotificationException('Unknown frequency "{0}".'.format(frequency))
+    locations = [location_key(location) for location in locations or []]
+    section_types = list(section_types or [])
+    with _connection(store) as connection:
+        # The first digest is due a full period after subscribing
+        cursor = connection.execute('INSERT INTO subscriptions (address, transport, locations, section_types, '
+                                    'frequency, digest_sent) VALUES (?, ?, ?, ?, ?, ?)',
+                                    (address, transport, json.dumps(locations), json.dumps(section_types), frequency,
+                                     now()))
+    return Subscription(cursor.lastrowid, address, transport, locations, section_types, frequency)
+
+
+def load_subscriptions(store):
+    """
+    :return: All subscriptions.
+    :rtype: list
+    """
+    rows = _connection(store).execute('SELECT id, address, transport, locations, section_types, frequency '
+                                      'FROM subscriptions ORDER BY id')
+    return [_subscription(row) for row in rows]
+
+
+def _subscription(row):
+    return Subscription(row[0], row[1], row[2], json.loads(row[3]), json.loads(row[4]), row[5])
+
+
+def _connection(store):
+    connection = store.ensure_schema(schema)
+    # Subscriptions added before digests have no frequency, they are all immediate
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(subscriptions)')]
+    if 'frequency' not in columns:
+        with connection:
+            connection.execute("ALTER TABLE subscriptions ADD COLUMN frequency TEXT NOT NULL DEFAULT 'immediate'")
+            connection.execute('ALTER TABLE subscriptions ADD COLUMN digest_sent REAL')
+    return store.ensure_schema(digest_schema)
+
+
+class SubscriptionIndex(object):
+    """
+    Subscriptions indexed by (location, section type), so matching a change only looks at interested subscribers.
+    """
+
+    def __init__(self, subscriptions):
+        self._index = {}
+        for subscription in subscriptions:
+            # None matches any location or section type
+            for location in subscription.locations or [None]:
+                for _type in subscription.section_types or [None]:
+                    self._index.setdefault((location, _type), []).append(subscription)
+
+    def match(self, location, _type):
+        """
+        :param location: Location key.
+        :type location: str
+        :param _type: Section type.
+        :type _type: str
+        :return: Subscriptions interested in changes to the location's sections of that type.
+        :rtype: list
+        """
+        matched = []
+        for key in ((location, _type), (location, None), (None, _type), (None, None)):
+            matched.extend(self._index.get(key, ()))
+        return matched
+
+
+class RateLimiter(object):
+    """
+    Thread safe token bucket.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: Tokens added per second.
+        :type rate: float
+        :param burst: Maximum number of tokens, defaults to rate.
+        :type burst: float
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._updated = now()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Block until tokens are available and take them.
+        """
+        tokens = min(tokens, self.burst)
+        while True:
+            with self._lock:
+                current = now()
+                self._tokens = min(self.burst, self._tokens + (current - self._updated) * self.rate)
+                self._updated = current
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            sleep(wait)
+
+
+class SmtpTransport(object):
+    """
+    Email notifications, a batch is sent over a single SMTP connection.
+
+    Transports send a batch of notifications and call delivered with each notification as soon as it was sent, so a
+    batch which fails part way is only retried for the notifications which were not sent.
+    """
+
+    def __init__(self, host='localhost', port=25, sender='notifier@localhost', username=None, password=None,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+
+    def send(self, notifications, delivered):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.username:
+                smtp.login(self.username, self.password)
+            for notification in notifications:
+                message = MIMEText(format_notification(notification))
+                message['Subject'] = 'Beer list changes at {0}'.format(notification.location)
+                message['From'] = self.sender
+                message['To'] = notification.subscription.address
+                smtp.sendmail(self.sender, [notification.subscription.address], message.as_string())
+                delivered(notification)
+        finally:
+            smtp.quit()
+
+
+class WebhookTransport(object):
+    """
+    JSON notifications POSTed to the subscription URL, one request per URL per batch.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+
+    def send(self, notifications, delivered):
+        by_url = OrderedDict()
+        for notification in notifications:
+            by_url.setdefault(notification.subscription.address, []).append(notification)
+        for url, url_notifications in by_url.iteritems():
+            payload = [{'location': notification.location, 'added': notification.added,
+                        'removed': notification.removed} for notification in url_notifications]
+            request = urllib2.Request(url, json.dumps(payload), {'Content-Type': 'application/json'})
+            urllib2.urlopen(request, timeout=self.timeout).read()
+            for notification in url_notifications:
+                delivered(notification)
+
+
+class Notifier(object):
+    """
+    Fans menu diffs out to subscribers in the background.
+
+    submit() only queues the diff, so scraping is never blocked. A dispatcher thread matches the changes against the
+    subscription index and groups them into batches per transport, which a pool of delivery threads sends subject to
+    a shared rate limit, retrying the undelivered notifications of failed batches with exponential backoff.
+
+    Changes for daily and weekly subscriptions are kept in the store instead and sent as one notification per location
+    once their digest is due. The dispatcher keeps the time the earliest digest is due and only claims digests once it
+    has passed, checking every digest_check seconds and on close.
+    """
+
+    def __init__(self, subscriptions, transports, store=None, workers=default_workers, batch_size=50,
+                 rate=default_rate, retries=3, backoff=1.0, digest_check=60):
+        """
+        :param subscriptions: Subscriptions to notify.
+        :type subscriptions: list
+        :param transports: Transport objects keyed by transport name.
+        :type transports: dict
+        :param store: Menu cache store the changes for digests are kept in, required for digest subscriptions.
+        :type store: cache_store.MenuCacheStore
+        :param workers: Number of delivery threads.
+        :type workers: int
+        :param batch_size: Maximum number of notifications per batch.
+        :type batch_size: int
+        :param rate: Maximum notifications sent per second.
+        :type rate: float
+        :param retries: Number of times to retry a failed batch.
+        :type retries: int
+        :param backoff: Seconds to wait before the first retry, doubled for each retry after that.
+        :type backoff: float
+        :param digest_check: Seconds between checks for due digests.
+        :type digest_check: float
+        :raises NotificationException: If there are digest subscriptions but no store.
+        """
+        self.index = SubscriptionIndex(subscriptions)
+        self.digests = dict((subscription.id, subscription) for subscription in subscriptions
+                            if subscription.frequency != 'immediate')
+        self.digest_frequencies = sorted(set(subscription.frequency for subscription in self.digests.itervalues()))
+        # Check for due digests as soon as the dispatcher starts
+        self.digest_due = 0
+        if self.digests and store is None:
+            raise NotificationException('Digest subscriptions need a store to keep their changes in.')
+        self.store = store
+        self.digest_check = digest_check
+        self.transports = transports
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = RateLimiter(rate, max(rate, batch_size))
+        self.sent = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._digest_lock = threading.Lock()
+        self._diffs = Queue.Queue()
+        self._batches = Queue.Queue()
+        self._threads = [threading.Thread(target=self._dispatch)]
+        self._threads.extend(threading.Thread(target=self._deliver) for _ in range(workers))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, location, diff):
+        """
+        Queue the changes of a location's menu for notification.
+
+        :param location: Stout location name.
+        :type location: str
+        :param diff: Diff from menu_diff.diff.
+        :type diff: dict
+        """
+        if diff['added'] or diff['removed']:
+            self._diffs.put((location, diff))
+
+    def close(self):
+        """
+        Wait for everything submitted to be delivered, then stop the threads.
+        """
+        self._diffs.join()
+        self.send_digests()
+        self._batches.join()
+        self._diffs.put(None)
+        for _ in self._threads[1:]:
+            self._batches.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def notifications(self, location, diff):
+        """
+        Match a diff against the subscriptions.
+
+        :return: One notification per interested subscriber.
+        :rtype: list
+        """
+        key = location_key(location)
+        # Group the changes by section type first, each subscriber is then visited once per type
+        changes = OrderedDict()
+        for change in ('added', 'removed'):
+            for item in diff[change]:
+                changes.setdefault(section_type(item['section']), {'added': [], 'removed': []})[change].append(item)
+        by_subscriber = OrderedDict()
+        for _type, typed_changes in changes.iteritems():
+            for subscription in self.index.match(key, _type):
+                entry = by_subscriber.setdefault(subscription.id, (subscription, [], []))
+                entry[1].extend(typed_changes['added'])
+                entry[2].extend(typed_changes['removed'])
+        return [Notification(subscription, location, added, removed)
+                for subscription, added, removed in by_subscriber.itervalues()]
+
+    def send_digests(self):
+        """
+        Queue a notification per location for every digest subscription which is due, with the changes kept since its
+        last digest, and update digest_due.
+
+        :return: Number of notifications queued.
+        :rtype: int
+        """
+        if not self.digests:
+            return 0
+        notifications = []
+        with self._digest_lock:
+            connection = _connection(self.store)
+            at = now()
+            with connection:
+                # Claiming the digests first makes the other notifiers sharing the store skip them, they are then told
+                # apart from the digests claimed before by digest_sent
+                for frequency in self.digest_frequencies:
+                    connection.execute('UPDATE subscriptions SET digest_sent = ? WHERE frequency = ? AND '
+                                       '(digest_sent IS NULL OR digest_sent <= ?)',
+                                       (at, frequency, at - frequencies[frequency]))
+                claimed = ('SELECT id FROM subscriptions WHERE frequency IN ({0}) AND digest_sent = ?'
+                           .format(', '.join('?' * len(self.digest_frequencies))))
+                params = self.digest_frequencies + [at]
+                by_subscription = OrderedDict()
+                for row in connection.execute(
+                        'SELECT subscriptions.id, address, transport, locations, section_types, frequency, location, '
+                        'added, removed FROM digest_items JOIN subscriptions ON subscriptions.id = subscription '
+                        'WHERE subscription IN (' + claimed + ') ORDER BY digest_items.id', params):
+                    by_location = by_subscription.setdefault(row[0], (_subscription(row), OrderedDict()))[1]
+                    entry = by_location.setdefault(row[6], ([], []))
+                    entry[0].extend(json.loads(row[7]))
+                    entry[1].extend(json.loads(row[8]))
+                connection.execute('DELETE FROM digest_items WHERE subscription IN (' + claimed + ')', params)
+            for subscription, by_location in by_subscription.itervalues():
+                notifications.extend(Notification(subscription, location, added, removed)
+                                     for location, (added, removed) in by_location.iteritems())
+            # The digest sent longest ago of each frequency is the next one due
+            due = []
+            for frequency in self.digest_frequencies:
+                row = connection.execute('SELECT digest_sent FROM subscriptions WHERE frequency = ? '
+                                         'ORDER BY digest_sent LIMIT 1', (frequency,)).fetchone()
+                if row:
+                    due.append((row[0] or 0) + frequencies[frequency])
+            self.digest_due = min(due) if due else float('inf')
+        self._queue(notifications)
+        return len(notifications)
+
+    def _dispatch(self):
+        while True:
+            try:
+                item = self._diffs.get(timeout=self.digest_check)
+            except Queue.Empty:
+                self._send_due_digests()
+                continue
+            try:
+                if item is None:
+                    return
+                notifications = []
+                digest_items = []
+                for notification in self.notifications(*item):
+                    if notification.subscription.id in self.digests:
+                        digest_items.append((notification.subscription.id, notification.location,
+                                             json.dumps(notification.added), json.dumps(notification.removed)))
+                    else:
+                        notifications.append(notification)
+                if digest_items:
+                    with _connection(self.store) as connection:
+                        connection.executemany('INSERT INTO digest_items (subscription, location, added, removed) '
+                                               'VALUES (?, ?, ?, ?)', digest_items)
+                self._queue(notifications)
+            except Exception as e:
+                _log('Unable to dispatch notifications: {0}'.format(str(e)), logging.ERROR)
+            finally:
+                self._diffs.task_done()
+            self._send_due_digests()
+
+    def _send_due_digests(self):
+        if not self.digests or now() < self.digest_due:
+            return
+        try:
+            self.send_digests()
+        except Exception as e:
+            _log('Unable to send digests: {0}'.format(str(e)), logging.ERROR)
+
+    def _queue(self, notifications):
+        # Batch per transport
+        batches = {}
+        for notification in notifications:
+            batch = batches.setdefault(notification.subscription.transport, [])
+            batch.append(notification)
+            if len(batch) >= self.batch_size:
+                self._batches.put((notification.subscription.transport, batch, 0))
+                batches[notification.subscription.transport] = []
+        for transport, batch in batches.iteritems():
+            if batch:
+                self._batches.put((transport, batch, 0))
+
+    def _deliver(self):
+        while True:
+            item = self._batches.get()
+            try:
+                if item is None:
+                    return
+                transport, batch, attempt = item
+                self.rate_limiter.acquire(len(batch))
+                delivered = set()
+                try:
+                    if transport not in self.transports:
+                        raise NotificationException('No transport configured for "{0}".'.format(transport))
+                    self.transports[transport].send(batch, lambda notification: delivered.add(id(notification)))
+                    with self._lock:
+                        self.sent += len(batch)
+                except Exception as e:
+                    # Subscribers sent to before the failure are not sent to again
+                    remaining = [notification for notification in batch if id(notification) not in delivered]
+                    with self._lock:
+                        self.sent += len(batch) - len(remaining)
+                    if attempt < self.retries:
+                        delay = self.backoff * 2 ** attempt
+                        _log('Sending {0} notifications failed ({1}), retrying in {2}s'
+                             .format(len(remaining), str(e), delay), logging.WARN)
+                        sleep(delay)
+                        self._batches.put((transport, remaining, attempt + 1))
+                    else:
+                        with self._lock:
+                            self.failed += len(remaining)
+                        _log('Giving up on {0} notifications: {1}'.format(len(remaining), str(e)), logging.ERROR)
+            finally:
+                self._batches.task_done()
+
+
+def add_arguments(parser):
+    """
+    Add the notification options of the scrapers to an argument parser.
+
+    :type parser: argparse.ArgumentParser
+    """
+    parser.add_argument('--notify', action='store_true', help='notify subscribers of menu changes')
+    parser.add_argument('--smtp-host', type=str, default='localhost', help='SMTP server for email notifications')
+    parser.add_argument('--smtp-port', type=int, default=25, help='SMTP server port')
+    parser.add_argument('--smtp-sender', type=str, default='notifier@localhost', help='notification email sender')
+    parser.add_argument('--notify-rate', type=float, default=default_rate,
+                        help='maximum notifications sent per second')
+    parser.add_argument('--notify-workers', type=int, default=default_workers,
+                        help='number of notification delivery threads')
+
+
+def from_arguments(store, args, timeout=30):
+    """
+    :param store: Menu cache store the subscriptions are kept in.
+    :type store: cache_store.MenuCacheStore
+    :param args: Parsed options added by add_arguments.
+    :type args: argparse.Namespace
+    :param timeout: Seconds to wait on each delivery.
+    :type timeout: float
+    :return: Notifier of every subscription, None unless --notify was given.
+    :rtype: Notifier
+    """
+    if not args.notify:
+        return None
+    return Notifier(load_subscriptions(store), {
+        'smtp': SmtpTransport(args.smtp_host, args.smtp_port, args.smtp_sender, timeout=timeout),
+        'webhook': WebhookTransport(timeout)
+    }, store, workers=args.notify_workers, rate=args.notify_rate)
+
+
+def format_notification(notification):
+    """
+    :return: Plain text body listing the changes.
+    :rtype: str
+    """
+    lines = ['Beer list changes at {0}'.format(notification.location), '']
+    for title, items in (('Added', notification.added), ('Removed', notification.removed)):
+        if items:
+            lines.append(title)
+            lines.extend('  {0} ({1})'.format(item['beverage'], item['section']) for item in items)
+            lines.append('')
+    return '\n'.join(lines)
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Manage menu change notification subscriptions.')
+    parser.add_argument('database', type=str, help='menu cache SQLite file')
+    subparsers = parser.add_subparsers(dest='command')
+    subscribe = subparsers.add_parser('subscribe', help='add a subscription')
+    subscribe.add_argument('address', type=str, help='email address or webhook URL')
+    subscribe.add_argument('--transport', choices=['smtp', 'webhook'], default='smtp')
+    subscribe.add_argument('--location', action='append', help='only notify about this location, may be repeated')
+    subscribe.add_argument('--section-type', action='append', choices=['beer', 'wine'],
+                           help='only notify about this section type, may be repeated')
+    subscribe.add_argument('--frequency', choices=list(frequencies), default='immediate',
+                           help='send changes as they happen or in a daily or weekly digest')
+    subparsers.add_parser('list', help='list subscriptions')
+    args = parser.parse_args()
+
+    cache = MenuCacheStore(args.database)
+    if args.command == 'subscribe':
+        _log('Added {0}'.format(add_subscription(cache, args.address, args.transport, args.location,
+                                                 args.section_type, args.frequency)))
+    else:
+        for sub in load_subscriptions(cache):
+            print '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(sub.id, sub.transport, sub.address,
+                                                        ','.join(sub.locations) or '*',
+                                                        ','.join(sub.section_types) or '*', sub.frequency)
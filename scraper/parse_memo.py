@@ -0,0 +1,185 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from time import time as now
+
+from parse_menu import parser_version
+
+root_log = logging.getLogger()
+
+
+class ParseMemo(object):
+    """
+    Persistent memo of beverage titles to their parsed name and details, so titles seen on an earlier scrape are not
+    parsed again.
+
+    Entries are keyed by the raw title, the section type and the parser version. Entries of other parser versions are
+    dropped when the memo is opened, so bumping parse_menu.parser_version invalidates it. The least recently used
+    entries are evicted once there are more than max_entries, use times are only written once per touch_interval.
+
+    Lookups are served from memory once read, new entries and use times are written in one transaction by flush().
+    Connections are per thread and per process like MenuCacheStore, so a memo set before forking a pool is shared by
+    the pool's processes.
+    """
+
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS parse_memo (
+            title TEXT NOT NULL,
+            type TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            details TEXT,
+            used REAL NOT NULL,
+            PRIMARY KEY (title, type, version)
+        )''',
+        'CREATE INDEX IF NOT EXISTS parse_memo_used ON parse_memo (used)',
+    ]
+
+    def __init__(self, path, max_entries=100000, version=parser_version, touch_interval=3600):
+        """
+        :param path: Path to the SQLite file, created if it does not exist.
+        :type path: str
+        :param max_entries: Maximum number of entries kept.
+        :type max_entries: int
+        :param version: Parser version of the entries.
+        :type version: int
+        :param touch_interval: Seconds before the use time of an entry is updated again.
+        :type touch_interval: float
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.version = version
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pending = {}
+        self._used = set()
+        self._pid = None
+
+    def connection(self):
+        """
+        Get the SQLite connection for the current thread.
+
+        :rtype: sqlite3.Connection
+        """
+        if getattr(self._local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                for statement in self.schema:
+                    connection.execute(statement)
+                connection.execute('DELETE FROM parse_memo WHERE version != ?', (self.version,))
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, title, _type):
+        """
+        :param title: Raw beverage title.
+        :type title: unicode
+        :param _type: Section type.
+        :type _type: str
+        :return: Parsed name and a copy of the details (None if they could not be parsed), None if the title is not in
+        the memo.
+        :rtype: tuple
+        """
+        key = (title, _type)
+        with self._lock:
+            self._reset_after_fork()
+            entry = self._entries.get(key)
+        if entry is None:
+            row = self.connection().execute('SELECT name, details, used FROM parse_memo WHERE title = ? AND type = ? '
+                                            'AND version = ?', (title, _type, self.version)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            entry = [row[0], json.loads(row[1]) if row[1] else None, row[2]]
+        with self._lock:
+            self._entries[key] = entry
+            if now() - entry[2] > self.touch_interval:
+                entry[2] = now()
+                self._used.add(key)
+        self.hits += 1
+        name, details, _ = entry
+        return name, dict(details) if details is not None else None
+
+    def put(self, title, _type, name, details):
+        """
+        Add a parsed title, written on the next flush.
+        """
+        key = (title, _type)
+        entry = [name, dict(details) if details is not None else None, now()]
+        with self._lock:
+            self._reset_after_fork()
+            self._entries[key] = entry
+            self._pending[key] = entry
+            if len(self._entries) > self.max_entries:
+                self._entries = dict(self._pending)
+
+    def flush(self):
+        """
+        Write new entries and use times, then evict the least recently used entries over max_entries.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            used, self._used = self._used, set()
+        if not pending and not used:
+            return
+        used_at = now()
+        with self.connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO parse_memo (title, type, version, name, details, used) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)',
+                                   [(title, _type, self.version, name,
+                                     json.dumps(details) if details is not None else None, used_at)
+                                    for (title, _type), (name, details, _) in pending.iteritems()])
+            connection.executemany('UPDATE parse_memo SET used = ? WHERE title = ? AND type = ? AND version = ?',
+                                   [(used_at, title, _type, self.version) for title, _type in used])
+            excess = connection.execute('SELECT COUNT(*) FROM parse_memo').fetchone()[0] - self.max_entries
+            if excess > 0:
+                connection.execute('DELETE FROM parse_memo WHERE rowid IN '
+                                   '(SELECT rowid FROM parse_memo ORDER BY used LIMIT ?)', (excess,))
+
+    def stats(self):
+        """
+        :return: Number of entries, and hits and misses of this process.
+        :rtype: dict
+        """
+        count = self.connection().execute('SELECT COUNT(*) FROM parse_memo').fetchone()[0]
+        return {'entries': count, 'hits': self.hits, 'misses': self.misses}
+
+    def _reset_after_fork(self):
+        # Entries pending in the parent are the parent's to write
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = {}
+            self._used = set()
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Show the size of the beverage title parse memo.')
+    parser.add_argument('database', type=str, help='parse memo SQLite file')
+    args = parser.parse_args()
+
+    _log('Parse memo of parser version {0}: {1}'.format(parser_version, ParseMemo(args.database).stats()))
@@ -6,13 +6,40 @@ import re
 import urllib2
 from datetime import datetime
 
-from lxml.html import fromstring
+from lxml import etree
+from lxml.html import fromstring, HtmlElementClassLookup
 from unidecode import unidecode
 
 import sys
 
+import metrics
+
 root_log = logging.getLogger()
-root_log.setLevel(logging.WARN)
+
+# Bump when a change to the parsers changes their output, invalidates the parse memo
+parser_version = 1
+# parse_memo.ParseMemo consulted before parsing a beverage title, titles are always parsed when None
+memo = None
+
+section_seconds = metrics.timer('parse_section_seconds', 'Time to parse a menu section, by section type')
+beverages_parsed = metrics.counter('parse_beverages_total', 'Beverages parsed, by section type')
+beverages_failed = metrics.counter('parse_beverages_failed_total', 'Beverage elements which could not be parsed')
+details_failed = metrics.counter('parse_details_failed_total', 'Beverage titles whose details could not be parsed')
+memo_lookups = metrics.counter('parse_memo_lookups_total', 'Parse memo lookups, by result hit or miss')
+
+# Compiled once rather than on every section and beverage
+h2_xpath = etree.XPath('.//h2')
+article_xpath = etree.XPath('.//article')
+title_xpath = etree.XPath('.//p[@class="title"]')
+name_regex = re.compile('^([^-]+)-(.+)$')
+year_regex = re.compile('([0-9]{4})')
+abv_regex = re.compile('^([0-9]*\.?[0-9]+) *%$')
+price_regex = re.compile('^\$ *([0-9]*\.?[0-9]+)$')
+size_regex = re.compile('^([0-9]*\.?[0-9]+) *(oz|ml)$', re.IGNORECASE)
+
+ml_per_oz = 29.5735
+# Numeric details added next to the raw text: ABV as a float, price in cents and size in ml
+normalized_fields = ['abv', 'price_cents', 'size_ml']
 
 
 class ParsingException(Exception):
@@ -61,44 +88,73 @@ class WineParsingStrategy(BeverageParsingStrategy):
 
 
 class WineParser(BeverageParser):
+    strategy = WineParsingStrategy()
+
     def parse(self, name):
-        return WineParsingStrategy().parse(name)
+        return self.strategy.parse(name)
 
 
 class BeveragePieceStrategy:
-    pass
+    def match(self, piece, details):
+        """
+        Add a piece of a beverage title to details if this strategy recognizes it. Each strategy recognizes one kind
+        of piece, the base strategy recognizes none.
+
+        :param piece: Non-empty piece of the title.
+        :type piece: str
+        :param details: Beverage details, updated in place.
+        :type details: dict
+        :return: Whether the piece was recognized.
+        :rtype: bool
+        """
+        return False
+
+    def parse(self, piece):
+        details = {}
+        if not self.match(piece, details):
+            raise PieceParsingException
+        return details
 
 
 class AlcoholPercentagePieceStrategy(BeveragePieceStrategy):
-    def parse(self, name):
-        if name.endswith('%'):
-            return {'alcohol_percentage': name}
-        else:
-            raise PieceParsingException
+    def match(self, piece, details):
+        if piece.endswith('%'):
+            details['alcohol_percentage'] = piece
+            abv = parse_abv(piece)
+            if abv is not None:
+                details['abv'] = abv
+            return True
+        return False
 
 
 class PricePieceStrategy(BeveragePieceStrategy):
-    def parse(self, name):
-        if name[0] == '$':
-            return {'price': name}
-        else:
-            raise PieceParsingException
+    def match(self, piece, details):
+        if piece.startswith('$'):
+            details['price'] = piece
+            price_cents = parse_price_cents(piece)
+            if price_cents is not None:
+                details['price_cents'] = price_cents
+            return True
+        return False
 
 
 class SizePieceStrategy(BeveragePieceStrategy):
-    def parse(self, name):
-        if name.endswith(('oz', 'ml')):
-            return {'size': name}
-        else:
-            raise PieceParsingException
+    def match(self, piece, details):
+        if piece.endswith(('oz', 'ml')):
+            details['size'] = piece
+            size_ml = parse_size_ml(piece)
+            if size_ml is not None:
+                details['size_ml'] = size_ml
+            return True
+        return False
 
 
 class NitroPieceStrategy(BeveragePieceStrategy):
-    def parse(self, piece):
+    def match(self, piece, details):
         if piece == 'Nitro':
-            return {'nitro': True}
-        else:
-            raise PieceParsingException
+            details['nitro'] = True
+            return True
+        return False
 
 
 class BeerParser(BeverageParser):
@@ -131,34 +187,25 @@ class BeerParser(BeverageParser):
         if 3 <= len(pieces) <= 6:
             details = {'type': 'beer'}
             # First piece is always the name
-            details = dict(details.items() + self._parse_name(pieces[0]).items())
-            del pieces[0]
+            self._parse_name(pieces[0], details)
 
             # Match easily identifiable pieces
             unidentified = []
-            for piece in pieces:
-                if len(piece):
-                    parsed = False
+            for piece in pieces[1:]:
+                if piece:
                     for strategy in self.strategies:
-                        try:
-                            details = dict(details.items() + strategy.parse(piece).items())
-                            parsed = True
+                        if strategy.match(piece, details):
                             break
-                        except PieceParsingException:
-                            pass
-                    if not parsed:
+                    else:
                         unidentified.append(piece)
 
             # Make assumptions on remaining pieces by position
-            try:
-                details = dict(details.items() + self._parse_positional(unidentified, total_count).items())
-            except ParsingException as e:
-                _log('{0} from name {1}'.format(str(e), name), logging.WARN)
+            if not self._parse_positional(unidentified, total_count, details):
+                _log('Unable to identify remaining beer name pieces: %s from name %s', logging.WARN, unidentified, name)
 
-            try:
-                details = dict(details.items() + self._parse_year(details['name']).items())
-            except PieceParsingException:
-                pass
+            year = self._parse_year(details['name'])
+            if year:
+                details['year'] = year
 
             return details
         else:
@@ -170,50 +217,100 @@ class BeerParser(BeverageParser):
         """
         return name.replace('w/', 'with ').replace('IPAw / ', 'IPA with ')
 
-    def _parse_name(self, piece):
-        regex = re.compile('^([^-]+)-(.+)$')
-        match = regex.match(piece)
+    def _parse_name(self, piece, details):
+        match = name_regex.match(piece)
         if match:
-            return {'name': match.group(1).strip(), 'brewery': match.group(2).strip()}
+            details['name'] = match.group(1).strip()
+            details['brewery'] = match.group(2).strip()
         else:
-            return {'name': piece}
+            details['name'] = piece
 
     def _parse_year(self, name):
-        year_re = re.compile('([0-9]{4})')
-        year_match = year_re.search(name)
+        year_match = year_regex.search(name)
         if year_match:
             year = int(year_match.group(1))
-            if year and year > 1990 and year < 2020:
-                return {'year': year}
-        raise PieceParsingException
+            if 1990 < year < 2020:
+                return year
+        return None
 
-    def _parse_positional(self, pieces, total_count):
+    def _parse_positional(self, pieces, total_count, details):
         """
         Parse the remaining unidentified pieces by position.
+
+        :return: False if the pieces could not be identified.
+        :rtype: bool
         """
-        details = {}
         if 1 <= len(pieces) <= 2:
             # Special case for 3 piece title, style will be only remaining piece
             if total_count == 3:
                 details['style'] = pieces[0]
             else:
                 details['location'] = pieces[0]
-                try:
+                if len(pieces) == 2:
                     details['style'] = pieces[1]
-                except IndexError:
-                    pass
-            return details
+            return True
         else:
-            raise ParsingException('Unable to identify remaining beer name pieces: {0}'.format(str(pieces)))
+            return False
+
+
+def parse_abv(text):
+    """
+    :param text: Alcohol percentage piece of a title, e.g. "6.9%".
+    :type text: str
+    :return: Alcohol percentage, None if it is not a number.
+    :rtype: float
+    """
+    match = abv_regex.match(text)
+    if match:
+        return float(match.group(1))
+    _log('Alcohol percentage "%s" is not a number', logging.WARN, text)
+    return None
+
+
+def parse_price_cents(text):
+    """
+    :param text: Price piece of a title, e.g. "$12".
+    :type text: str
+    :return: Price in cents, None if it is not a number.
+    :rtype: int
+    """
+    match = price_regex.match(text)
+    if match:
+        return int(round(float(match.group(1)) * 100))
+    _log('Price "%s" is not a number', logging.WARN, text)
+    return None
+
+
+def parse_size_ml(text):
+    """
+    :param text: Size piece of a title, e.g. "22oz" or "375ml".
+    :type text: str
+    :return: Size in ml, None if it is not a number.
+    :rtype: float
+    """
+    match = size_regex.match(text)
+    if match:
+        size = float(match.group(1))
+        return round(size * ml_per_oz, 1) if match.group(2).lower() == 'oz' else size
+    _log('Size "%s" is not a number', logging.WARN, text)
+    return None
 
 
-def parse_menu(html, location, date):
+# Parsers hold no state, share one of each rather than creating one per beverage
+beer_parser = BeerParser()
+wine_parser = WineParser()
+
+
+def parse_menu(html, location, date, streaming=False):
     # TODO: parse location from menu
-    return {
+    menu = {
         'location': location,
         'parsed': str(date),
-        'sections': parse_sections(html)
+        'sections': list(iter_sections(html)) if streaming else parse_sections(html)
     }
+    if memo:
+        memo.flush()
+    return menu
 
 
 def parse_sections(html):
@@ -259,6 +356,111 @@ def parse_sections(html):
     return parsed_sections
 
 
+def iter_sections(html, chunk_size=65536):
+    """
+    Parse the menu sections in a single pass over the page, yielding each section as soon as it has been read.
+
+    Uses a pull parser rather than building the whole page tree. Only the div#second-menu subtree is kept and each
+    section is discarded once parsed. Produces the same sections as parse_sections.
+
+    :param html: Stout menu web page HTML
+    :type html: str
+    :param chunk_size: Number of characters fed to the parser at a time.
+    :type chunk_size: int
+    :return: Generator of section dicts.
+    :rtype: generator
+    """
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    parser.set_element_class_lookup(HtmlElementClassLookup())
+    stream = _SectionStream()
+    for offset in range(0, len(html), chunk_size):
+        parser.feed(html[offset:offset + chunk_size])
+        for section in stream.consume(parser.read_events()):
+            yield section
+    parser.close()
+    for section in stream.consume(parser.read_events()):
+        yield section
+
+    if stream.menu is None:
+        _log('Unable to find "div#second-menu" when parsing menu.', logging.ERROR)
+        raise ParsingException('Unable to find "div#second-menu" when parsing menu.')
+    _log('Found {0} headers and {1} sections in menu.'.format(stream.header_count, stream.section_count),
+         logging.INFO)
+    if stream.header_count != stream.section_count:
+        _log('Number of headers {0} does not match number of sections {1}'
+             .format(stream.header_count, stream.section_count), logging.WARN)
+
+
+class _SectionStream(object):
+    """
+    Pair up the headers and sections of div#second-menu from pull parser events.
+
+    Headers and sections are matched up in document order, the same as zipping the lists of all headers and sections
+    in parse_sections. A pair is parsed once both elements have been fully read.
+    """
+
+    def __init__(self):
+        self.menu = None
+        self.menu_done = False
+        self.header_count = 0
+        self.section_count = 0
+        self.parsed_count = 0
+        # [element, fully read] in document order
+        self._headers = []
+        self._sections = []
+        self._open = {}
+        # Number of open sections, a nested section must not be cleared before its parent is parsed
+        self._open_sections = 0
+
+    def consume(self, events):
+        for event, element in events:
+            if self.menu is None or self.menu_done:
+                if event == 'start' and self.menu is None and element.tag == 'div' and \
+                        element.get('id') == 'second-menu':
+                    self.menu = element
+                elif event == 'end':
+                    self._discard(element)
+                continue
+
+            if event == 'start':
+                if element.tag == 'header':
+                    self._open[element] = [element, False]
+                    self._headers.append(self._open[element])
+                    self.header_count += 1
+                elif element.tag == 'section':
+                    self._open[element] = [element, False]
+                    self._sections.append(self._open[element])
+                    self.section_count += 1
+                    self._open_sections += 1
+            else:
+                if element is self.menu:
+                    self.menu_done = True
+                elif element.tag in ('header', 'section') and element in self._open:
+                    self._open.pop(element)[1] = True
+                    if element.tag == 'section':
+                        self._open_sections -= 1
+                for section in self._parse_ready():
+                    yield section
+
+    def _parse_ready(self):
+        while self._headers and self._sections and self._headers[0][1] and self._sections[0][1]:
+            header_element = self._headers.pop(0)[0]
+            section_element = self._sections.pop(0)[0]
+            self.parsed_count += 1
+            yield _parse_section(header_element, section_element, self.parsed_count)
+            # Unless a pending header or section is inside of it, the section is no longer needed
+            if not self._open_sections and not self._headers:
+                section_element.clear()
+
+    def _discard(self, element):
+        # Free elements outside of the menu once they have been read
+        element.clear()
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                parent.remove(element.getprevious())
+
+
 def _parse_section(header_element, section_element, section_count):
     """
     Parse a menu header and section element into a section dict.
@@ -273,33 +475,47 @@ def _parse_section(header_element, section_element, section_count):
     :rtype: dict
     """
     # H2 inside the header has the section name
-    name = header_element.xpath('.//h2')
+    name = h2_xpath(header_element)
     if name:
         name = name[0].text_content().strip()
-        _log('Parsing section {0} "{1}".'.format(section_count, name))
+        _log('Parsing section %d "%s".', logging.DEBUG, section_count, name)
         section = {
             'name': name,
-            'type': 'wine' if 'Wine' in name else 'beer',
+            'type': section_type(name),
             'beverages': []
         }
 
-        # Find all article elements inside the section
-        beverage_elements = section_element.xpath('.//article')
-        _log('Found {0} beverages.'.format(len(beverage_elements)))
-        beverage_count = 0
-        for beverage_element in beverage_elements:
-            beverage_count += 1
-            try:
-                beverage = _parse_beverage(beverage_element, section['type'] == 'wine', beverage_count, section_count)
-                _log('Parsed beverage {0} "{1}".'.format(beverage_count, beverage['name']))
-                section['beverages'].append(beverage)
-            except ParsingException as e:
-                _log(str(e), logging.DEBUG)
+        with section_seconds.time(type=section['type']):
+            # Find all article elements inside the section
+            beverage_elements = article_xpath(section_element)
+            _log('Found %d beverages.', logging.DEBUG, len(beverage_elements))
+            beverage_count = 0
+            for beverage_element in beverage_elements:
+                beverage_count += 1
+                try:
+                    beverage = _parse_beverage(beverage_element, section['type'] == 'wine', beverage_count,
+                                               section_count)
+                    _log('Parsed beverage %d "%s".', logging.DEBUG, beverage_count, beverage['name'])
+                    section['beverages'].append(beverage)
+                except ParsingException as e:
+                    beverages_failed.inc(type=section['type'])
+                    _log('%s', logging.DEBUG, e)
+        beverages_parsed.inc(len(section['beverages']), type=section['type'])
         return section
     else:
         raise ParsingException('Unable to find "h2" in header {0}'.format(section_count))
 
 
+def section_type(name):
+    """
+    :param name: Section name.
+    :type name: str
+    :return: Type of the beverages in the section, "wine" or "beer".
+    :rtype: str
+    """
+    return 'wine' if 'Wine' in name else 'beer'
+
+
 def _parse_beverage(beverage_element, is_wine, beverage_count, section_count):
     """
     Parse a beverage element into an item.
@@ -314,10 +530,20 @@ def _parse_beverage(beverage_element, is_wine, beverage_count, section_count):
     :rtype: dict
     """
     # .title element contains the beverage name
-    name = beverage_element.xpath('.//p[@class="title"]')
+    name = title_xpath(beverage_element)
     if name:
-        name = name[0].text_content().strip()
+        title = name = name[0].text_content().strip()
         if name:
+            _type = 'wine' if is_wine else 'beer'
+            cached = memo.get(title, _type) if memo else None
+            if memo:
+                memo_lookups.inc(result='hit' if cached else 'miss')
+            if cached:
+                name, details = cached
+                beverage = {'name': name}
+                if details is not None:
+                    beverage['details'] = details
+                return beverage
             if type(name) is unicode:
                 # Convert any fancy unicode characters to more common ascii equivalents
                 name = unidecode(name)
@@ -327,7 +553,10 @@ def _parse_beverage(beverage_element, is_wine, beverage_count, section_count):
             try:
                 beverage['details'] = _parse_beverage_details(name, is_wine)
             except ParsingException as e:
-                _log(str(e), logging.DEBUG)
+                details_failed.inc(type=_type)
+                _log('%s', logging.DEBUG, e)
+            if memo:
+                memo.put(title, _type, name, beverage.get('details'))
             return beverage
         else:
             raise ParsingException('Empty beverage in section {0} item {1}'.format(section_count, beverage_count))
@@ -338,15 +567,14 @@ def _parse_beverage(beverage_element, is_wine, beverage_count, section_count):
 
 def _parse_beverage_details(name, is_wine):
     if is_wine:
-        parser = WineParser()
-        return parser.parse(name)
+        return wine_parser.parse(name)
     else:
-        parser = BeerParser()
-        return parser.parse(name)
+        return beer_parser.parse(name)
 
 
-def _log(message, level=logging.INFO):
-    root_log.log(level, message)
+def _log(message, level=logging.INFO, *args):
+    # Arguments are only formatted into the message if the level is enabled, so per beverage messages are cheap
+    root_log.log(level, message, *args)
 
 
 if __name__ == '__main__':
@@ -355,11 +583,13 @@ if __name__ == '__main__':
     sh.setLevel(logging.INFO)
     sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     root_log.addHandler(sh)
+    root_log.setLevel(logging.WARN)
 
     # Command line arguments
     parser = argparse.ArgumentParser(description='Parse http://www.stoutburgersandbeers.com/ beer menu into JSON.')
     parser.add_argument('filename', type=str, help='file path or URL to beverage menu')
     parser.add_argument('--pretty', action='store_true', help='pretty print JSON output')
+    parser.add_argument('--streaming', action='store_true', help='parse the page in a single streaming pass')
     args = parser.parse_args()
 
     # Parse menu file
@@ -371,7 +601,7 @@ if __name__ == '__main__':
 
     if contents:
         # Parse menu
-        menu = parse_menu(contents, 'Studio City', datetime.now())
+        menu = parse_menu(contents, 'Studio City', datetime.now(), args.streaming)
 
         # Output parsed menu as JSON
         if args.pretty:
@@ -0,0 +1,95 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+from jinja2 import Environment, FileSystemLoader
+
+from cache_store import MenuCacheStore, menu_name, snapshot_etag, snapshot_time
+
+root_log = logging.getLogger()
+
+template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web', 'templates')
+
+_environment = None
+
+
+def render_snapshot(snapshot, menu, output_dir):
+    """
+    Write the HTML and JSON of a snapshot's menu view to static files, laid out like the menu view URLs:
+    <output_dir>/menu/<location>/<scrape time>/index.html and index.json, and the same under
+    <output_dir>/menu/<menu name>/ for the day. A reverse proxy can serve them without the web app.
+
+    :param snapshot: Snapshot of the menu.
+    :type snapshot: cache_store.Snapshot
+    :param menu: Parsed menu.
+    :type menu: dict
+    :param output_dir: Root directory of the static files.
+    :type output_dir: str
+    :return: Directory the files of the snapshot were written to.
+    :rtype: str
+    """
+    html = _get_environment().get_template('table_view.html').render(menu=menu).encode('utf-8')
+    directories = [os.path.join(output_dir, 'menu', snapshot.location, snapshot_time(snapshot.scraped)),
+                   os.path.join(output_dir, 'menu', menu_name(snapshot.location, snapshot.scraped))]
+    for directory in directories:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        _write(os.path.join(directory, 'index.html'), html)
+        _write(os.path.join(directory, 'index.json'), json.dumps(menu))
+        # The ETag the web app serves the unsorted HTML page with
+        _write(os.path.join(directory, 'etag'), snapshot_etag(snapshot))
+    return directories[0]
+
+
+def render_all(store, output_dir, locations=None):
+    """
+    Pre-render every cached snapshot, the last snapshot of each day is what the menu view shows for that day.
+
+    :return: Number of snapshots rendered.
+    :rtype: int
+    """
+    count = 0
+    for location in locations or store.locations():
+        for snapshot in store.snapshots(location):
+            render_snapshot(snapshot, store.load(snapshot), output_dir)
+            count += 1
+    return count
+
+
+def _get_environment():
+    global _environment
+    if _environment is None:
+        _environment = Environment(loader=FileSystemLoader(template_dir), autoescape=True)
+    return _environment
+
+
+def _write(path, content):
+    # Write then rename, so a file being served is never partially written
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(content)
+    os.rename(tmp_path, path)
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Pre-render the menu view of every cached menu to static files.')
+    parser.add_argument('database', type=str, help='menu cache SQLite file')
+    parser.add_argument('output_dir', type=str, help='directory to write the static files to')
+    parser.add_argument('--location', type=str, action='append', help='only render this location, may be repeated')
+    args = parser.parse_args()
+
+    _log('Rendered {0} menus'.format(render_all(MenuCacheStore(args.database), args.output_dir, args.location)))
@@ -0,0 +1,85 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+from cache_store import location_key
+
+root_log = logging.getLogger()
+
+# Config file of the locations to scrape, STOUT_LOCATIONS overrides it
+default_path = os.environ.get('STOUT_LOCATIONS', os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                              'locations.json'))
+# Seconds between scrapes of a location in the work queue unless its config sets an interval
+default_interval = 3600
+
+
+class RegistryException(Exception):
+    pass
+
+
+def load_locations(path=None, include_disabled=False):
+    """
+    Load the locations to scrape from a JSON config file of the form:
+
+    {"locations": [{"name": "Studio City", "url": "http://...", "interval": 3600, "enabled": true}]}
+
+    name and url are required. interval is the seconds between scrapes in the work queue, enabled defaults to true.
+
+    :param path: Config file, defaults to default_path.
+    :type path: str
+    :param include_disabled: Also return locations which are not enabled.
+    :type include_disabled: bool
+    :return: Locations with name, url, interval and enabled, in the order of the file.
+    :rtype: list
+    :raises RegistryException: If the file can not be read or a location is invalid.
+    """
+    path = path or default_path
+    try:
+        with open(path) as fh:
+            config = json.load(fh)
+    except (IOError, ValueError) as e:
+        raise RegistryException('Unable to read locations from {0}: {1}'.format(path, str(e)))
+
+    locations = []
+    seen = set()
+    for i, entry in enumerate(config.get('locations', []) if isinstance(config, dict) else []):
+        if not isinstance(entry, dict) or not entry.get('name') or not entry.get('url'):
+            raise RegistryException('Location {0} of {1} needs a name and url'.format(i, path))
+        key = location_key(entry['name'])
+        if key in seen:
+            raise RegistryException('Location "{0}" is configured twice in {1}'.format(entry['name'], path))
+        seen.add(key)
+        interval = entry.get('interval', default_interval)
+        if not isinstance(interval, (int, float)) or interval <= 0:
+            raise RegistryException('Interval of "{0}" must be a positive number of seconds'.format(entry['name']))
+        location = {'name': entry['name'], 'url': entry['url'], 'interval': interval,
+                    'enabled': entry.get('enabled', True)}
+        if location['enabled'] or include_disabled:
+            locations.append(location)
+    if not locations:
+        raise RegistryException('No locations configured in {0}'.format(path))
+    return locations
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Validate and list the configured locations.')
+    parser.add_argument('config', type=str, nargs='?', default=default_path, help='locations JSON file')
+    args = parser.parse_args()
+
+    for loc in load_locations(args.config, include_disabled=True):
+        _log('{0} - {1} every {2}s{3}'.format(loc['name'], loc['url'], loc['interval'],
+                                             '' if loc['enabled'] else ' (disabled)'))
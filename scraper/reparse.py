@@ -0,0 +1,136 @@
+import argparse
+import logging
+import multiprocessing
+import sys
+import zlib
+from time import time as now
+
+import diff_chain
+import identity
+import manifest
+import metrics
+import parse_memo
+import parse_menu
+import search_index
+import tenure
+from cache_store import MenuCacheStore, parse_scraped
+
+root_log = logging.getLogger()
+
+
+def reparse(store, locations=None, processes=None, batch_size=64, progress_interval=10):
+    """
+    Parse every archived menu page again and replace the snapshots whose parsed menu changed.
+
+    Pages are parsed across a process pool, then their beverages are resolved to identities in this process. Each
+    changed snapshot is replaced in a single transaction and its manifest entry updated. Pages which fail to parse are
+    logged and their snapshots kept. The diff chain and tenures of every affected location and the search index are
+    rebuilt at the end, also when the reparse is interrupted.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param locations: Only reparse these locations.
+    :type locations: list
+    :param processes: Number of parsing processes, defaults to the number of CPUs.
+    :type processes: int
+    :param batch_size: Number of pages read from the store and handed to the pool at a time.
+    :type batch_size: int
+    :param progress_interval: Seconds between progress log messages.
+    :type progress_interval: float
+    :return: Number of pages parsed and number of snapshots changed.
+    :rtype: tuple
+    """
+    archived = []
+    for location in locations or [None]:
+        archived.extend(store.archived(location))
+    _log('Reparsing {0} archived pages'.format(len(archived)))
+
+    pool = multiprocessing.Pool(processes, metrics.reset)
+    started = last_progress = now()
+    parsed = changed = failed = 0
+    changed_locations = set()
+    try:
+        for offset in range(0, len(archived), batch_size):
+            batch = archived[offset:offset + batch_size]
+            # Send the pages compressed, there is less to pickle and the workers decompress in parallel
+            tasks = [(i, name, scraped_at, store.load_page(page, False))
+                     for i, (_, name, scraped_at, page) in enumerate(batch)]
+            for i, menu, parse_metrics, error in pool.imap_unordered(_parse_page, tasks):
+                metrics.merge(parse_metrics)
+                snapshot = batch[i][0]
+                parsed += 1
+                if menu is None:
+                    # The snapshot keeps its current menu
+                    _log('Unable to reparse {0} {1}: {2}'.format(snapshot.location, snapshot.scraped, error),
+                         logging.ERROR)
+                    failed += 1
+                    continue
+                identity.resolve(store, menu)
+                replaced = store.put(snapshot.location, parse_scraped(snapshot.scraped), menu, snapshot)
+                if replaced != snapshot:
+                    manifest.record(store, replaced, menu)
+                    changed += 1
+                    changed_locations.add(snapshot.location)
+                if now() - last_progress >= progress_interval:
+                    last_progress = now()
+                    _log_progress(parsed, len(archived), changed, last_progress - started)
+    finally:
+        pool.close()
+        pool.join()
+        # Snapshots replaced before an error are committed, the derived tables must follow them
+        for location in changed_locations:
+            diff_chain.rebuild(store, location)
+            tenure.rebuild(store, location)
+        if changed:
+            search_index.rebuild(store)
+    _log_progress(parsed, len(archived), changed, now() - started)
+    if failed:
+        _log('{0} pages could not be reparsed'.format(failed), logging.WARN)
+    return parsed, changed
+
+
+def _parse_page(task):
+    i, name, scraped_at, page = task
+    try:
+        menu, parse_metrics = metrics.collect_call(parse_menu.parse_menu, zlib.decompress(page), name, scraped_at,
+                                                   True)
+    except Exception as e:
+        # One broken page must not stop the reparse of the others
+        return i, None, {}, '{0}: {1}'.format(e.__class__.__name__, str(e))
+    return i, menu, parse_metrics, None
+
+
+def _log_progress(parsed, total, changed, elapsed):
+    rate = parsed / elapsed if elapsed else 0
+    _log('Reparsed {0}/{1} pages, {2} changed, {3:.1f} pages/s'.format(parsed, total, changed, rate))
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Parse the archived menu pages again with the current parser.')
+    parser.add_argument('database', type=str, help='menu cache SQLite file')
+    parser.add_argument('--location', type=str, action='append', help='only reparse this location, may be repeated')
+    parser.add_argument('--processes', type=int, default=None, help='number of parsing processes')
+    parser.add_argument('--memo', type=str, help='parse memo SQLite file to consult and fill')
+    parser.add_argument('--profile', type=str, metavar='FILE',
+                        help='profile the run to FILE, parsing processes to FILE.<pid>')
+    args = parser.parse_args()
+
+    if args.memo:
+        parse_menu.memo = parse_memo.ParseMemo(args.memo)
+
+    with metrics.profiled(args.profile):
+        reparse(MenuCacheStore(args.database), args.location, args.processes)
+    _log('Parsed {0} beverages, {1} failed, {2} without details'.format(
+        parse_menu.beverages_parsed.total(), parse_menu.beverages_failed.total(), parse_menu.details_failed.total()))
@@ -0,0 +1,383 @@
+import argparse
+import logging
+import math
+import multiprocessing
+import Queue
+import random
+import signal
+import sys
+import threading
+from datetime import datetime, timedelta
+from time import time as now
+
+import diff_chain
+import metrics
+import notify
+import parse_memo
+import parse_menu
+import registry
+import scrape
+
+root_log = logging.getLogger()
+
+polls = metrics.counter('scheduler_polls_total', 'Scheduled scrapes, by location and result: changed, unchanged or '
+                                                 'error')
+poll_lag = metrics.timer('scheduler_lag_seconds', 'Time from when a scrape was due until a fetch thread started it')
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel. Items are dropped into one of slots buckets by the tick they are due at, advancing the wheel
+    only looks at the buckets of the ticks which passed, so scheduling and expiring are constant time however many
+    items are scheduled. Items due further out than a full turn of the wheel wait out the extra turns in their bucket.
+    """
+
+    def __init__(self, tick=1.0, slots=3600, start=None):
+        """
+        :param tick: Seconds per tick, items are due at the resolution of a tick.
+        :type tick: float
+        :param slots: Number of buckets, one turn of the wheel is tick * slots seconds.
+        :type slots: int
+        :param start: Time of the first tick, defaults to now.
+        :type start: float
+        """
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._position = 0
+        self._time = now() if start is None else start
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, item):
+        """
+        :param delay: Seconds from the wheel's current time until the item is due, at least one tick.
+        :type delay: float
+        :param item: Returned by advance once it is due.
+        """
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        slot = (self._position + ticks) % len(self._slots)
+        # Turns of the wheel to wait out before the item is due when its bucket comes around
+        self._slots[slot].append([(ticks - 1) // len(self._slots), item])
+        self._count += 1
+
+    def advance(self, until):
+        """
+        Move the wheel forward to a time.
+
+        :param until: Time to advance to.
+        :type until: float
+        :return: Items which became due, in the order they were due.
+        :rtype: list
+        """
+        due = []
+        while self._time + self.tick <= until:
+            self._time += self.tick
+            self._position = (self._position + 1) % len(self._slots)
+            waiting = []
+            for entry in self._slots[self._position]:
+                if entry[0]:
+                    entry[0] -= 1
+                    waiting.append(entry)
+                else:
+                    due.append(entry[1])
+            self._slots[self._position] = waiting
+        self._count -= len(due)
+        return due
+
+
+class LocationSchedule(object):
+    """
+    Polling state of one location.
+    """
+
+    def __init__(self, location, rate):
+        """
+        :param location: Stout location with name and url.
+        :type location: dict
+        :param rate: Estimated menu changes per second.
+        :type rate: float
+        """
+        self.location = location
+        self.rate = rate
+        self.errors = 0
+        self.interval = None
+        self.last_poll = None
+        self.due = None
+
+
+class Scheduler(object):
+    """
+    Scrape daemon which polls each location about as often as its menu changes.
+
+    The change rate of each location is an exponentially weighted moving average of the changes seen per second, seeded
+    from the diff chain. A location is polled every changes_per_poll / rate seconds, bounded by min_interval and
+    max_interval, with random jitter so locations do not synchronize. A location whose scrape fails, or returns an
+    empty page, backs off: it waits its normal interval after the first failure, doubling with each consecutive
+    failure up to max_interval, on top of the retries of each scrape.
+
+    All locations share one timer wheel and a bounded pool of fetch threads, a location is never scraped again before
+    its previous scrape finished.
+    """
+
+    def __init__(self, locations, min_interval=900, max_interval=86400, changes_per_poll=0.25, smoothing=86400,
+                 jitter=0.1, workers=4, processes=None, history_days=14, tick=1.0, slots=3600, seed=None):
+        """
+        :param locations: Stout locations with name and url.
+        :type locations: list
+        :param min_interval: Minimum seconds between scrapes of a location.
+        :type min_interval: float
+        :param max_interval: Maximum seconds between scrapes of a location.
+        :type max_interval: float
+        :param changes_per_poll: Expected menu changes between scrapes, lower polls more often.
+        :type changes_per_poll: float
+        :param smoothing: Seconds over which older change observations lose most of their weight.
+        :type smoothing: float
+        :param jitter: Fraction the interval is randomly lengthened or shortened by.
+        :type jitter: float
+        :param workers: Maximum number of menus fetched at once.
+        :type workers: int
+        :param processes: Number of parsing processes, defaults to the number of CPUs.
+        :type processes: int
+        :param history_days: Days of the diff chain the change rates are seeded from.
+        :type history_days: int
+        :param tick: Seconds per tick of the timer wheel.
+        :type tick: float
+        :param slots: Buckets of the timer wheel.
+        :type slots: int
+        :param seed: Random seed of the jitter.
+        :type seed: int
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.changes_per_poll = changes_per_poll
+        self.smoothing = smoothing
+        self.jitter = jitter
+        self.workers = workers
+        self.processes = processes
+        self.history_days = history_days
+        self.schedules = [LocationSchedule(location, 0.0) for location in locations]
+        self._rand = random.Random(seed)
+        self._wheel = TimerWheel(tick, slots)
+        self._jobs = Queue.Queue()
+        self._results = Queue.Queue()
+        self._stopping = threading.Event()
+
+    def seed_rates(self, store):
+        """
+        Estimate the change rate of every location from its diff chain over the last history_days. A location without
+        history starts at the rate of polling every min_interval, until its first scrapes say otherwise.
+
+        :param store: Menu cache store.
+        :type store: cache_store.MenuCacheStore
+        """
+        since = datetime.now() - timedelta(days=self.history_days)
+        for schedule in self.schedules:
+            start = None
+            changes = 0
+            for entry in diff_chain.iter_changes(store, schedule.location['name'], since):
+                if start is None:
+                    # The first menu of a location starts its history, it is not a change
+                    start = since if entry['previous'] else entry['scraped']
+                    if not entry['previous']:
+                        continue
+                if any(entry.get(change) for change in diff_chain.change_lists):
+                    changes += 1
+            if start is None:
+                schedule.rate = self.changes_per_poll / self.min_interval
+            else:
+                schedule.rate = changes / max(self.min_interval, (datetime.now() - start).total_seconds())
+            _log('{0} changes {1:.2f} times a day'.format(schedule.location['name'], schedule.rate * 86400))
+
+    def interval(self, schedule):
+        """
+        :return: Seconds until the next scrape of a location, before jitter.
+        :rtype: float
+        """
+        if schedule.rate <= 0:
+            interval = self.max_interval
+        else:
+            interval = max(self.min_interval, min(self.max_interval, self.changes_per_poll / schedule.rate))
+        if schedule.errors:
+            # Never poll a failing location more often than a healthy one
+            return min(self.max_interval, interval * 2 ** (schedule.errors - 1))
+        return interval
+
+    def observe(self, schedule, result, at):
+        """
+        Update a location's change rate and error count with the result of a scrape.
+
+        :param result: "changed", "unchanged" or "error".
+        :type result: str
+        :param at: Time the scrape finished.
+        :type at: float
+        """
+        if result == 'error':
+            schedule.errors += 1
+            return
+        schedule.errors = 0
+        if schedule.last_poll is not None:
+            elapsed = max(at - schedule.last_poll, 1.0)
+            # Weight the observation by the time it covers, so a short interval does not swing the rate
+            weight = 1 - math.exp(-elapsed / self.smoothing)
+            schedule.rate += weight * ((1.0 if result == 'changed' else 0.0) / elapsed - schedule.rate)
+        schedule.last_poll = at
+
+    def run(self, store, timeout=scrape.default_timeout, retries=scrape.default_retries,
+            backoff=scrape.default_backoff, metrics_path=None, metrics_interval=60):
+        """
+        Scrape locations as they come due until stop is called.
+
+        :param store: Menu cache store the change rates are seeded from.
+        :type store: cache_store.MenuCacheStore
+        :param timeout: Seconds to wait on each menu request.
+        :type timeout: float
+        :param retries: Number of times to retry a failed menu request.
+        :type retries: int
+        :param backoff: Seconds to wait before the first retry.
+        :type backoff: float
+        :param metrics_path: File to write the metrics to in Prometheus text format, every metrics_interval seconds
+        and on stop.
+        :type metrics_path: str
+        :param metrics_interval: Seconds between writes of the metrics.
+        :type metrics_interval: float
+        """
+        self.seed_rates(store)
+        # Spread the first scrapes over the first interval rather than fetching every location at once
+        started = now()
+        for schedule in self.schedules:
+            self._schedule(schedule, started, self._rand.uniform(0, self.interval(schedule)))
+
+        pool = multiprocessing.Pool(self.processes, metrics.reset)
+        threads = [threading.Thread(target=self._fetch, args=(pool, timeout, retries, backoff))
+                   for _ in range(max(1, min(self.workers, len(self.schedules))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        metrics_written = now()
+        try:
+            while not self._stopping.is_set():
+                for schedule in self._wheel.advance(now()):
+                    self._jobs.put(schedule)
+                self._reschedule_finished()
+                if metrics_path and now() - metrics_written >= metrics_interval:
+                    metrics.dump(metrics_path, text=True)
+                    metrics_written = now()
+                self._stopping.wait(self._wheel.tick)
+        finally:
+            # Drop scrapes which are due but not started, then stop the fetch threads
+            try:
+                while True:
+                    self._jobs.get_nowait()
+            except Queue.Empty:
+                pass
+            for _ in threads:
+                self._jobs.put(None)
+            for thread in threads:
+                thread.join()
+            pool.close()
+            pool.join()
+            if metrics_path:
+                metrics.dump(metrics_path, text=True)
+
+    def stop(self):
+        self._stopping.set()
+
+    def _fetch(self, pool, timeout, retries, backoff):
+        while True:
+            schedule = self._jobs.get()
+            if schedule is None:
+                return
+            poll_lag.observe(max(0.0, now() - schedule.due))
+            name = schedule.location['name']
+            try:
+                snapshot = scrape.scrape_location(schedule.location, pool, timeout, retries, backoff)
+                result = 'changed' if snapshot and _changed(snapshot) else 'unchanged'
+            except Exception as e:
+                _log('Failed to scrape {0}: {1}'.format(name, str(e)), logging.ERROR)
+                result = 'error'
+            polls.inc(location=name, result=result)
+            self._results.put((schedule, result, now()))
+
+    def _reschedule_finished(self):
+        while True:
+            try:
+                schedule, result, at = self._results.get_nowait()
+            except Queue.Empty:
+                return
+            self.observe(schedule, result, at)
+            self._schedule(schedule, at, self.interval(schedule) * self._rand.uniform(1 - self.jitter,
+                                                                                      1 + self.jitter))
+            _log('Next scrape of {0} in {1:.0f}s ({2})'.format(schedule.location['name'], schedule.interval, result),
+                 logging.DEBUG)
+
+    def _schedule(self, schedule, at, delay):
+        schedule.interval = delay
+        schedule.due = at + delay
+        self._wheel.schedule(schedule.due - now(), schedule)
+
+
+def _changed(snapshot):
+    # Identical menus share a blob, a page whose content hash changed may still parse to the same menu
+    previous = scrape.get_store().find_previous(snapshot)
+    return previous is None or previous.blob != snapshot.blob
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Scrape stout beer menus as often as each location changes.')
+    parser.add_argument('--min-interval', type=float, default=900, help='minimum seconds between scrapes')
+    parser.add_argument('--max-interval', type=float, default=86400, help='maximum seconds between scrapes')
+    parser.add_argument('--changes-per-poll', type=float, default=0.25,
+                        help='expected menu changes between scrapes, lower scrapes more often')
+    parser.add_argument('--jitter', type=float, default=0.1, help='fraction intervals are randomly varied by')
+    parser.add_argument('--workers', type=int, default=4, help='maximum number of menus fetched at once')
+    parser.add_argument('--processes', type=int, default=None, help='number of menu parsing processes')
+    parser.add_argument('--timeout', type=float, default=scrape.default_timeout, help='seconds to wait on each request')
+    parser.add_argument('--retries', type=int, default=scrape.default_retries, help='times to retry a failed request')
+    parser.add_argument('--backoff', type=float, default=scrape.default_backoff, help='seconds before the first retry')
+    parser.add_argument('--no-memo', action='store_true', help='parse every beverage title, ignoring the parse memo')
+    parser.add_argument('--deltas', action='store_true', help='store changed menus as deltas against the last menu')
+    parser.add_argument('--prerender', type=str, metavar='DIR', help='pre-render the menu view of new menus to DIR')
+    parser.add_argument('--metrics', type=str, metavar='FILE',
+                        help='write the metrics to FILE in Prometheus text format every minute')
+    notify.add_arguments(parser)
+    parser.add_argument('--config', type=str, default=registry.default_path, help='locations JSON file')
+    parser.add_argument('--location', action='append', metavar='NAME=URL',
+                        help='scrape this location instead of the configured ones, may be repeated')
+    args = parser.parse_args()
+
+    scrape.cache_store_deltas = args.deltas
+    scrape.prerender_dir = args.prerender
+    if not args.no_memo:
+        # Set before the parsing pool is forked, so the pool's processes use it too
+        parse_menu.memo = parse_memo.ParseMemo(scrape.parse_memo_path)
+    if args.location:
+        locations = [dict(zip(('name', 'url'), loc.split('=', 1))) for loc in args.location]
+    else:
+        locations = registry.load_locations(args.config)
+
+    scheduler = Scheduler(locations, args.min_interval, args.max_interval, args.changes_per_poll,
+                          jitter=args.jitter, workers=args.workers, processes=args.processes)
+    signal.signal(signal.SIGINT, lambda signum, frame: scheduler.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    scrape.notifier = notify.from_arguments(scrape.get_store(), args, args.timeout)
+    try:
+        scheduler.run(scrape.get_store(), args.timeout, args.retries, args.backoff, args.metrics)
+    finally:
+        if scrape.notifier:
+            # Deliver what the last scrapes queued
+            scrape.notifier.close()
+            _log('Sent {0} notifications, {1} failed'.format(scrape.notifier.sent, scrape.notifier.failed))
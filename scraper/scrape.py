@@ -1,143 +1,414 @@
+import argparse
+import functools
+import hashlib
+import httplib
+import multiprocessing
 import os
-import json
 import logging
+import Queue
+import socket
+import threading
 import urllib2
-from datetime import datetime, timedelta
+from datetime import datetime
+from time import sleep
 import sys
 import re
 
+import cache_store
+import diff_chain
+import identity
+import manifest
+import metrics
+import notify
+import parse_memo
 import parse_menu
+import prerender
+import registry
+import search_index
+import tenure
 
 
 root_log = logging.getLogger()
-root_log.setLevel(logging.INFO)
-
-locations = [
-    {
-        'name': 'Hollywood',
-        'url': 'http://www.stoutburgersandbeers.com/hollywood-beer-menu/'
-    },
-    {
-        'name': 'Studio City',
-        'url': 'http://www.stoutburgersandbeers.com/studio-city-beer-menu/'
-    },
-    {
-        'name': 'Santa Monica',
-        'url': 'http://www.stoutburgersandbeers.com/santa-monica-beer-menu/'
-    },
-]
+
 # Root cache directory
 cache_root = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'menu_cache')
+# SQLite file the parsed menus are stored in, STOUT_CACHE_STORE overrides it e.g. for the web app
+cache_store_path = os.environ.get('STOUT_CACHE_STORE', os.path.join(cache_root, 'menu_cache.db'))
+# SQLite file of the memo of parsed beverage titles
+parse_memo_path = os.path.join(cache_root, 'parse_memo.db')
+# Store changed menus as deltas against the previous menu of the location, with a full copy every checkpoint_interval
+cache_store_deltas = False
+cache_store_checkpoint_interval = 7
+_store = None
+# notify.Notifier cache_menu hands the changes of each new menu to, notifications are off when None
+notifier = None
+# Directory to pre-render the menu view of each new menu to, for a reverse proxy to serve
+prerender_dir = None
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS fetch_state (
+        location TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT
+    )''',
+]
+
+# Seconds to wait on a menu request before giving up
+default_timeout = 30
+# Number of times a failed menu request is retried
+default_retries = 3
+# Seconds to wait before the first retry, doubled for each retry after that
+default_backoff = 1.0
 
+fetch_seconds = metrics.timer('scrape_fetch_seconds', 'Time to download a menu page including retries, by location')
+fetch_bytes = metrics.counter('scrape_fetch_bytes_total', 'Bytes of menu pages downloaded, by location')
+fetch_retries = metrics.counter('scrape_fetch_retries_total', 'Menu page requests retried, by location')
+parse_seconds = metrics.timer('scrape_parse_seconds', 'Time to parse a menu page, by location')
+scrapes = metrics.counter('scrape_menus_total', 'Menus scraped, by location and result: cached, unchanged, '
+                                                'not_modified or failed')
 
-def scrape_location(location):
+
+class FetchException(Exception):
+    pass
+
+
+def scrape_location(location, pool=None, timeout=default_timeout, retries=default_retries, backoff=default_backoff,
+                    force=False, fence=None):
     """
     Scrape the stout menu, parse it into JSON, and cache it by date.
 
+    The validators of the last response are saved for each location in the menu cache store. A menu which the server
+    reports as not modified, or whose content hash is that of the page the latest menu was parsed from, is not parsed
+    or cached again.
+
     :param location: Stout location to scrape.
     :type location: dict
-    :return:
-    :rtype:
+    :param pool: Process pool to parse the menu in, parsed in this process if not provided.
+    :type pool: multiprocessing.Pool
+    :param timeout: Seconds to wait on the menu request.
+    :type timeout: float
+    :param retries: Number of times to retry a failed menu request.
+    :type retries: int
+    :param backoff: Seconds to wait before the first retry.
+    :type backoff: float
+    :param force: Download and cache the menu even if it has not changed.
+    :type force: bool
+    :param fence: Checked in the transaction caching the menu, see cache_menu, and with write=False in those saving
+    the fetch state and extending tenures, so a scraper whose lease was reclaimed writes nothing.
+    :type fence: callable
+    :return: The cached snapshot, None if the menu was unchanged.
+    :rtype: cache_store.Snapshot
+    :raises FetchException: If the menu could not be retrieved or was empty.
     """
     _log('Scraping {0} - {1}'.format(location['name'], location['url']), logging.INFO)
-    menu_html = urllib2.urlopen(location['url']).read()
-    if menu_html:
+    fetch_state = {} if force else get_fetch_state(location['name'])
+    check = functools.partial(fence, write=False) if fence else None
+    try:
+        with fetch_seconds.time(location=location['name']):
+            menu_html, validators = fetch_menu(location['url'], timeout, retries, backoff, fetch_state,
+                                               location['name'])
+    except FetchException:
+        scrapes.inc(location=location['name'], result='failed')
+        raise
+    if menu_html is None:
+        _log('Menu for {0} not modified'.format(location['name']), logging.INFO)
+        tenure.touch(get_store(), location['name'], datetime.now(), check)
+        scrapes.inc(location=location['name'], result='not_modified')
+    elif menu_html:
         _log('Read {0} bytes'.format(len(menu_html)), logging.INFO)
+        fetch_bytes.inc(len(menu_html), location=location['name'])
+        content_hash = hashlib.sha1(menu_html).hexdigest()
+        if content_hash == fetch_state.get('hash'):
+            _log('Menu for {0} unchanged since last scrape'.format(location['name']), logging.INFO)
+            tenure.touch(get_store(), location['name'], datetime.now(), check)
+            save_fetch_state(location['name'], validators, check)
+            scrapes.inc(location=location['name'], result='unchanged')
+            return None
         scrape_time = datetime.now()
-        menu_json = parse_menu.parse_menu(menu_html, location['name'], scrape_time)
-        cache_menu(menu_json, location, scrape_time)
+        with parse_seconds.time(location=location['name']):
+            if pool:
+                # The pool process hands back the metrics it recorded while parsing along with the menu
+                menu_json, parse_metrics = pool.apply(metrics.collect_call, (parse_menu.parse_menu, menu_html,
+                                                                             location['name'], scrape_time, True))
+                metrics.merge(parse_metrics)
+            else:
+                menu_json = parse_menu.parse_menu(menu_html, location['name'], scrape_time, streaming=True)
+        snapshot = cache_menu(menu_json, location, scrape_time, menu_html, fence)
+        # Only remember the validators once the page has been cached, so a failed parse is retried next time
+        save_fetch_state(location['name'], validators, check)
+        scrapes.inc(location=location['name'], result='cached')
+        return snapshot
     else:
-        _log('Unable to retrieve menu from {0}'.format(location['url']), logging.ERROR)
+        scrapes.inc(location=location['name'], result='failed')
+        raise FetchException('Empty menu from {0}'.format(location['url']))
 
 
-def cache_menu(menu, location, time):
+def scrape_locations(locations, workers=4, processes=None, timeout=default_timeout, retries=default_retries,
+                     backoff=default_backoff, force=False):
     """
-    Cache the parsed menu JSON on the filesystem organized by date.
+    Scrape several locations concurrently.
+
+    Menus are fetched by a bounded pool of threads. Parsing is CPU bound so it is handed off to a process pool, which
+    keeps a large menu from stalling the other fetches.
+
+    :param locations: Stout locations to scrape.
+    :type locations: list
+    :param workers: Maximum number of menus fetched at once.
+    :type workers: int
+    :param processes: Number of parsing processes, defaults to the number of CPUs.
+    :type processes: int
+    :param timeout: Seconds to wait on each menu request.
+    :type timeout: float
+    :param retries: Number of times to retry a failed menu request.
+    :type retries: int
+    :param backoff: Seconds to wait before the first retry.
+    :type backoff: float
+    :param force: Download and cache menus even if they have not changed.
+    :type force: bool
+    :return: The cached snapshot keyed by location name, None for locations which failed or were unchanged.
+    :rtype: dict
+    """
+    results = {}
+    jobs = Queue.Queue()
+    for location in locations:
+        jobs.put(location)
+
+    # Parsing processes start with an empty registry, so they never report metrics of this process
+    pool = multiprocessing.Pool(processes, metrics.reset)
+
+    def worker():
+        while True:
+            try:
+                location = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[location['name']] = scrape_location(location, pool, timeout, retries, backoff, force)
+            except Exception as e:
+                _log('Failed to scrape {0}: {1}'.format(location['name'], str(e)), logging.ERROR)
+                results[location['name']] = None
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(locations))))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def fetch_menu(url, timeout=default_timeout, retries=default_retries, backoff=default_backoff, fetch_state=None,
+               location=None):
+    """
+    Download a menu page, retrying with exponential backoff on network errors and server errors.
+
+    When the ETag/Last-Modified of a previous response are given the request is made conditional.
+
+    :param url: URL of the menu page.
+    :type url: str
+    :param timeout: Seconds to wait on the request.
+    :type timeout: float
+    :param retries: Number of times to retry a failed request.
+    :type retries: int
+    :param backoff: Seconds to wait before the first retry, doubled for each retry after that.
+    :type backoff: float
+    :param fetch_state: Validators from the previous response, see get_fetch_state.
+    :type fetch_state: dict
+    :param location: Stout location name the retries are counted for, defaults to the URL.
+    :type location: str
+    :return: Menu HTML, None if not modified, and the validators of the response.
+    :rtype: tuple
+    """
+    fetch_state = fetch_state or {}
+    request = urllib2.Request(url)
+    if fetch_state.get('etag'):
+        request.add_header('If-None-Match', fetch_state['etag'])
+    if fetch_state.get('last_modified'):
+        request.add_header('If-Modified-Since', fetch_state['last_modified'])
+
+    attempt = 0
+    while True:
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+            validators = {
+                'etag': response.info().getheader('ETag'),
+                'last_modified': response.info().getheader('Last-Modified')
+            }
+            return response.read(), validators
+        except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+            if isinstance(e, urllib2.HTTPError) and e.code == 304:
+                return None, dict(fetch_state)
+            # Client errors will not fix themselves, only retry server errors and throttling
+            if isinstance(e, urllib2.HTTPError) and e.code < 500 and e.code != 429:
+                raise FetchException('Request for {0} failed: {1}'.format(url, str(e)))
+            attempt += 1
+            if attempt > retries:
+                raise FetchException('Request for {0} failed after {1} attempts: {2}'.format(url, attempt, str(e)))
+            delay = backoff * 2 ** (attempt - 1)
+            fetch_retries.inc(location=location or url)
+            _log('Request for {0} failed ({1}), retrying in {2}s'.format(url, str(e), delay), logging.WARN)
+            sleep(delay)
+
+
+def get_fetch_state(location):
+    """
+    Get the validators saved from the last response for a location and the content hash of the page its latest menu
+    was parsed from. Both are kept in the menu cache store, so every node scraping the location sees the same state.
+
+    :param location: Stout location name.
+    :type location: str
+    :return: Dict with etag, last_modified and hash, empty if the location has not been scraped.
+    :rtype: dict
+    """
+    store = get_store()
+    state = {}
+    row = store.ensure_schema(schema).execute('SELECT etag, last_modified FROM fetch_state WHERE location = ?',
+                                              (cache_store.location_key(location),)).fetchone()
+    if row:
+        state['etag'], state['last_modified'] = row
+    page = store.latest_page(location)
+    if page:
+        state['hash'] = page
+    return state
+
+
+def save_fetch_state(location, state, fence=None):
+    """
+    Save the validators of the last response for a location. The content hash is not saved, it is the hash of the
+    archived page.
+
+    :param location: Stout location name.
+    :type location: str
+    :param state: Dict with etag and last_modified.
+    :type state: dict
+    :param fence: Called with the connection first thing in the transaction, raising rolls the write back.
+    :type fence: callable
+    """
+    with get_store().ensure_schema(schema) as connection:
+        if fence:
+            fence(connection)
+        connection.execute('INSERT OR REPLACE INTO fetch_state (location, etag, last_modified) VALUES (?, ?, ?)',
+                           (cache_store.location_key(location), state.get('etag'), state.get('last_modified')))
+
+
+def cache_menu(menu, location, time, html=None, fence=None):
+    """
+    Resolve the beverages of the parsed menu to canonical identities, cache the menu JSON and the page it was parsed
+    from in the menu cache store, then record it with record_menu.
 
     :param menu: Parsed menu JSON.
-    :type menu: str
+    :type menu: dict
     :param location: Stout location menu is for.
     :type location: dict
     :param time: When menu was downloaded.
     :type time: datetime
-    :return: Path to the cached file.
-    :rtype: str
+    :param html: Menu page HTML the menu was parsed from, archived so it can be parsed again.
+    :type html: str
+    :param fence: Called with the store connection in the transaction writing the snapshot and page, raises to abort
+    it before anything is cached, see MenuCacheStore.put.
+    :type fence: callable
+    :return: The cached snapshot.
+    :rtype: cache_store.Snapshot
     """
-    # Name files menu_YYYY-MM-DD_location.json
-    file_path = _build_cache_path(location['name'], time=time)
-    # Organize cache into directories by location/year/month
-    directory = os.path.dirname(file_path)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    # Write file
-    with open(file_path, 'w') as fh:
-        fh.write(json.dumps(menu))
-    return file_path
+    store = get_store()
+    identity.resolve(store, menu)
+    snapshot = store.put(location['name'], time, menu, fence=fence, html=html)
+    record_menu(snapshot, menu, location['name'])
+    return snapshot
+
+
+def record_menu(snapshot, menu, name):
+    """
+    Record the changes of a cached menu since the previous menu and add it to the manifest, search index and tenures.
+    The changes are queued for notification when a notifier is set, and the menu view is pre-rendered when
+    prerender_dir is set. Recording a snapshot again repairs what a scraper which died after caching it missed.
+
+    :param snapshot: The cached snapshot.
+    :type snapshot: cache_store.Snapshot
+    :param menu: Parsed menu of the snapshot.
+    :type menu: dict
+    :param name: Stout location name.
+    :type name: str
+    """
+    store = get_store()
+    _diff = diff_chain.record(store, snapshot)
+    manifest.record(store, snapshot, menu)
+    search_index.record(store, snapshot, menu)
+    tenure.record(store, snapshot, menu)
+    if prerender_dir:
+        prerender.render_snapshot(snapshot, menu, prerender_dir)
+    if notifier and _diff:
+        notifier.submit(name, _diff)
+
+
+def get_store():
+    """
+    Get the menu cache store, opened on first use.
+
+    :rtype: cache_store.MenuCacheStore
+    """
+    global _store
+    if _store is None:
+        _store = cache_store.MenuCacheStore(cache_store_path, cache_store_deltas, cache_store_checkpoint_interval)
+    return _store
 
 
 def get_cache_near(location, time, lean='new'):
-    cache_path = _build_cache_path(location, time=time)
-    i = 0
-    while not os.path.exists(cache_path):
-        i += 1
-        if lean == 'new':
-            time = time + timedelta(days=1)
-        else:
-            time = time - timedelta(days=1)
-        cache_path = _build_cache_path(location, time=time)
-        if i > 100:
-            # Unable to find nearby cache, return oldest/newest
-            return get_cache_extreme(location, lean)
-    return json.load(open(cache_path))
+    """
+    Get the menu nearest to a time, see MenuCacheStore.find_near.
+
+    :return: Parsed menu, None if the location has not been cached.
+    :rtype: dict
+    """
+    return _load(get_store().find_near(location, time, lean))
 
 
 def get_cache_extreme(location, extreme='new'):
-    location = _safe_location(location)
-    year = min(os.listdir(cache_root))
-    year_dir = os.path.join(cache_root, year)
-    month = min(os.listdir(year_dir))
-    month_dir = os.path.join(year_dir, month)
-    regex = re.compile('.*[0-9]{4}-[0-9]{2}-([0-9]{2})_' + location + '.json')
-    days = []
-    for menu_file in os.listdir(month_dir):
-        matches = regex.match(menu_file)
-        if matches:
-            days.append(matches.group(1))
-    if extreme == 'new':
-        day = max(days)
-    else:
-        day = min(days)
-    return get_cache(location=location, year=year, month=month, day=day)
+    """
+    Get the newest or oldest menu of a location, see MenuCacheStore.find_extreme.
+
+    :return: Parsed menu, None if the location has not been cached.
+    :rtype: dict
+    """
+    return _load(get_store().find_extreme(location, extreme))
 
 
 def get_cache(name=None, location=None, time=None, year=None, month=None, day=None):
+    """
+    Get the last menu cached on a day, see find_cache.
+
+    :return: Parsed menu, None if the location was not cached that day.
+    :rtype: dict
+    """
+    return _load(find_cache(name, location, time, year, month, day))
+
+
+def find_cache(name=None, location=None, time=None, year=None, month=None, day=None):
+    """
+    Find the last snapshot cached on a day. The day is either a name such as menu_2014-08-25_studio_city, a time, or
+    the year, month and day.
+
+    :return: Snapshot, None if the location was not cached that day.
+    :rtype: cache_store.Snapshot
+    """
     if name:
         regex = re.compile('.*([0-9]{4})-([0-9]{2})-([0-9]{2})_(.*)')
         matches = regex.match(name)
-        cache_path = _build_cache_path(matches.group(4), year=matches.group(1), month=matches.group(2),
-                                       day=matches.group(3))
-    else:
-        if time:
-            cache_path = _build_cache_path(location=location, time=time)
-        else:
-            cache_path = _build_cache_path(location=location, year=year, month=month, day=day)
-
-    return json.load(open(cache_path))
+        if not matches:
+            return None
+        location = matches.group(4)
+        time = datetime(int(matches.group(1)), int(matches.group(2)), int(matches.group(3)))
+    elif not time:
+        time = datetime(int(year), int(month), int(day))
 
-
-def _build_cache_path(location, year=None, month=None, day=None, time=None):
-    location = _safe_location(location)
-    if time:
-        _dir = os.path.join(time.strftime('%Y'), time.strftime('%m'))
-        filename = 'menu_{0}_{1}.json'.format(time.strftime('%Y-%m-%d'), location)
-    else:
-        _dir = os.path.join(year, month)
-        filename = 'menu_{0}-{1}-{2}_{3}.json'.format(year, month, day, location)
-    return os.path.join(cache_root, _dir, filename)
+    return get_store().find_day(location, time)
 
 
-def _safe_location(location):
-    return location.replace(' ', '_').lower()
+def _load(snapshot):
+    return get_store().load(snapshot) if snapshot else None
 
 
 def _log(message, level=logging.INFO):
@@ -150,6 +421,57 @@ if __name__ == '__main__':
     sh.setLevel(logging.INFO)
     sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Scrape stout beer menus and cache them by date.')
+    parser.add_argument('--concurrent', action='store_true', help='scrape all locations in parallel')
+    parser.add_argument('--workers', type=int, default=4, help='maximum number of menus fetched at once')
+    parser.add_argument('--processes', type=int, default=None, help='number of menu parsing processes')
+    parser.add_argument('--timeout', type=float, default=default_timeout, help='seconds to wait on each request')
+    parser.add_argument('--retries', type=int, default=default_retries, help='times to retry a failed request')
+    parser.add_argument('--backoff', type=float, default=default_backoff, help='seconds before the first retry')
+    parser.add_argument('--force', action='store_true', help='cache menus even if they have not changed')
+    parser.add_argument('--deltas', action='store_true', help='store changed menus as deltas against the last menu')
+    parser.add_argument('--no-memo', action='store_true', help='parse every beverage title, ignoring the parse memo')
+    parser.add_argument('--prerender', type=str, metavar='DIR', help='pre-render the menu view of new menus to DIR')
+    parser.add_argument('--metrics', type=str, metavar='FILE',
+                        help='write the metrics of the run to FILE in Prometheus text format')
+    parser.add_argument('--profile', type=str, metavar='FILE',
+                        help='profile the run to FILE, parsing processes to FILE.<pid>')
+    notify.add_arguments(parser)
+    parser.add_argument('--config', type=str, default=registry.default_path, help='locations JSON file')
+    parser.add_argument('--location', action='append', metavar='NAME=URL',
+                        help='scrape this location instead of the configured ones, may be repeated')
+    args = parser.parse_args()
+
+    cache_store_deltas = args.deltas
+    prerender_dir = args.prerender
+    if not args.no_memo:
+        # Set before the parsing pool is forked, so the pool's processes use it too
+        parse_menu.memo = parse_memo.ParseMemo(parse_memo_path)
+    if args.location:
+        locations = [dict(zip(('name', 'url'), loc.split('=', 1))) for loc in args.location]
+    else:
+        locations = registry.load_locations(args.config)
+
+    notifier = notify.from_arguments(get_store(), args, args.timeout)
+
+    with metrics.profiled(args.profile):
+        if args.concurrent:
+            scrape_locations(locations, args.workers, args.processes, args.timeout, args.retries, args.backoff,
+                             args.force)
+        else:
+            for loc in locations:
+                try:
+                    scrape_location(loc, timeout=args.timeout, retries=args.retries, backoff=args.backoff,
+                                    force=args.force)
+                except FetchException as e:
+                    _log(str(e), logging.ERROR)
+
+    if notifier:
+        notifier.close()
+        _log('Sent {0} notifications, {1} failed'.format(notifier.sent, notifier.failed), logging.INFO)
 
-    for loc in locations:
-        scrape_location(loc)
+    if args.metrics:
+        metrics.dump(args.metrics, text=True)
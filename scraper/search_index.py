@@ -0,0 +1,200 @@
+import argparse
+import json
+import logging
+import sys
+
+from cache_store import MenuCacheStore, location_key
+from menu_diff import beverage_key, tokenize
+
+root_log = logging.getLogger()
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS search_beverages (
+        id INTEGER PRIMARY KEY,
+        key TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        details TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS search_terms (
+        term TEXT NOT NULL,
+        field TEXT NOT NULL,
+        beverage INTEGER NOT NULL REFERENCES search_beverages (id),
+        PRIMARY KEY (term, field, beverage)
+    )''',
+    'CREATE INDEX IF NOT EXISTS search_terms_beverage ON search_terms (beverage)',
+    '''CREATE TABLE IF NOT EXISTS search_sightings (
+        beverage INTEGER NOT NULL REFERENCES search_beverages (id),
+        location TEXT NOT NULL,
+        first_seen TEXT NOT NULL,
+        last_seen TEXT NOT NULL,
+        PRIMARY KEY (beverage, location)
+    )''',
+]
+
+# Details fields which are indexed besides the full title, the winery of a wine is indexed as its brewery
+indexed_fields = {
+    'brewery': 'brewery',
+    'winery': 'brewery',
+    'style': 'style',
+    'location': 'location',
+    'year': 'year'
+}
+
+
+def record(store, snapshot, menu):
+    """
+    Add the beverages of a newly cached menu to the index and update when they were first and last seen.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param snapshot: Snapshot of the menu.
+    :type snapshot: cache_store.Snapshot
+    :param menu: Parsed menu.
+    :type menu: dict
+    """
+    connection = store.ensure_schema(schema)
+    with connection:
+        for section in menu['sections']:
+            for beverage in section['beverages']:
+                beverage_id = _index_beverage(connection, beverage)
+                connection.execute('INSERT OR IGNORE INTO search_sightings (beverage, location, first_seen, last_seen) '
+                                   'VALUES (?, ?, ?, ?)', (beverage_id, snapshot.location, snapshot.scraped,
+                                                           snapshot.scraped))
+                connection.execute('UPDATE search_sightings SET first_seen = MIN(first_seen, ?), '
+                                   'last_seen = MAX(last_seen, ?) WHERE beverage = ? AND location = ?',
+                                   (snapshot.scraped, snapshot.scraped, beverage_id, snapshot.location))
+
+
+def rebuild(store):
+    """
+    Rebuild the index from every cached menu, used when the cached menus were replaced.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :return: Number of menus indexed.
+    :rtype: int
+    """
+    connection = store.ensure_schema(schema)
+    with connection:
+        for table in ('search_sightings', 'search_terms', 'search_beverages'):
+            connection.execute('DELETE FROM ' + table)
+    count = 0
+    for location in store.locations():
+        for snapshot in store.snapshots(location):
+            record(store, snapshot, store.load(snapshot))
+            count += 1
+    return count
+
+
+def search(store, query, stout_location=None, limit=50, **fields):
+    """
+    Find beverages by the words in their title and details.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param query: Words which must all appear in the beverage title or details.
+    :type query: str
+    :param stout_location: Only return beverages seen at this Stout location.
+    :type stout_location: str
+    :param limit: Maximum number of beverages returned.
+    :type limit: int
+    :param fields: Words which must appear in a specific field, brewery, style, location (where the beverage is from)
+    or year.
+    :return: Matching beverages with name, details and a list of locations with the first_seen and last_seen times,
+    most recently seen first.
+    :rtype: list
+    """
+    terms = [(term, None) for term in tokenize(query)]
+    for field, value in fields.iteritems():
+        if value:
+            terms.extend((term, field) for term in tokenize(value))
+    if not terms:
+        return []
+
+    queries = []
+    params = []
+    for term, field in terms:
+        if field:
+            queries.append('SELECT beverage FROM search_terms WHERE term = ? AND field = ?')
+            params.extend((term, field))
+        else:
+            queries.append('SELECT beverage FROM search_terms WHERE term = ?')
+            params.append(term)
+    sql = 'SELECT beverage, location, first_seen, last_seen FROM search_sightings WHERE beverage IN (' + \
+          ' INTERSECT '.join(queries) + ')'
+    if stout_location:
+        sql += ' AND location = ?'
+        params.append(location_key(stout_location))
+
+    connection = store.ensure_schema(schema)
+    results = {}
+    for beverage_id, _location, first_seen, last_seen in connection.execute(sql, params):
+        result = results.setdefault(beverage_id, {'id': beverage_id, 'locations': []})
+        result['locations'].append({'location': _location, 'first_seen': first_seen, 'last_seen': last_seen})
+    for result in results.itervalues():
+        result['locations'].sort(key=lambda sighting: sighting['last_seen'], reverse=True)
+    results = sorted(results.itervalues(), key=lambda r: r['locations'][0]['last_seen'], reverse=True)[:limit]
+
+    for result in results:
+        name, details = connection.execute('SELECT name, details FROM search_beverages WHERE id = ?',
+                                           (result['id'],)).fetchone()
+        result['name'] = name
+        result['details'] = json.loads(details) if details else None
+    return results
+
+
+def _index_beverage(connection, beverage):
+    key = beverage_key(beverage)
+    details = json.dumps(beverage['details'], sort_keys=True) if beverage.get('details') else None
+    row = connection.execute('SELECT id, name, details FROM search_beverages WHERE key = ?', (key,)).fetchone()
+    if row and row[1] == beverage['name'] and row[2] == details:
+        return row[0]
+    if row:
+        # Keep the latest title and details, and only their terms
+        connection.execute('UPDATE search_beverages SET name = ?, details = ? WHERE id = ?',
+                           (beverage['name'], details, row[0]))
+        connection.execute('DELETE FROM search_terms WHERE beverage = ?', (row[0],))
+        beverage_id = row[0]
+    else:
+        # Another scraper thread may index the beverage between the check and the insert, which then waits for its
+        # transaction and is ignored. The row exists from then on, so the beverage is indexed again as an update.
+        cursor = connection.execute('INSERT OR IGNORE INTO search_beverages (key, name, details) VALUES (?, ?, ?)',
+                                    (key, beverage['name'], details))
+        if cursor.rowcount != 1:
+            return _index_beverage(connection, beverage)
+        beverage_id = cursor.lastrowid
+    terms = set((term, 'name') for term in tokenize(beverage['name']))
+    for field, value in (beverage.get('details') or {}).iteritems():
+        if field in indexed_fields and value:
+            terms.update((term, indexed_fields[field]) for term in tokenize(value))
+    connection.executemany('INSERT OR IGNORE INTO search_terms (term, field, beverage) VALUES (?, ?, ?)',
+                           [(term, field, beverage_id) for term, field in terms])
+    return beverage_id
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Search every beverage ever cached, or rebuild the search index.')
+    parser.add_argument('database', type=str, help='menu cache SQLite file')
+    parser.add_argument('query', type=str, nargs='?', help='words to search for')
+    parser.add_argument('--location', type=str, help='only search this Stout location')
+    parser.add_argument('--origin', type=str, help='words of where the beverage is from')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the index from the cached menus')
+    args = parser.parse_args()
+
+    cache = MenuCacheStore(args.database)
+    if args.rebuild:
+        _log('Indexed {0} menus'.format(rebuild(cache)))
+    if args.query:
+        print json.dumps(search(cache, args.query, args.location, location=args.origin), indent=2)
@@ -8,4 +8,8 @@ setup(name='StoutBeerNotifier',
           'unidecode',
           'Flask'
       ],
+      extras_require={
+          # Compact encoding of the web API
+          'msgpack': ['msgpack'],
+      },
 )
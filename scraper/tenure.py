@@ -0,0 +1,242 @@
+import argparse
+import json
+import logging
+import sys
+
+from cache_store import MenuCacheStore, date_format, location_key, parse_scraped
+from menu_diff import beverage_key
+
+root_log = logging.getLogger()
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS tenures (
+        id INTEGER PRIMARY KEY,
+        location TEXT NOT NULL,
+        beverage TEXT NOT NULL,
+        section TEXT NOT NULL,
+        name TEXT NOT NULL,
+        first_seen TEXT NOT NULL,
+        last_seen TEXT NOT NULL,
+        open INTEGER NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS tenures_location_open ON tenures (location, open)',
+    'CREATE INDEX IF NOT EXISTS tenures_location_beverage ON tenures (location, beverage)',
+    # Last time the menu of each snapshot was still current, unchanged scrapes cache no snapshot of their own
+    '''CREATE TABLE IF NOT EXISTS tenure_checks (
+        location TEXT NOT NULL,
+        scraped TEXT NOT NULL,
+        checked TEXT NOT NULL,
+        PRIMARY KEY (location, scraped)
+    )''',
+]
+
+# Tenure of an interval in days
+tenure_days = 'julianday(last_seen) - julianday(first_seen)'
+
+
+def record(store, snapshot, menu):
+    """
+    Extend the open interval of every beverage still on the menu, close the intervals of beverages which are gone and
+    open intervals for new beverages.
+
+    Menus must be recorded in the order they were scraped, a menu older than the last one recorded is skipped and the
+    location has to be rebuilt. Recording the last menu again changes nothing.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param snapshot: Snapshot of the menu.
+    :type snapshot: cache_store.Snapshot
+    :param menu: Parsed menu.
+    :type menu: dict
+    """
+    connection = store.ensure_schema(schema)
+    latest = connection.execute('SELECT MAX(last_seen) FROM tenures WHERE location = ?',
+                                (snapshot.location,)).fetchone()[0]
+    if latest and snapshot.scraped < latest:
+        _log('Menu of {0} scraped {1} is older than the tenures, rebuild them'
+             .format(snapshot.location, snapshot.scraped), logging.WARN)
+        return
+
+    present = {}
+    for section in menu['sections']:
+        for beverage in section['beverages']:
+            present[(beverage_key(beverage), section['name'])] = beverage['name']
+
+    with connection:
+        rows = connection.execute('SELECT id, beverage, section FROM tenures WHERE location = ? AND open = 1',
+                                  (snapshot.location,)).fetchall()
+        extended = []
+        closed = []
+        for tenure_id, key, section in rows:
+            if present.pop((key, section), None) is not None:
+                extended.append((snapshot.scraped, tenure_id))
+            else:
+                closed.append((tenure_id,))
+        connection.executemany('UPDATE tenures SET last_seen = ? WHERE id = ?', extended)
+        connection.executemany('UPDATE tenures SET open = 0 WHERE id = ?', closed)
+        connection.executemany('INSERT INTO tenures (location, beverage, section, name, first_seen, last_seen, open) '
+                               'VALUES (?, ?, ?, ?, ?, ?, 1)',
+                               [(snapshot.location, key, section, name, snapshot.scraped, snapshot.scraped)
+                                for (key, section), name in present.iteritems()])
+
+
+def touch(store, location, time, fence=None):
+    """
+    Extend the open intervals of a location to a scrape which found its menu unchanged, so tenures last until the
+    latest scrape rather than the latest change.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param location: Stout location name.
+    :type location: str
+    :param time: When the unchanged menu was downloaded.
+    :type time: datetime
+    :param fence: Called with the connection first thing in the transaction, raising rolls the write back.
+    :type fence: callable
+    """
+    latest = store.find_extreme(location, 'new')
+    checked = time.strftime(date_format)
+    if latest is None or checked <= latest.scraped:
+        return
+    with store.ensure_schema(schema) as connection:
+        if fence:
+            fence(connection)
+        connection.execute('INSERT OR REPLACE INTO tenure_checks (location, scraped, checked) VALUES (?, ?, ?)',
+                           (latest.location, latest.scraped, checked))
+        _extend(connection, latest.location, checked)
+
+
+def rebuild(store, location):
+    """
+    Recompute the tenures of a location from its cached menus and the unchanged scrapes after each.
+
+    :return: Number of menus recorded.
+    :rtype: int
+    """
+    connection = store.ensure_schema(schema)
+    with connection:
+        connection.execute('DELETE FROM tenures WHERE location = ?', (location_key(location),))
+    checks = dict(connection.execute('SELECT scraped, checked FROM tenure_checks WHERE location = ?',
+                                     (location_key(location),)))
+    count = 0
+    for snapshot in store.snapshots(location):
+        record(store, snapshot, store.load(snapshot))
+        if snapshot.scraped in checks:
+            with connection:
+                _extend(connection, snapshot.location, checks[snapshot.scraped])
+        count += 1
+    return count
+
+
+def _extend(connection, location, checked):
+    connection.execute('UPDATE tenures SET last_seen = ? WHERE location = ? AND open = 1 AND last_seen < ?',
+                       (checked, location, checked))
+
+
+def section_stats(store, location, start=None, end=None):
+    """
+    Turnover of each section, to see which taps change fastest.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param location: Stout location name.
+    :type location: str
+    :param start: Only count beverages first seen at or after this time.
+    :type start: datetime
+    :param end: Only count beverages first seen at or before this time.
+    :type end: datetime
+    :return: Per section the number of beverages added, beverages added per day, and the average tenure in days of
+    the beverages which are no longer on the menu.
+    :rtype: list
+    """
+    where, params = _range(location, start, end)
+    connection = store.ensure_schema(schema)
+    rows = connection.execute('SELECT section, COUNT(*), MIN(first_seen), MAX(last_seen), '
+                              'AVG(CASE WHEN open = 0 THEN ' + tenure_days + ' END) '
+                              'FROM tenures WHERE ' + where + ' GROUP BY section ORDER BY section', params)
+    stats = []
+    for section, added, first, last, average in rows:
+        days = (parse_scraped(last) - parse_scraped(first)).total_seconds() / 86400
+        stats.append({
+            'section': section,
+            'added': added,
+            'added_per_day': added / days if days else None,
+            'average_tenure': average
+        })
+    return stats
+
+
+def beverage_tenure(store, location, beverage):
+    """
+    How long a beverage lasts at a location.
+
+    :param store: Menu cache store.
+    :type store: cache_store.MenuCacheStore
+    :param location: Stout location name.
+    :type location: str
+    :param beverage: Beverage dict from a menu.
+    :type beverage: dict
+    :return: Number of times it was on the menu, average and longest tenure in days, and whether it is on the menu
+    now.
+    :rtype: dict
+    """
+    connection = store.ensure_schema(schema)
+    count, average, longest, current = connection.execute(
+        'SELECT COUNT(*), AVG(' + tenure_days + '), MAX(' + tenure_days + '), MAX(open) FROM tenures '
+        'WHERE location = ? AND beverage = ?', (location_key(location), beverage_key(beverage))).fetchone()
+    return {'times': count, 'average_tenure': average, 'longest_tenure': longest, 'on_menu': bool(current)}
+
+
+def current_ages(store, location):
+    """
+    How long each beverage currently on the menu has been on it.
+
+    :return: Name, section and days on the menu as of the last scrape, including scrapes which found it unchanged,
+    oldest first.
+    :rtype: list
+    """
+    connection = store.ensure_schema(schema)
+    rows = connection.execute('SELECT name, section, ' + tenure_days + ' FROM tenures '
+                              'WHERE location = ? AND open = 1 ORDER BY first_seen',
+                              (location_key(location),))
+    return [{'name': name, 'section': section, 'age': age} for name, section, age in rows]
+
+
+def _range(location, start, end):
+    where = 'location = ?'
+    params = [location_key(location)]
+    if start:
+        where += ' AND first_seen >= ?'
+        params.append(start.strftime('%Y-%m-%d %H:%M:%S.%f'))
+    if end:
+        where += ' AND first_seen <= ?'
+        params.append(end.strftime('%Y-%m-%d %H:%M:%S.%f'))
+    return where, params
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Report how long beverages stay on the menu of a location.')
+    parser.add_argument('database', type=str, help='menu cache SQLite file')
+    parser.add_argument('location', type=str, help='stout location')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the tenures from the cached menus')
+    args = parser.parse_args()
+
+    cache = MenuCacheStore(args.database)
+    if args.rebuild:
+        _log('Recorded {0} menus'.format(rebuild(cache, args.location)))
+    print json.dumps({
+        'sections': section_stats(cache, args.location),
+        'current': current_ages(cache, args.location)
+    }, indent=2)
@@ -0,0 +1,4 @@
+import logging
+
+# Retries and failures are logged as they would be by the scrapers, keep them out of the test output
+logging.getLogger().addHandler(logging.NullHandler())
@@ -0,0 +1,63 @@
+import copy
+import unittest
+
+from menu_diff import diff
+from parse_menu import beer_parser
+
+
+def _menu(parsed, *titles):
+    return {
+        'location': 'Studio City',
+        'parsed': parsed,
+        'sections': [{'name': 'Bottles', 'type': 'beer',
+                      'beverages': [{'name': title, 'details': beer_parser.parse(title)} for title in titles]}]
+    }
+
+
+duvel_small = 'Duvel - Duvel Moortgat / Belg / Golden Ale / 330ml / 8.5% / $9'
+duvel_large = 'Duvel - Duvel Moortgat / Belg / Golden Ale / 750ml / 8.5% / $24'
+duvel_large_raised = 'Duvel - Duvel Moortgat / Belg / Golden Ale / 750ml / 8.5% / $26'
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_same_menu_has_no_changes(self):
+        menu = _menu('2014-01-01 12:00:00', duvel_small, duvel_large)
+        _diff = diff(menu, copy.deepcopy(menu), fields=True)
+        self.assertEqual([], _diff['added'])
+        self.assertEqual([], _diff['removed'])
+        self.assertEqual([], _diff['modified'])
+
+    def test_two_sizes_are_paired_by_size(self):
+        # Listed in the other order, with only the large bottle's price raised
+        _diff = diff(_menu('2014-01-01 12:00:00', duvel_small, duvel_large),
+                     _menu('2014-01-02 12:00:00', duvel_large_raised, duvel_small), fields=True)
+        self.assertEqual([], _diff['added'])
+        self.assertEqual([], _diff['removed'])
+        self.assertEqual(1, len(_diff['modified']))
+        self.assertEqual(duvel_large_raised, _diff['modified'][0]['beverage'])
+        self.assertEqual(['price', 'price_cents'], sorted(_diff['modified'][0]['changes']))
+
+    def test_removed_size_is_reported(self):
+        _diff = diff(_menu('2014-01-01 12:00:00', duvel_small, duvel_large),
+                     _menu('2014-01-02 12:00:00', duvel_small), fields=True)
+        self.assertEqual([], _diff['added'])
+        self.assertEqual([duvel_large], [item['beverage'] for item in _diff['removed']])
+        self.assertEqual([], _diff['modified'])
+
+    def test_added_size_is_reported(self):
+        _diff = diff(_menu('2014-01-01 12:00:00', duvel_small),
+                     _menu('2014-01-02 12:00:00', duvel_small, duvel_large))
+        self.assertEqual([duvel_large], [item['beverage'] for item in _diff['added']])
+        self.assertEqual([], _diff['removed'])
+
+    def test_single_beverage_size_change_is_modified(self):
+        _diff = diff(_menu('2014-01-01 12:00:00', duvel_small),
+                     _menu('2014-01-02 12:00:00', duvel_large), fields=True)
+        self.assertEqual([], _diff['added'])
+        self.assertEqual([], _diff['removed'])
+        self.assertIn('size', _diff['modified'][0]['changes'])
+
+
+if __name__ == '__main__':
+    unittest.main()
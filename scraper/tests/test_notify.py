@@ -0,0 +1,184 @@
+import asyncore
+import json
+import os
+import shutil
+import smtpd
+import tempfile
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import notify
+from cache_store import MenuCacheStore
+
+
+class SmtpStandIn(smtpd.SMTPServer):
+    """
+    Local SMTP server which keeps the recipients of every message and refuses the messages to fail_once, once each.
+    """
+
+    def __init__(self, fail_once=()):
+        smtpd.SMTPServer.__init__(self, ('localhost', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.fail_once = set(fail_once)
+        self.received = []
+        self._thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05, 'map': self._map})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if rcpttos[0] in self.fail_once:
+            self.fail_once.remove(rcpttos[0])
+            return '451 Try again later'
+        self.received.extend(rcpttos)
+
+    def stop(self):
+        self.close()
+        self._thread.join()
+
+
+class WebhookStandIn(HTTPServer):
+    """
+    Local HTTP server which keeps the path and payload of every POST and answers 500 to fail_once paths, once each.
+    """
+
+    def __init__(self, fail_once=()):
+        HTTPServer.__init__(self, ('localhost', 0), WebhookHandler)
+        self.fail_once = set(fail_once)
+        self.received = []
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self, path):
+        return 'http://localhost:{0}{1}'.format(self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path in self.server.fail_once:
+            self.server.fail_once.remove(self.path)
+            self.send_response(500)
+        else:
+            self.server.received.append((self.path, payload))
+            self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _diff(added=('Pliny the Elder - Russian River / CA / DIPA / 8%',), removed=()):
+    return {'added': [{'section': 'On Tap', 'beverage': beverage} for beverage in added],
+            'removed': [{'section': 'On Tap', 'beverage': beverage} for beverage in removed]}
+
+
+class NotifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = MenuCacheStore(os.path.join(self.directory, 'menu_cache.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_smtp_retry_only_resends_undelivered(self):
+        addresses = ['user{0}@example.com'.format(i) for i in range(5)]
+        for address in addresses:
+            notify.add_subscription(self.store, address)
+        server = SmtpStandIn(fail_once=[addresses[2]])
+        try:
+            notifier = notify.Notifier(notify.load_subscriptions(self.store),
+                                       {'smtp': notify.SmtpTransport('localhost', server.port, timeout=5)},
+                                       workers=1, backoff=0.01)
+            notifier.submit('Studio City', _diff())
+            notifier.close()
+        finally:
+            server.stop()
+        self.assertEqual(sorted(addresses), sorted(server.received))
+        self.assertEqual((5, 0), (notifier.sent, notifier.failed))
+
+    def test_webhook_retry_only_resends_undelivered(self):
+        server = WebhookStandIn(fail_once=['/b'])
+        try:
+            for path in ('/a', '/b', '/c'):
+                notify.add_subscription(self.store, server.url(path), 'webhook')
+            notifier = notify.Notifier(notify.load_subscriptions(self.store), {'webhook': notify.WebhookTransport(5)},
+                                       workers=1, backoff=0.01)
+            notifier.submit('Studio City', _diff())
+            notifier.close()
+        finally:
+            server.stop()
+        self.assertEqual(['/a', '/b', '/c'], sorted(path for path, _ in server.received))
+        self.assertEqual((3, 0), (notifier.sent, notifier.failed))
+
+    def test_filters(self):
+        server = WebhookStandIn()
+        try:
+            notify.add_subscription(self.store, server.url('/all'), 'webhook')
+            notify.add_subscription(self.store, server.url('/studio-city-beer'), 'webhook', ['Studio City'], ['beer'])
+            notify.add_subscription(self.store, server.url('/hollywood'), 'webhook', ['Hollywood'])
+            notify.add_subscription(self.store, server.url('/wine'), 'webhook', section_types=['wine'])
+            notifier = notify.Notifier(notify.load_subscriptions(self.store), {'webhook': notify.WebhookTransport(5)})
+            notifier.submit('Studio City', _diff())
+            notifier.close()
+        finally:
+            server.stop()
+        self.assertEqual(['/all', '/studio-city-beer'], sorted(path for path, _ in server.received))
+
+    def test_digest_is_sent_once_due(self):
+        server = WebhookStandIn()
+        try:
+            subscription = notify.add_subscription(self.store, server.url('/daily'), 'webhook', frequency='daily')
+            notifier = notify.Notifier(notify.load_subscriptions(self.store), {'webhook': notify.WebhookTransport(5)},
+                                       self.store)
+            notifier.submit('Studio City', _diff(added=['Pliny the Elder - Russian River / CA / DIPA / 8%']))
+            notifier.submit('Studio City', _diff(added=['Duvel - Duvel Moortgat / Belg / Golden Ale / 8.5%']))
+            notifier._diffs.join()
+            self.assertEqual(0, notifier.send_digests())
+
+            # A day later both changes are sent in one notification
+            with self.store.connection() as connection:
+                connection.execute('UPDATE subscriptions SET digest_sent = digest_sent - 86400 WHERE id = ?',
+                                   (subscription.id,))
+            notifier.close()
+        finally:
+            server.stop()
+        self.assertEqual(1, len(server.received))
+        path, payload = server.received[0]
+        self.assertEqual(2, len(payload[0]['added']))
+        self.assertEqual(0, notifier.send_digests())
+
+    def test_due_digests_are_claimed_together(self):
+        server = WebhookStandIn()
+        try:
+            for path, frequency in (('/a', 'daily'), ('/b', 'daily'), ('/weekly', 'weekly')):
+                notify.add_subscription(self.store, server.url(path), 'webhook', frequency=frequency)
+            notifier = notify.Notifier(notify.load_subscriptions(self.store), {'webhook': notify.WebhookTransport(5)},
+                                       self.store)
+            notifier.submit('Studio City', _diff(added=['Pliny the Elder - Russian River / CA / DIPA / 8%']))
+            notifier._diffs.join()
+            self.assertEqual(0, notifier.send_digests())
+
+            with self.store.connection() as connection:
+                connection.execute("UPDATE subscriptions SET digest_sent = digest_sent - 86400 "
+                                   "WHERE frequency = 'daily'")
+            self.assertEqual(2, notifier.send_digests())
+            # The daily digests were just sent, the weekly one is due in a week
+            self.assertAlmostEqual(time.time() + 86400, notifier.digest_due, delta=60)
+            notifier.close()
+        finally:
+            server.stop()
+        self.assertEqual(['/a', '/b'], sorted(path for path, _ in server.received))
+
+
+if __name__ == '__main__':
+    unittest.main()
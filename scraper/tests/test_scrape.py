@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import TCPServer
+
+import scrape
+
+sample_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'sample')
+
+
+class SampleHandler(SimpleHTTPRequestHandler):
+    """
+    Serve the sample pages, SimpleHTTPRequestHandler serves the working directory so translate_path is rebased.
+    """
+
+    def translate_path(self, path):
+        return os.path.join(sample_dir, os.path.basename(SimpleHTTPRequestHandler.translate_path(self, path)))
+
+    def log_message(self, *args):
+        pass
+
+
+class SampleServer(TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self):
+        TCPServer.__init__(self, ('localhost', 0), SampleHandler)
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self, name):
+        return 'http://localhost:{0}/{1}'.format(self.server_address[1], name)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def _titles(menu):
+    return [(section['name'], [beverage['name'] for beverage in section['beverages']]) for section in menu['sections']]
+
+
+class ScrapeLocationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = SampleServer()
+        self._store_path, self._store = scrape.cache_store_path, scrape._store
+        scrape.cache_store_path = os.path.join(self.directory, 'menu_cache.db')
+        scrape._store = None
+
+    def tearDown(self):
+        scrape.cache_store_path, scrape._store = self._store_path, self._store
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_scrape_sample_pages(self):
+        locations = [{'name': 'Studio City', 'url': self.server.url('2014-08-25.html')},
+                     {'name': 'Hollywood', 'url': self.server.url('old.html')},
+                     {'name': 'Missing', 'url': self.server.url('missing.html')}]
+        results = scrape.scrape_locations(locations, workers=3, processes=1, retries=0)
+        self.assertIsNone(results['Missing'])
+
+        store = scrape.get_store()
+        for name, sample in (('Studio City', '2014-08-25.json'), ('Hollywood', 'old.json')):
+            self.assertEqual(results[name], store.find_extreme(name))
+            with open(os.path.join(sample_dir, sample)) as fh:
+                expected = json.load(fh)
+            self.assertEqual(_titles(expected), _titles(store.load(results[name])))
+
+        # The pages are unchanged, nothing is cached again
+        results = scrape.scrape_locations(locations[:2], workers=2, processes=1, retries=0)
+        self.assertEqual({'Studio City': None, 'Hollywood': None}, results)
+        self.assertEqual(1, len(store.snapshots('Hollywood')))
+
+
+if __name__ == '__main__':
+    unittest.main()
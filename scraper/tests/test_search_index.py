@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import search_index
+from cache_store import MenuCacheStore
+from parse_menu import beer_parser
+
+duvel = 'Duvel - Duvel Moortgat / Belg / Golden Ale / 330ml / 8.5% / $9'
+sculpin = 'Sculpin - Ballast Point / CA / IPA / 7%'
+
+
+def _menu(*titles):
+    return {'sections': [{'name': 'On Tap', 'type': 'beer',
+                          'beverages': [{'name': title, 'details': beer_parser.parse(title)} for title in titles]}]}
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = MenuCacheStore(os.path.join(self.directory, 'menu_cache.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _record(self, location, time, menu):
+        search_index.record(self.store, self.store.put(location, time, menu), menu)
+
+    def _names(self, query, *args, **fields):
+        return [result['name'] for result in search_index.search(self.store, query, *args, **fields)]
+
+    def test_location_field_and_stout_location(self):
+        self._record('Studio City', datetime(2014, 8, 25), _menu(duvel, sculpin))
+        self._record('Hollywood', datetime(2014, 8, 25), _menu(sculpin))
+        self.assertEqual([duvel], self._names('', location='belg'))
+        self.assertEqual([], self._names('', 'Hollywood', location='belg'))
+        self.assertEqual([sculpin], self._names('sculpin', 'Hollywood'))
+        self.assertEqual([duvel], self._names('golden', 'Studio City', location='belg'))
+
+    def test_changed_details_drop_stale_terms(self):
+        self._record('Studio City', datetime(2014, 8, 25), _menu(sculpin))
+        self.assertEqual([sculpin], self._names('ipa'))
+        # Same beverage, its style was corrected on a later menu
+        renamed = sculpin.replace('IPA', 'West Coast Pale')
+        self._record('Studio City', datetime(2014, 8, 26), _menu(renamed))
+        self.assertEqual([], self._names('ipa'))
+        self.assertEqual([renamed], self._names('', style='pale'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+from time import time as now
+
+import manifest
+import scrape
+from cache_store import MenuCacheStore
+from parse_menu import beer_parser
+from work_queue import LeaseQueue, StaleLeaseException, repair, work
+
+pliny = 'Pliny the Elder - Russian River / CA / DIPA / 8%'
+sample_page = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'sample', '2014-08-25.html')
+
+
+class MenuHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MenuStandIn(HTTPServer):
+    """
+    Serves the sample menu page, or whatever status and body the test sets.
+    """
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('localhost', 0), MenuHandler)
+        self.status = 200
+        with open(sample_page) as fh:
+            self.body = fh.read()
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self):
+        return 'http://localhost:{0}/studio-city'.format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def _menu(parsed):
+    return {
+        'location': 'Studio City',
+        'parsed': parsed,
+        'sections': [{'name': 'On Tap', 'type': 'beer',
+                      'beverages': [{'name': pliny, 'details': beer_parser.parse(pliny)}]}]
+    }
+
+
+class LeaseQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = MenuCacheStore(os.path.join(self.directory, 'menu_cache.db'))
+        self.queue = LeaseQueue(self.store, lease_duration=300)
+        self.queue.sync([{'name': 'Studio City', 'url': 'http://localhost/studio-city', 'interval': 3600}])
+        self._store, scrape._store = scrape._store, self.store
+
+    def tearDown(self):
+        scrape._store = self._store
+        shutil.rmtree(self.directory)
+
+    def _expire(self):
+        with self.queue.connection() as connection:
+            connection.execute('UPDATE scrape_jobs SET expires = ?', (now() - 1,))
+
+    def _put(self, lease, time):
+        return self.store.put('Studio City', time, _menu(str(time)), fence=self.queue.fence(lease),
+                              html='<html>{0}</html>'.format(time))
+
+    def test_expired_lease_is_reclaimed_and_stale_writes_fenced(self):
+        first = self.queue.lease('node-a:1')
+        self.assertIsNotNone(first)
+        self.assertIsNone(self.queue.lease('node-b:1'))
+
+        self._expire()
+        second = self.queue.lease('node-b:1')
+        self.assertEqual('node-b:1', second.owner)
+        self.assertGreater(second.token, first.token)
+
+        # The worker whose lease expired may still be scraping, its write is rejected
+        with self.assertRaises(StaleLeaseException):
+            self._put(first, datetime(2014, 8, 25, 12))
+        self.assertEqual([], self.store.snapshots('Studio City'))
+        self.assertIsNone(self.store.latest_page('Studio City'))
+
+        self._put(second, datetime(2014, 8, 25, 13))
+        # A second write under the same lease is rejected too
+        with self.assertRaises(StaleLeaseException):
+            self._put(second, datetime(2014, 8, 25, 14))
+        self.assertEqual(['2014-08-25 13:00:00.000000'],
+                         [snapshot.scraped for snapshot in self.store.snapshots('Studio City')])
+
+        self.assertIsNone(self.queue.heartbeat(first))
+        self.assertFalse(self.queue.release(first))
+        self.assertTrue(self.queue.release(second))
+
+    def test_next_lease_records_snapshot_of_failed_lease(self):
+        first = self.queue.lease('node-a:1')
+        # The worker dies after caching the snapshot, before recording it
+        self._put(first, datetime(2014, 8, 25, 12))
+        self.assertEqual([], manifest.page(self.store)[0])
+
+        self._expire()
+        second = self.queue.lease('node-b:1')
+        self.assertEqual(first.token, second.unrecorded)
+        repair(self.queue, second)
+        entries = manifest.page(self.store)[0]
+        self.assertEqual([datetime(2014, 8, 25, 12)], [entry['scraped'] for entry in entries])
+        self.assertTrue(self.queue.release(second))
+
+        with self.queue.connection() as connection:
+            connection.execute('UPDATE scrape_jobs SET due = ?', (now() - 1,))
+        self.assertIsNone(self.queue.lease('node-a:1').unrecorded)
+
+    def _due(self):
+        with self.queue.connection() as connection:
+            connection.execute('UPDATE scrape_jobs SET due = ?', (now() - 1,))
+
+    def _job(self):
+        return self.queue.connection().execute('SELECT due, owner, errors, last_error, written, recorded '
+                                               'FROM scrape_jobs').fetchone()
+
+    def test_work_scrapes_and_backs_off_on_errors(self):
+        server = MenuStandIn()
+        try:
+            self.queue.sync([{'name': 'Studio City', 'url': server.url(), 'interval': 3600}])
+            self.assertEqual(1, work(self.queue, 'node-a:1', poll_interval=0.01, max_jobs=1, retries=0))
+            self.assertEqual(1, len(self.store.snapshots('Studio City')))
+            due, owner, errors, last_error, written, recorded = self._job()
+            self.assertAlmostEqual(now() + 3600, due, delta=60)
+            self.assertEqual((None, 0, None), (owner, errors, last_error))
+            self.assertIsNotNone(written)
+            self.assertEqual(written, recorded)
+
+            self._due()
+            server.status = 500
+            self.assertEqual(1, work(self.queue, 'node-a:1', poll_interval=0.01, max_jobs=1, retries=0))
+            due, owner, errors, last_error, _, _ = self._job()
+            self.assertAlmostEqual(now() + self.queue.error_backoff, due, delta=30)
+            self.assertEqual((None, 1), (owner, errors))
+            self.assertIn('500', last_error)
+            self.assertEqual(1, len(self.store.snapshots('Studio City')))
+        finally:
+            server.stop()
+
+    def test_reclaimed_lease_writes_nothing_for_unchanged_menu(self):
+        server = MenuStandIn()
+        try:
+            self.queue.sync([{'name': 'Studio City', 'url': server.url(), 'interval': 3600}])
+            work(self.queue, 'node-a:1', poll_interval=0.01, max_jobs=1, retries=0)
+            self._due()
+            first = self.queue.lease('node-a:1')
+            self._expire()
+            self.queue.lease('node-b:1')
+
+            # The page is unchanged, the tenure would be extended to this scrape
+            with self.assertRaises(StaleLeaseException):
+                scrape.scrape_location({'name': 'Studio City', 'url': server.url()}, retries=0,
+                                       fence=self.queue.fence(first))
+            self.assertEqual([], self.store.connection().execute('SELECT * FROM tenure_checks').fetchall())
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
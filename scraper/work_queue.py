@@ -0,0 +1,374 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from time import time as now
+
+import metrics
+import notify
+import parse_memo
+import parse_menu
+import registry
+import scrape
+from cache_store import location_key
+
+root_log = logging.getLogger()
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS scrape_jobs (
+        location TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        url TEXT NOT NULL,
+        interval REAL NOT NULL,
+        due REAL NOT NULL,
+        owner TEXT,
+        expires REAL,
+        token INTEGER NOT NULL DEFAULT 0,
+        written INTEGER,
+        recorded INTEGER,
+        errors INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS scrape_jobs_due ON scrape_jobs (due)',
+]
+
+# A lease on the scrape job of a location, token is the fencing token which increases with every lease of the job.
+# unrecorded is the token of an earlier lease which cached a snapshot without recording it, None if there is none.
+Lease = namedtuple('Lease', ['location', 'name', 'url', 'interval', 'owner', 'token', 'expires', 'unrecorded'])
+
+leases = metrics.counter('work_queue_leases_total', 'Scrape jobs leased, by whether an expired lease was reclaimed')
+fenced = metrics.counter('work_queue_fenced_total', 'Snapshot writes rejected because the lease was lost')
+repairs = metrics.counter('work_queue_repairs_total', 'Snapshots recorded for a lease which cached them and failed')
+
+
+class StaleLeaseException(Exception):
+    pass
+
+
+class LeaseQueue(object):
+    """
+    Queue of scrape jobs, one per configured location, kept in the menu cache store so that scraper workers on
+    several nodes sharing the store take turns scraping the locations.
+
+    A worker leases a due job for lease_duration seconds, heartbeats to extend the lease while it scrapes and releases
+    the job with the time it is next due. A lease which expires, because its worker died or stalled, is reclaimed by
+    the next worker to lease the job. Every lease gets a higher fencing token, the snapshot is only written if the
+    worker's token is still the job's current one and has not written yet, checked in the transaction writing it, so
+    each lease caches at most one snapshot and a reclaimed lease never writes at all.
+
+    The snapshot and its page are written in the fenced transaction, the diff chain, manifest, search index and tenures
+    after it. A worker marks its lease recorded once they are written. When the next lease of the job finds a written
+    lease which was not recorded, because its worker died or failed in between, it records the snapshot first.
+    """
+
+    def __init__(self, store, lease_duration=300, error_backoff=60):
+        """
+        :param store: Menu cache store the jobs are kept in.
+        :type store: cache_store.MenuCacheStore
+        :param lease_duration: Seconds a lease lasts without a heartbeat.
+        :type lease_duration: float
+        :param error_backoff: Seconds before a failed job is due again, doubled with every failure in a row up to the
+        job's interval.
+        :type error_backoff: float
+        """
+        self.store = store
+        self.lease_duration = lease_duration
+        self.error_backoff = error_backoff
+
+    def connection(self):
+        connection = self.store.ensure_schema(schema)
+        # Jobs created before leases were marked recorded have no recorded column
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(scrape_jobs)')]
+        if 'recorded' not in columns:
+            with connection:
+                connection.execute('ALTER TABLE scrape_jobs ADD COLUMN recorded INTEGER')
+                connection.execute('UPDATE scrape_jobs SET recorded = written')
+        return connection
+
+    def sync(self, locations):
+        """
+        Add a job for every location which has none, update the name, url and interval of the others and remove the
+        jobs of locations which are no longer configured.
+
+        :param locations: Locations from registry.load_locations.
+        :type locations: list
+        :return: Number of jobs added and removed.
+        :rtype: tuple
+        """
+        keys = [location_key(location['name']) for location in locations]
+        with self.connection() as connection:
+            existing = set(row[0] for row in connection.execute('SELECT location FROM scrape_jobs'))
+            for key, location in zip(keys, locations):
+                interval = location.get('interval', registry.default_interval)
+                if key in existing:
+                    connection.execute('UPDATE scrape_jobs SET name = ?, url = ?, interval = ? WHERE location = ?',
+                                       (location['name'], location['url'], interval, key))
+                else:
+                    connection.execute('INSERT INTO scrape_jobs (location, name, url, interval, due) '
+                                       'VALUES (?, ?, ?, ?, ?)', (key, location['name'], location['url'], interval,
+                                                                  now()))
+            removed = existing - set(keys)
+            connection.executemany('DELETE FROM scrape_jobs WHERE location = ?', [(key,) for key in removed])
+        return len(set(keys) - existing), len(removed)
+
+    def lease(self, owner):
+        """
+        Lease the job which has been due the longest, reclaiming it if its lease expired.
+
+        :param owner: Name of the worker, e.g. host:pid.
+        :type owner: str
+        :return: The lease, None if no job is due.
+        :rtype: Lease
+        """
+        connection = self.connection()
+        at = now()
+        candidates = connection.execute('SELECT location, owner FROM scrape_jobs WHERE due <= ? AND '
+                                        '(owner IS NULL OR expires < ?) ORDER BY due LIMIT 10', (at, at)).fetchall()
+        for key, previous_owner in candidates:
+            # Another worker may lease the same job first, the conditional update only succeeds for one of them
+            with connection:
+                cursor = connection.execute('UPDATE scrape_jobs SET owner = ?, expires = ?, token = token + 1 '
+                                            'WHERE location = ? AND due <= ? AND (owner IS NULL OR expires < ?)',
+                                            (owner, at + self.lease_duration, key, at, at))
+                if cursor.rowcount != 1:
+                    continue
+                row = connection.execute('SELECT name, url, interval, token, written, recorded FROM scrape_jobs '
+                                         'WHERE location = ?', (key,)).fetchone()
+            if previous_owner:
+                _log('Reclaimed {0} from {1} whose lease expired'.format(row[0], previous_owner), logging.WARN)
+            leases.inc(reclaimed='true' if previous_owner else 'false')
+            unrecorded = row[4] if row[4] is not None and row[4] != row[5] else None
+            return Lease(key, row[0], row[1], row[2], owner, row[3], at + self.lease_duration, unrecorded)
+        return None
+
+    def heartbeat(self, lease):
+        """
+        Extend a lease by lease_duration.
+
+        :return: The extended lease, None if the lease was lost to another worker.
+        :rtype: Lease
+        """
+        expires = now() + self.lease_duration
+        with self.connection() as connection:
+            cursor = connection.execute('UPDATE scrape_jobs SET expires = ? WHERE location = ? AND token = ? AND '
+                                        'owner = ?', (expires, lease.location, lease.token, lease.owner))
+        return lease._replace(expires=expires) if cursor.rowcount == 1 else None
+
+    def release(self, lease, error=None):
+        """
+        Release a leased job. It is next due after its interval, or after a backoff doubling with every failure in a
+        row if the scrape failed.
+
+        :param error: Why the scrape failed, None if it succeeded.
+        :type error: str
+        :return: False if the lease was lost to another worker and nothing was changed.
+        :rtype: bool
+        """
+        with self.connection() as connection:
+            if error is None:
+                cursor = connection.execute('UPDATE scrape_jobs SET owner = NULL, expires = NULL, due = ?, errors = 0, '
+                                            'last_error = NULL WHERE location = ? AND token = ? AND owner = ?',
+                                            (now() + lease.interval, lease.location, lease.token, lease.owner))
+            else:
+                cursor = connection.execute('UPDATE scrape_jobs SET owner = NULL, expires = NULL, '
+                                            'due = ? + MIN(interval, ? * (1 << MIN(errors, 16))), '
+                                            'errors = errors + 1, last_error = ? WHERE location = ? AND token = ? AND '
+                                            'owner = ?', (now(), self.error_backoff, error, lease.location,
+                                                          lease.token, lease.owner))
+        return cursor.rowcount == 1
+
+    def fence(self, lease):
+        """
+        :return: Fence for MenuCacheStore.put which aborts the write unless the lease is still current and has not
+        written a snapshot yet, and marks it as written. Called with write=False it only checks the lease is current,
+        for the other writes of a scrape.
+        :rtype: callable
+        """
+        def check(connection, write=True):
+            if write:
+                cursor = connection.execute('UPDATE scrape_jobs SET written = ? WHERE location = ? AND token = ? AND '
+                                            '(written IS NULL OR written != ?)',
+                                            (lease.token, lease.location, lease.token, lease.token))
+            else:
+                # Updating the job holds the write lock, so it cannot be reclaimed before the transaction commits
+                cursor = connection.execute('UPDATE scrape_jobs SET token = token WHERE location = ? AND token = ?',
+                                            (lease.location, lease.token))
+            if cursor.rowcount != 1:
+                fenced.inc()
+                raise StaleLeaseException('Lease {0} of {1} is no longer current'.format(lease.token, lease.name))
+        return check
+
+    def recorded(self, lease, token):
+        """
+        Mark the snapshot written by the lease with a token as recorded, unless a later lease has written since.
+
+        :param lease: Current lease of the job.
+        :type lease: Lease
+        :param token: Token of the lease which wrote the snapshot, the current lease's or its unrecorded one.
+        :type token: int
+        """
+        with self.connection() as connection:
+            connection.execute('UPDATE scrape_jobs SET recorded = ? WHERE location = ? AND written = ?',
+                               (token, lease.location, token))
+
+    def jobs(self):
+        """
+        :return: Every job with its state, ordered by when it is due.
+        :rtype: list
+        """
+        rows = self.connection().execute('SELECT name, url, interval, due, owner, expires, token, errors, last_error '
+                                         'FROM scrape_jobs ORDER BY due')
+        return [dict(zip(('name', 'url', 'interval', 'due', 'owner', 'expires', 'token', 'errors', 'last_error'), row))
+                for row in rows]
+
+
+def work(queue, owner=None, poll_interval=5, max_jobs=None, stop=None, timeout=scrape.default_timeout,
+         retries=scrape.default_retries, backoff=scrape.default_backoff):
+    """
+    Lease and scrape due jobs until stopped. The lease is extended by a heartbeat thread while the location is
+    scraped. A snapshot an earlier lease of the job did not record is recorded first, see repair.
+
+    :param queue: Queue to lease jobs from.
+    :type queue: LeaseQueue
+    :param owner: Name of this worker, defaults to host:pid.
+    :type owner: str
+    :param poll_interval: Seconds to wait when no job is due.
+    :type poll_interval: float
+    :param max_jobs: Stop after this many jobs, run until stopped if None.
+    :type max_jobs: int
+    :param stop: Stop once set.
+    :type stop: threading.Event
+    :return: Number of jobs done.
+    :rtype: int
+    """
+    owner = owner or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    stop = stop or threading.Event()
+    done = 0
+    while not stop.is_set() and (max_jobs is None or done < max_jobs):
+        lease = queue.lease(owner)
+        if lease is None:
+            stop.wait(poll_interval)
+            continue
+        done += 1
+        try:
+            with _heartbeat(queue, lease):
+                if lease.unrecorded is not None:
+                    repair(queue, lease)
+                snapshot = scrape.scrape_location({'name': lease.name, 'url': lease.url}, timeout=timeout,
+                                                  retries=retries, backoff=backoff, fence=queue.fence(lease))
+                if snapshot:
+                    queue.recorded(lease, lease.token)
+        except StaleLeaseException as e:
+            # The job belongs to whoever reclaimed it, there is nothing to release
+            _log(str(e), logging.WARN)
+            continue
+        except Exception as e:
+            _log('Failed to scrape {0}: {1}'.format(lease.name, str(e)), logging.ERROR)
+            queue.release(lease, str(e) or e.__class__.__name__)
+            continue
+        queue.release(lease)
+    return done
+
+
+def repair(queue, lease):
+    """
+    Record the snapshot cached by an earlier lease of the job which died or failed before recording it. Each lease
+    writes at most one snapshot and only while it is current, so it is the latest snapshot of the location. Its
+    changes are notified again if the earlier worker got as far as queueing them.
+
+    :param queue: Queue the lease is from.
+    :type queue: LeaseQueue
+    :param lease: Current lease of the job, with the unrecorded token.
+    :type lease: Lease
+    """
+    store = scrape.get_store()
+    snapshot = store.find_extreme(lease.name)
+    if snapshot:
+        _log('Recording {0} scraped {1} for lease {2}'.format(lease.name, snapshot.scraped, lease.unrecorded),
+             logging.WARN)
+        scrape.record_menu(snapshot, store.load(snapshot), lease.name)
+        repairs.inc()
+    queue.recorded(lease, lease.unrecorded)
+
+
+@contextmanager
+def _heartbeat(queue, lease):
+    finished = threading.Event()
+
+    def beat():
+        while not finished.wait(queue.lease_duration / 3.0):
+            if queue.heartbeat(lease) is None:
+                _log('Lost the lease on {0}'.format(lease.name), logging.WARN)
+                return
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        finished.set()
+        thread.join()
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Scrape locations leased from a work queue shared by several '
+                                                 'workers.')
+    parser.add_argument('command', choices=['sync', 'work', 'list'],
+                        help='sync the jobs with the config, work on due jobs or list the jobs')
+    parser.add_argument('--config', type=str, default=registry.default_path, help='locations JSON file')
+    parser.add_argument('--lease', type=float, default=300, help='seconds a lease lasts without a heartbeat')
+    parser.add_argument('--poll-interval', type=float, default=5, help='seconds to wait when no job is due')
+    parser.add_argument('--max-jobs', type=int, default=None, help='stop after this many jobs')
+    parser.add_argument('--owner', type=str, default=None, help='name of this worker, defaults to host:pid')
+    parser.add_argument('--timeout', type=float, default=scrape.default_timeout, help='seconds to wait on each request')
+    parser.add_argument('--retries', type=int, default=scrape.default_retries, help='times to retry a failed request')
+    parser.add_argument('--backoff', type=float, default=scrape.default_backoff, help='seconds before the first retry')
+    parser.add_argument('--no-memo', action='store_true', help='parse every beverage title, ignoring the parse memo')
+    parser.add_argument('--deltas', action='store_true', help='store changed menus as deltas against the last menu')
+    parser.add_argument('--prerender', type=str, metavar='DIR', help='pre-render the menu view of new menus to DIR')
+    notify.add_arguments(parser)
+    args = parser.parse_args()
+
+    scrape.cache_store_deltas = args.deltas
+    scrape.prerender_dir = args.prerender
+    work_queue = LeaseQueue(scrape.get_store(), args.lease)
+    if args.command == 'sync':
+        _log('Added {0} jobs, removed {1}'.format(*work_queue.sync(registry.load_locations(args.config))))
+    elif args.command == 'list':
+        for job in work_queue.jobs():
+            _log('{name} due in {0:.0f}s, owner {owner}, token {token}, errors {errors}'.format(
+                job['due'] - now(), **job))
+    else:
+        if not args.no_memo:
+            parse_menu.memo = parse_memo.ParseMemo(scrape.parse_memo_path)
+        # Finish the current job on SIGINT/SIGTERM, an interrupted lease would only be reclaimed once it expires
+        stopping = threading.Event()
+        signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        scrape.notifier = notify.from_arguments(scrape.get_store(), args, args.timeout)
+        try:
+            _log('Did {0} jobs'.format(work(work_queue, args.owner, args.poll_interval, args.max_jobs, stopping,
+                                            args.timeout, args.retries, args.backoff)))
+        finally:
+            if scrape.notifier:
+                # Deliver what the last scrapes queued
+                scrape.notifier.close()
+                _log('Sent {0} notifications, {1} failed'.format(scrape.notifier.sent, scrape.notifier.failed))
@@ -2,3 +2,4 @@ from flask import Flask
 app = Flask(__name__)
 
 import views
+import api
@@ -0,0 +1,151 @@
+import json
+import zlib
+from datetime import datetime, timedelta
+
+from flask import Response, request
+
+from web import app
+from web.views import diff_range, load_menu
+from scraper.cache_store import url_time_format
+from scraper.diff_chain import iter_changes
+from scraper.manifest import ManifestException, page
+from scraper.menu_diff import json_default
+from scraper.scrape import get_store
+
+# Optional compact encoding, JSON is always available
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+msgpack_mimetype = 'application/x-msgpack'
+ndjson_mimetype = 'application/x-ndjson'
+
+
+class ApiException(Exception):
+    pass
+
+
+@app.errorhandler(ApiException)
+def api_error(e):
+    return _respond({'error': str(e)}, status=400)
+
+
+@app.route('/api/v1/snapshots/')
+def api_snapshots():
+    start, end = _date_range()
+    try:
+        entries, cursor = page(get_store(), request.args.get('location'), start, end, request.args.get('after'),
+                               min(request.args.get('limit', 50, type=int), 500))
+    except ManifestException as e:
+        raise ApiException(str(e))
+    return _respond({'snapshots': entries, 'next': cursor})
+
+
+@app.route('/api/v1/snapshots/<location>/<day>/')
+def api_snapshot(location, day):
+    # A day returns the last menu of the day, the time of a listed snapshot returns that snapshot
+    if len(day) > len('YYYY-MM-DD'):
+        snapshot = get_store().find_scraped(location, _parse_time(day))
+    else:
+        snapshot = get_store().find_day(location, _parse_day(day))
+    if not snapshot:
+        return _respond({'error': 'No menu for {0} on {1}'.format(location, day)}, status=404)
+    return _respond({'location': snapshot.location, 'scraped': snapshot.scraped, 'blob': snapshot.blob,
+                     'menu': load_menu(snapshot)})
+
+
+@app.route('/api/v1/diff/')
+def api_diff():
+    location = _required('location')
+    start = _required('start')
+    end = request.args.get('end')
+    # Validate the days before looking anything up
+    _parse_day(start)
+    if end:
+        _parse_day(end)
+    _diff = diff_range(location, start, end)
+    if _diff is None:
+        return _respond({'error': 'No menus for {0} in the range'.format(location)}, status=404)
+    return _respond(_diff)
+
+
+@app.route('/api/v1/changes/')
+def api_changes():
+    """
+    Every stored change of a location in a date range, streamed as one record per cached menu.
+    """
+    start, end = _date_range()
+    return _respond_stream(iter_changes(get_store(), _required('location'), start, end))
+
+
+def _respond(obj, status=200):
+    """
+    Encode a single object as msgpack when the client prefers it, JSON otherwise.
+    """
+    if msgpack and request.accept_mimetypes.best_match(['application/json', msgpack_mimetype]) == msgpack_mimetype:
+        return _response([_pack(obj)], msgpack_mimetype, status)
+    return _response([json.dumps(obj, default=json_default)], 'application/json', status)
+
+
+def _respond_stream(items):
+    """
+    Stream a sequence of objects as newline delimited JSON, or concatenated msgpack objects when the client prefers
+    it, encoding each one as it is sent rather than building the whole response in memory.
+    """
+    if msgpack and request.accept_mimetypes.best_match([ndjson_mimetype, msgpack_mimetype]) == msgpack_mimetype:
+        return _response((_pack(item) for item in items), msgpack_mimetype)
+    return _response((json.dumps(item, default=json_default) + '\n' for item in items), ndjson_mimetype)
+
+
+def _response(chunks, mimetype, status=200):
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    # The quality is 0 when gzip is refused (gzip;q=0) or not accepted at all
+    if request.accept_encodings['gzip'] > 0:
+        chunks = _gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, status, headers, mimetype=mimetype)
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _pack(obj):
+    # Python 2 str is text here (SQLite keys, ISO times), bin would hand a client bytes where it expects strings. Pack
+    # str and unicode alike as the msgpack str type, the API sends no binary data.
+    return msgpack.packb(obj, default=json_default, use_bin_type=False)
+
+
+def _required(name):
+    value = request.args.get(name)
+    if not value:
+        raise ApiException('Missing parameter "{0}"'.format(name))
+    return value
+
+
+def _parse_day(day):
+    try:
+        return datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        raise ApiException('Invalid day "{0}", expected YYYY-MM-DD'.format(day))
+
+
+def _parse_time(time):
+    try:
+        return datetime.strptime(time, url_time_format)
+    except ValueError:
+        raise ApiException('Invalid time "{0}", expected YYYYMMDDTHHMMSS.ffffff'.format(time))
+
+
+def _date_range():
+    # The end day is inclusive
+    start = request.args.get('start')
+    end = request.args.get('end')
+    return (_parse_day(start) if start else None,
+            _parse_day(end) + timedelta(days=1) if end else None)
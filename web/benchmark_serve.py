@@ -0,0 +1,118 @@
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import urllib2
+from datetime import datetime, timedelta
+from time import sleep, time as now
+
+import scraper.scrape as scrape
+from scraper.benchmark_columnar import synthetic_history
+
+locations = ['Hollywood', 'Studio City', 'Santa Monica']
+
+
+def build_cache(path, days, beverages, changes):
+    """
+    Cache a synthetic history of menus for every location, through scrape.cache_menu like real scrapes.
+
+    :return: Day of the first menu.
+    :rtype: datetime
+    """
+    scrape.cache_store_path = path
+    for seed, location in enumerate(locations):
+        for menu in synthetic_history(days, beverages, changes, seed):
+            menu['location'] = location
+            scrape.cache_menu(menu, {'name': location}, datetime.strptime(menu['parsed'], '%Y-%m-%d %H:%M:%S'))
+    return datetime.strptime(menu['parsed'][:10], '%Y-%m-%d') - timedelta(days=days - 1)
+
+
+def wait_ready(url, timeout=60):
+    deadline = now() + timeout
+    while now() < deadline:
+        try:
+            urllib2.urlopen(url + '/readyz', timeout=1).read()
+            return
+        except Exception:
+            sleep(0.2)
+    raise Exception('Server at {0} did not become ready'.format(url))
+
+
+def run_client(task):
+    """
+    Request random diffs until the duration is up.
+
+    :return: Latency of every request in seconds and the number of failed requests.
+    :rtype: tuple
+    """
+    url, first_day, days, duration, seed = task
+    rand = random.Random(seed)
+    latencies = []
+    errors = 0
+    deadline = now() + duration
+    while now() < deadline:
+        start = rand.randrange(days - 1)
+        end = rand.randrange(start + 1, days)
+        query = 'location={0}&start={1}&end={2}'.format(
+            urllib2.quote(rand.choice(locations)), (first_day + timedelta(days=start)).strftime('%Y-%m-%d'),
+            (first_day + timedelta(days=end)).strftime('%Y-%m-%d'))
+        started = now()
+        try:
+            urllib2.urlopen('{0}/menu/diff/?{1}'.format(url, query), timeout=30).read()
+            latencies.append(now() - started)
+        except Exception:
+            errors += 1
+    return latencies, errors
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Load test /menu/diff/ of web/serve.py against a synthetic cache.')
+    parser.add_argument('--days', type=int, default=90, help='number of menus per location')
+    parser.add_argument('--beverages', type=int, default=100, help='number of beverages per menu')
+    parser.add_argument('--changes', type=int, default=5, help='number of beverages replaced between menus')
+    parser.add_argument('--workers', type=int, default=2, help='server worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='server threads per worker')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client processes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send requests for')
+    parser.add_argument('--port', type=int, default=5055, help='port to serve on')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'menu_cache.db')
+    first_day = build_cache(path, args.days, args.beverages, args.changes)
+
+    env = dict(os.environ, STOUT_CACHE_STORE=path)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, '-m', 'web.serve', '--port', str(args.port), '--workers',
+                                   str(args.workers), '--threads', str(args.threads)],
+                                  cwd=root, env=env, stdout=devnull, stderr=devnull)
+    try:
+        url = 'http://127.0.0.1:{0}'.format(args.port)
+        wait_ready(url)
+        pool = multiprocessing.Pool(args.clients)
+        results = pool.map(run_client, [(url, first_day, args.days, args.duration, seed)
+                                        for seed in range(args.clients)])
+        pool.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = [latency for client_latencies, _ in results for latency in client_latencies]
+    errors = sum(client_errors for _, client_errors in results)
+    print 'Cache: {0} locations, {1} menus of {2} beverages each'.format(len(locations), args.days, args.beverages)
+    print 'Server: {0} workers of {1} threads, {2} clients'.format(args.workers, args.threads, args.clients)
+    print 'Requests: {0}, errors: {1}'.format(len(latencies), errors)
+    if latencies:
+        print 'Throughput: {0:.0f} requests/s'.format(len(latencies) / args.duration)
+        print 'Latency p50: {0:.1f}ms, p99: {1:.1f}ms'.format(percentile(latencies, 50) * 1000,
+                                                              percentile(latencies, 99) * 1000)
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+from scraper import metrics
+
+lookups = metrics.counter('web_cache_lookups_total', 'In process cache lookups, by cache and result hit or miss')
+
+
+class LRUCache(object):
+    """
+    Thread safe, size bounded cache which evicts the least recently used entry.
+    """
+
+    def __init__(self, max_size, name=None):
+        """
+        :param max_size: Maximum number of entries.
+        :type max_size: int
+        :param name: Name the hits and misses are reported under in the metrics, not reported if None.
+        :type name: str
+        """
+        self.max_size = max_size
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        Get the entry for a key, computing and caching it on a miss.
+
+        :param key: Hashable key.
+        :param compute: Called with no arguments to create the entry on a miss.
+        :type compute: callable
+        :return: Cached or computed entry.
+        """
+        with self._lock:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                self.hits += 1
+                if self.name:
+                    lookups.inc(cache=self.name, result='hit')
+                return value
+            self.misses += 1
+            if self.name:
+                lookups.inc(cache=self.name, result='miss')
+        # Compute outside of the lock so a slow entry does not block hits on other keys
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: Number of entries, hits and misses.
+        :rtype: dict
+        """
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
@@ -1,2 +1,3 @@
-from web import app
+from web import app, views
+views.warm_caches()
 app.run(debug=True)
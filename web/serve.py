@@ -0,0 +1,178 @@
+import argparse
+import errno
+import glob
+import logging
+import os
+import Queue
+import signal
+import socket
+import sys
+import threading
+from time import sleep
+
+from werkzeug.serving import BaseWSGIServer
+
+from web import app, views
+from scraper import metrics
+
+root_log = logging.getLogger()
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server handling requests on a fixed pool of threads rather than a new thread per request, so a burst of
+    traffic queues instead of exhausting the process.
+    """
+
+    def __init__(self, host, port, app, threads=8, fd=None):
+        BaseWSGIServer.__init__(self, host, port, app, fd=fd)
+        self._requests = Queue.Queue(threads * 4)
+        self._threads = [threading.Thread(target=self._handle) for _ in range(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _handle(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def serve(host='127.0.0.1', port=5000, workers=2, threads=8, backlog=128, metrics_dir=None, metrics_interval=5):
+    """
+    Pre-fork server. The listening socket is opened once, then each worker process accepts connections from it with
+    its own thread pool, store connections and caches. Workers which exit are restarted until the server is stopped
+    with SIGINT or SIGTERM.
+
+    Each worker has its own metrics. With metrics_dir every worker dumps them there every metrics_interval seconds, so
+    /metrics reports the sum of all the workers whichever one serves it. Dumps of exited workers are kept so their
+    counts are not lost.
+
+    :param host: Address to bind to.
+    :type host: str
+    :param port: Port to bind to.
+    :type port: int
+    :param workers: Number of worker processes.
+    :type workers: int
+    :param threads: Number of request threads per worker.
+    :type threads: int
+    :param backlog: Listen backlog of the socket.
+    :type backlog: int
+    :param metrics_dir: Directory the workers dump their metrics to, emptied on start.
+    :type metrics_dir: str
+    :param metrics_interval: Seconds between dumps of a worker's metrics.
+    :type metrics_interval: float
+    """
+    if metrics_dir:
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+        for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+            os.remove(path)
+        views.metrics_dir = metrics_dir
+
+    listener = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    _log('Listening on {0}:{1} with {2} workers of {3} threads'.format(host, listener.getsockname()[1], workers,
+                                                                        threads))
+
+    children = set()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            _kill(pid)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while not stopping:
+        while len(children) < workers and not stopping:
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                _run_worker(host, listener, threads, metrics_interval)
+                os._exit(0)
+            children.add(pid)
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+            continue
+        children.discard(pid)
+        if not stopping:
+            _log('Worker {0} exited with status {1}, restarting'.format(pid, status), logging.WARN)
+
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+    listener.close()
+
+
+def _run_worker(host, listener, threads, metrics_interval):
+    # Metrics recorded by the parent before forking are the parent's
+    metrics.reset()
+    server = PooledWSGIServer(host, 0, app, threads, fd=listener.fileno())
+    _log('Worker {0} warmed {1} menus'.format(os.getpid(), views.warm_caches()))
+    if views.metrics_dir:
+        dumper = threading.Thread(target=_dump_metrics, args=(metrics_interval,))
+        dumper.daemon = True
+        dumper.start()
+    server.serve_forever()
+
+
+def _dump_metrics(interval):
+    path = os.path.join(views.metrics_dir, views.worker_metrics_name())
+    while True:
+        try:
+            metrics.dump(path)
+        except (IOError, OSError) as e:
+            _log('Unable to dump metrics to {0}: {1}'.format(path, str(e)), logging.WARN)
+        sleep(interval)
+
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def _log(message, level=logging.INFO):
+    root_log.log(level, message)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+    root_log.setLevel(logging.INFO)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Serve the web app with pre-forked worker processes.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to bind to')
+    parser.add_argument('--port', type=int, default=5000, help='port to bind to')
+    parser.add_argument('--workers', type=int, default=2, help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='number of request threads per worker')
+    parser.add_argument('--backlog', type=int, default=128, help='listen backlog')
+    parser.add_argument('--metrics-dir', type=str, default=views.metrics_dir,
+                        help='directory workers dump their metrics to, so /metrics reports every worker')
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, args.threads, args.backlog, args.metrics_dir)
@@ -1,8 +1,50 @@
+import os
+from time import time as now
+
 from web import app
-from scraper.scrape import get_cache, get_cache_near, get_cache_extreme
-from flask import render_template, request
+from web.cache import LRUCache
+from scraper import metrics
+from scraper.cache_store import location_key, snapshot_etag, url_time_format
+from scraper.scrape import find_cache, get_store
+from flask import Response, abort, g, jsonify, make_response, render_template, request
 from datetime import datetime, timedelta
-from scraper.menu_diff import diff
+from scraper.diff_chain import compose
+from scraper.manifest import ManifestException, page
+from scraper.parse_menu import normalized_fields
+from scraper.search_index import search
+
+# Parsed menus keyed by snapshot, snapshots never change once cached
+menu_cache = LRUCache(128, 'menus')
+# Changes composed from the diff chain keyed by the (start snapshot, end snapshot) pair
+diff_cache = LRUCache(1024, 'diffs')
+
+# Seconds the menu view of a snapshot may be cached, its menu only changes if it is reparsed
+snapshot_max_age = 24 * 60 * 60
+# Seconds the menu view of a day may be cached before it is revalidated, a later scrape or a reparse replaces it
+day_menu_max_age = 60
+
+# Set once warm_caches has run, until then the app reports it is not ready for traffic
+ready = False
+
+# Directory every worker of web.serve dumps its metrics to, /metrics reports the sum of the workers when set
+metrics_dir = os.environ.get('STOUT_METRICS_DIR')
+
+request_seconds = metrics.timer('web_request_seconds', 'Time to handle a request, by route, method and status')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = now()
+
+
+@app.after_request
+def observe_request(response):
+    # Streamed responses are timed until the response starts
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        request_seconds.observe(now() - started, route=request.url_rule.rule if request.url_rule else 'unmatched',
+                                method=request.method, status=response.status_code)
+    return response
 
 
 @app.route('/')
@@ -12,14 +54,85 @@ def home():
 
 @app.route('/menu/')
 def menu_index():
-    # TODO: List all menus, click to view
-    return 'Menu index'
+    # The filter options and the listed menus use location keys, "Studio City" selects studio_city
+    location = request.args.get('location')
+    location = location_key(location) if location else None
+    start = request.args.get('start')
+    end = request.args.get('end')
+    after = request.args.get('after')
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    try:
+        start_date = datetime.strptime(start, '%Y-%m-%d') if start else None
+        # Include menus scraped at any time on the end day
+        end_date = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+        entries, cursor = page(get_store(), location, start_date, end_date, after, limit)
+    except (ValueError, ManifestException):
+        abort(400)
+    if request.args.get('format') == 'json':
+        return jsonify(menus=entries, next=cursor)
+    return render_template('menu_index.html', menus=entries, next=cursor, locations=sorted(get_store().locations()),
+                           location=location, start=start, end=end, limit=limit)
 
 
 @app.route('/menu/<menu_name>/')
 def menu_view(menu_name):
-    menu = get_cache(name=menu_name)
-    return render_template('table_view.html', menu=menu)
+    snapshot = find_cache(name=menu_name)
+    if not snapshot:
+        abort(404)
+    response = snapshot_response(snapshot)
+    response.cache_control.max_age = day_menu_max_age
+    response.cache_control.must_revalidate = True
+    return response
+
+
+@app.route('/menu/<location>/<scraped>/')
+def snapshot_view(location, scraped):
+    try:
+        time = datetime.strptime(scraped, url_time_format)
+    except ValueError:
+        abort(404)
+    snapshot = get_store().find_scraped(location, time)
+    if not snapshot:
+        abort(404)
+    response = snapshot_response(snapshot)
+    response.cache_control.max_age = snapshot_max_age
+    return response
+
+
+def snapshot_response(snapshot):
+    """
+    Render the menu view of a snapshot, as JSON with format=json and sorted by a numeric field with sort and order.
+    If-None-Match is answered with 304 without loading the menu, the caller sets the lifetime.
+
+    :param snapshot: Snapshot from the menu cache store.
+    :type snapshot: cache_store.Snapshot
+    :rtype: flask.Response
+    """
+    sort = request.args.get('sort')
+    if sort not in normalized_fields:
+        sort = None
+    descending = request.args.get('order') == 'desc'
+    as_json = request.args.get('format') == 'json'
+    etag = snapshot_etag(snapshot)
+    if sort:
+        etag += '-{0}-{1}'.format(sort, 'desc' if descending else 'asc')
+    if as_json:
+        etag += '-json'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        menu = load_menu(snapshot)
+        # Sort the beverages of each section by one of the numeric fields parsed at ingest
+        if sort:
+            menu = sort_menu(menu, sort, descending)
+        if as_json:
+            response = jsonify(menu)
+        else:
+            response = make_response(render_template('table_view.html', menu=menu, sort=sort,
+                                                     descending=descending))
+    response.set_etag(etag)
+    response.cache_control.public = True
+    return response
 
 
 @app.route('/menu/diff/')
@@ -33,17 +146,143 @@ def menu_diff():
     # Compute menu diff
     _diff = None
     if location and start:
-        start_date = datetime.strptime(start, '%Y-%m-%d')
-        start_menu = get_cache_near(location, start_date, True)
-        if end:
-            end_date = datetime.strptime(end, '%Y-%m-%d')
-            end_menu = get_cache_near(location, end_date, False)
-        else:
-            end_menu = get_cache_extreme(location, 'new')
-        _diff = diff(start_menu, end_menu)
+        _diff = diff_range(location, start, end)
     # Form defaults
     if not start:
         start = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
     if not end:
         end = datetime.now().strftime('%Y-%m-%d')
     return render_template('diff.html', diff=_diff, location=location, start=start, end=end)
+
+
+@app.route('/search/')
+def beverage_search():
+    query = request.args.get('q', '')
+    # location is the Stout location, origin where the beverage is from
+    results = search(get_store(), query, request.args.get('location'), request.args.get('limit', 50, type=int),
+                     brewery=request.args.get('brewery'), style=request.args.get('style'),
+                     location=request.args.get('origin'), year=request.args.get('year'))
+    return jsonify(query=query, results=results)
+
+
+@app.route('/healthz')
+def healthz():
+    return jsonify(status='ok')
+
+
+@app.route('/readyz')
+def readyz():
+    if not ready:
+        return jsonify(status='warming'), 503
+    try:
+        get_store().connection().execute('SELECT 1 FROM snapshots LIMIT 1').fetchall()
+    except Exception as e:
+        return jsonify(status='error', error=str(e)), 503
+    return jsonify(status='ready')
+
+
+@app.route('/cache/stats/')
+def cache_stats():
+    return jsonify(menus=menu_cache.stats(), diffs=diff_cache.stats())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if metrics_dir:
+        # This worker's own metrics are current, the other workers' are as of their last dump
+        snapshots = [metrics.registry.snapshot()] + metrics.load_dir(metrics_dir, worker_metrics_name())
+        text = metrics.render_merged(snapshots)
+    else:
+        text = metrics.registry.render()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+def load_menu(snapshot):
+    """
+    Load the menu of a snapshot through the in process menu cache.
+
+    :param snapshot: Snapshot from the menu cache store.
+    :type snapshot: cache_store.Snapshot
+    :return: Parsed menu, shared between requests so it must not be modified.
+    :rtype: dict
+    """
+    return menu_cache.get(snapshot, lambda: get_store().load(snapshot))
+
+
+def sort_menu(menu, field, descending=False):
+    """
+    Sort the beverages of each section by a numeric details field, beverages without the field last.
+
+    :param menu: Parsed menu, not modified.
+    :type menu: dict
+    :param field: One of parse_menu.normalized_fields.
+    :type field: str
+    :param descending: Largest first.
+    :type descending: bool
+    :return: Copy of the menu with sorted sections.
+    :rtype: dict
+    """
+    def value(beverage):
+        return (beverage.get('details') or {}).get(field)
+
+    sections = []
+    for section in menu['sections']:
+        present = [beverage for beverage in section['beverages'] if value(beverage) is not None]
+        missing = [beverage for beverage in section['beverages'] if value(beverage) is None]
+        present.sort(key=value, reverse=descending)
+        sections.append(dict(section, beverages=present + missing))
+    return dict(menu, sections=sections)
+
+
+def diff_range(location, start, end=None):
+    """
+    Changes to a location's menu between two days, composed from the diff chain through the in process diff cache.
+
+    :param location: Stout location name.
+    :type location: str
+    :param start: First day, YYYY-MM-DD.
+    :type start: str
+    :param end: Last day, YYYY-MM-DD, the latest menu if not given.
+    :type end: str
+    :return: Diff from diff_chain.compose, None if the location has no menus in the range.
+    :rtype: dict
+    """
+    store = get_store()
+    start_date = datetime.strptime(start, '%Y-%m-%d')
+    start_snapshot = store.find_near(location, start_date, 'new')
+    if end:
+        # Include menus scraped at any time on the end day
+        end_date = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1, microseconds=-1)
+        end_snapshot = store.find_near(location, end_date, 'old')
+    else:
+        end_snapshot = store.find_extreme(location, 'new')
+    if not start_snapshot or not end_snapshot:
+        return None
+    return diff_cache.get((start_snapshot, end_snapshot), lambda: compose(store, start_snapshot, end_snapshot))
+
+
+def warm_caches():
+    """
+    Load the latest menu of every location into the menu cache, then report ready.
+
+    :return: Number of menus loaded.
+    :rtype: int
+    """
+    global ready
+    store = get_store()
+    count = 0
+    for location in store.locations():
+        snapshot = store.find_extreme(location, 'new')
+        if snapshot:
+            load_menu(snapshot)
+            count += 1
+    ready = True
+    return count
+
+
+def worker_metrics_name():
+    """
+    :return: File name the metrics of this worker are dumped to in metrics_dir.
+    :rtype: str
+    """
+    return '{0}.json'.format(os.getpid())